@@ -95,6 +95,20 @@ def nodes_join_network(nodes):
     t2 = time.time()
     return t2 - t1
 
+def nodes_join_network_concurrently(nodes):
+    threads = [
+        threading.Thread(target=do_request,
+                         args=(node, "POST", f"/join?nprime={nodes[0]}"))
+        for node in nodes[1::]
+    ]
+    t1 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t2 = time.time()
+    return t2 - t1
+
 def nodes_leave_network(size, nodes):
     remove_nodes = random.sample(nodes, k=size)
     t1 = time.time()
@@ -114,6 +128,42 @@ def sim_recover(node):
     do_request(node, "POST", "/sim-recover")
 
 
+def set_faults(node, rules):
+    do_request(node, "PUT", "/admin/faults", json.dumps(rules))
+
+
+def inject_faults(nodes, rule):
+    # The same rule on every link; an empty rule turns injection off.
+    for node in nodes:
+        set_faults(node, {"*": rule} if rule else {})
+
+
+def partition(groups, rule=None):
+    # Cut every link between the groups, in both directions. Links within a
+    # group keep rule.
+    for group in groups:
+        rules = {"*": rule} if rule else {}
+        for other in groups:
+            if other is not group:
+                for node in other:
+                    rules[node] = {"partition": True}
+        for node in group:
+            set_faults(node, rules)
+
+
+def measure_lookups(nodes, keys):
+    # Mean GET time through random nodes, and how many GETs failed.
+    failed = 0
+    t1 = time.time()
+    for key in keys:
+        r = do_request(random.choice(nodes), "GET", f"/storage/{key}",
+                       accept_statuses=[200, 404, 500, 502, 504])
+        if r.status != 200 or r.body != key:
+            failed += 1
+    t2 = time.time()
+    return (t2 - t1) / len(keys), failed
+
+
 def get_neighbours(node):
     conn = httplib.HTTPConnection(node)
     conn.request("GET", "/neighbors")
@@ -140,19 +190,75 @@ def walk_neighbours(start_nodes):
     return visited
 
 
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="api_network_test")
+
+    parser.add_argument("--concurrent", action="store_true",
+                        help="join all nodes at once instead of one by one")
+
+    parser.add_argument("--latency", type=float, default=0,
+                        help="injected one-way latency between nodes in ms")
+
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="injected jitter between nodes in ms")
+
+    parser.add_argument("--bandwidth", type=float, default=0,
+                        help="bandwidth of each link between nodes in bytes/s")
+
+    parser.add_argument("--drop", type=float, default=0,
+                        help="probability that a message between nodes is lost")
+
+    parser.add_argument("--keys", type=int, default=0,
+                        help="number of keys to store and look up after joining")
+
+    parser.add_argument("--partition", type=float, default=0,
+                        help="split the ring in two halves for this many seconds " +
+                        "before the leave test")
+
+    return parser
+
+
 def main():
+    args = arg_parser().parse_args()
     nodes = retrieve_nodes_from_file()
-    
-    time = nodes_join_network(nodes)
-    print("Join time", time)
+
+    if args.concurrent:
+        duration = nodes_join_network_concurrently(nodes)
+    else:
+        duration = nodes_join_network(nodes)
+    print("Join time", duration)
 
     walked_nodes = set([nodes[0]])
     walked_nodes |= walk_neighbours([nodes[0]])
     walked_nodes = list(walked_nodes)
     print("%d nodes registered: %s" % (len(walked_nodes), ", ".join(walked_nodes)))
 
-    time, node = nodes_leave_network(25, nodes)
-    print("Leave time", time)
+    # Faults go in once the ring is up; the join protocol has no retries
+    # for lost messages.
+    rule = {name: value for name, value in (
+        ("latency", args.latency), ("jitter", args.jitter),
+        ("bandwidth", args.bandwidth), ("drop", args.drop)) if value}
+    inject_faults(nodes, rule)
+
+    keys = [str(uuid.uuid4()) for i in range(args.keys)]
+    for key in keys:
+        do_request(random.choice(nodes), "PUT", f"/storage/{key}", key,
+                   accept_statuses=[200, 500, 502, 504])
+    if keys:
+        print("Lookup time %f, %d failed" % measure_lookups(nodes, keys))
+
+    if args.partition:
+        half = len(nodes) // 2
+        partition([nodes[:half], nodes[half:]], rule)
+        if keys:
+            print("Lookup time during partition %f, %d failed" % measure_lookups(nodes, keys))
+        time.sleep(args.partition)
+        inject_faults(nodes, rule)
+        if keys:
+            print("Lookup time after partition %f, %d failed" % measure_lookups(nodes, keys))
+
+    duration, node = nodes_leave_network(25, nodes)
+    print("Leave time", duration)
 
     walked_nodes = set([node])
     walked_nodes |= walk_neighbours([node])
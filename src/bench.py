@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+import argparse
+import gc
+import http.client
+import io
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from compress import encode
+from node import NodeHttpHandler, ThreadingHttpServer
+from store import encode_items
+
+# Micro-benchmarks of the node's hot paths, each on its own, and of a whole
+# PUT and GET against a node in this process.
+#
+# Every benchmark runs in a loop long enough to take --min-time seconds,
+# --repeat times, with the garbage collector off as timeit does, and the
+# median and the fastest of those runs are kept, per operation. Results are
+# appended to a file with the commit they were measured on, and compared to
+# the last results of another commit (or of the same one before its
+# uncommitted changes): a benchmark that got slower by more than the
+# threshold in both its median and its fastest run is a regression, and
+# makes the script exit with 1. Numbers are only comparable on one machine.
+
+VALUE_SIZE = 100
+JOIN_ITEMS = 100
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="bench")
+
+    parser.add_argument("-k", "--filter", type=str, default="",
+                        help="only run the benchmarks whose name contains this")
+
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="timed runs per benchmark, default 5")
+
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds each run takes at least, default 0.2")
+
+    parser.add_argument("--results", type=str, default="bench.jsonl",
+                        help="file the results of every commit go to, default bench.jsonl")
+
+    parser.add_argument("--baseline", type=str, default=None,
+                        help="commit to compare with, default the last other one measured")
+
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="slowdown that counts as a regression, default 0.1")
+
+    parser.add_argument("--no-save", action="store_true",
+                        help="compare, but don't add these results to the file")
+
+    parser.add_argument("--list", action="store_true",
+                        help="list the benchmarks and exit")
+
+    return parser
+
+
+class QuietHandler(NodeHttpHandler):
+    # Printing a log line per request would measure the terminal.
+    def log_message(self, format, *args):
+        pass
+
+
+def bench_node():
+    # A node with two neighbors, so ownership checks go through the whole
+    # comparison instead of the single-node shortcut. It owns the keys
+    # "own-*" and forwards "far-*".
+    node = ThreadingHttpServer.__new__(ThreadingHttpServer)
+    node.setup_node("localhost:8000")
+    node.predecessor = (format(int(node.key, 16) - (1 << 156), "040x"), "localhost:8001")
+    node.successor = (format(int(node.key, 16) + (1 << 156), "040x"), "localhost:8002")
+    return node
+
+
+def owned_keys(node, count):
+    keys = []
+    i = 0
+    while len(keys) < count:
+        key = f"own-{i}"
+        if node.next_hop(node.hash_value(key.encode())) is None:
+            keys.append(key)
+        i += 1
+    return keys
+
+
+def request_handler(node):
+    # A handler for requests made up in memory, answering into a socket
+    # that a thread keeps draining.
+    ours, theirs = socket.socketpair()
+
+    def drain():
+        while theirs.recv(1 << 16):
+            pass
+
+    threading.Thread(target=drain, daemon=True).start()
+    handler = QuietHandler.__new__(QuietHandler)
+    handler.server = node
+    handler.connection = ours
+    handler.client_address = ("127.0.0.1", 0)
+    handler.request_version = handler.protocol_version
+    handler.close_connection = True
+    return handler
+
+
+def bench_hash_value():
+    node = bench_node()
+    key = b"some-key-of-typical-length"
+    return lambda: node.hash_value(key)
+
+
+def bench_next_hop():
+    node = bench_node()
+    hashed_key = node.hash_value(owned_keys(node, 1)[0].encode())
+    return lambda: node.next_hop(hashed_key)
+
+
+def bench_store_value():
+    node = bench_node()
+    key = owned_keys(node, 1)[0]
+    value = encode(b"x" * VALUE_SIZE)
+    return lambda: node.store_value(key, value)
+
+
+def bench_get_value():
+    node = bench_node()
+    key = owned_keys(node, 1)[0]
+    node.store_value(key, encode(b"x" * VALUE_SIZE))
+    return lambda: node.get_value(key)
+
+
+def bench_dispatch_get():
+    # Route lookup, key parsing, the GET itself and the response.
+    node = bench_node()
+    key = owned_keys(node, 1)[0]
+    node.store_value(key, encode(b"x" * VALUE_SIZE))
+    handler = request_handler(node)
+    handler.path = f"/storage/{key}"
+    handler.requestline = f"GET {handler.path} HTTP/1.0"
+    handler.command = "GET"
+    handler.headers = {}
+    return lambda: handler.dispatch("GET")
+
+
+def bench_dispatch_put():
+    node = bench_node()
+    key = owned_keys(node, 1)[0]
+    value = b"x" * VALUE_SIZE
+    handler = request_handler(node)
+    handler.path = f"/storage/{key}"
+    handler.requestline = f"PUT {handler.path} HTTP/1.0"
+    handler.command = "PUT"
+    handler.headers = {"content-length": str(len(value))}
+
+    def put():
+        handler.rfile = io.BytesIO(value)
+        handler.dispatch("PUT")
+
+    return put
+
+
+def bench_send_whole_response():
+    handler = request_handler(bench_node())
+    handler.requestline = "GET /storage/key HTTP/1.0"
+    body = b"x" * VALUE_SIZE
+    return lambda: handler.send_whole_response(200, body, headers={"ETag": '"0"'})
+
+
+def bench_join_response():
+    # What find_neighbors sends a joining node: its neighbors and the keys
+    # it takes over, as JSON.
+    node = bench_node()
+    value = encode(b"x" * VALUE_SIZE)
+    items = [(node.hash_value(str(i).encode()), value, None, None) for i in range(JOIN_ITEMS)]
+    me = (node.key, node.address)
+    return lambda: json.dumps({"predecessor": me, "successor": me,
+                               "items": encode_items(items)})
+
+
+def bench_http_put_get():
+    # A PUT and a GET of the same key from a client, over HTTP, against a
+    # node serving on a thread of this process.
+    server = ThreadingHttpServer(("127.0.0.1", 0), QuietHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    address = f"127.0.0.1:{server.server_port}"
+    value = b"x" * VALUE_SIZE
+
+    def put_get():
+        for method, body in (("PUT", value), ("GET", None)):
+            conn = http.client.HTTPConnection(address)
+            conn.request(method, "/storage/bench", body)
+            resp = conn.getresponse()
+            resp.read()
+            conn.close()
+            if resp.status != 200:
+                raise RuntimeError(f"{method} failed with {resp.status}")
+
+    return put_get
+
+
+BENCHMARKS = {
+    "hash_value": bench_hash_value,
+    "next_hop": bench_next_hop,
+    "store_value": bench_store_value,
+    "get_value": bench_get_value,
+    "dispatch_get": bench_dispatch_get,
+    "dispatch_put": bench_dispatch_put,
+    "send_whole_response": bench_send_whole_response,
+    "join_response": bench_join_response,
+    "http_put_get": bench_http_put_get,
+}
+
+
+def time_loop(operation, loops):
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        start = time.perf_counter()
+        for i in range(loops):
+            operation()
+        return time.perf_counter() - start
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def run(setup, repeat, min_time):
+    # Nanoseconds per operation of every run.
+    operation = setup()
+    loops = 1
+    while (elapsed := time_loop(operation, loops)) < min_time:
+        loops = max(loops * 2, int(loops * min_time / max(elapsed, 1e-9) * 1.1))
+    return [time_loop(operation, loops) / loops * 1e9 for i in range(repeat)]
+
+
+def git(*args):
+    try:
+        return subprocess.run(["git", *args], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    try:
+        with open(path) as file:
+            return [json.loads(line) for line in file if line.strip()]
+    except FileNotFoundError:
+        return []
+
+
+def find_baseline(history, commit, dirty, baseline=None):
+    for entry in reversed(history):
+        if baseline is not None:
+            if entry["commit"].startswith(baseline) and not entry["dirty"]:
+                return entry
+        elif (entry["commit"], entry["dirty"]) != (commit, dirty):
+            return entry
+    return None
+
+
+def main(args):
+    names = [name for name in BENCHMARKS if args.filter in name]
+    if args.list:
+        print("\n".join(names))
+        return
+
+    commit = git("rev-parse", "HEAD") or "unknown"
+    dirty = bool(git("status", "--porcelain", "--untracked-files=no"))
+    history = load_results(args.results)
+    baseline = find_baseline(history, commit, dirty, args.baseline)
+    if args.baseline and baseline is None:
+        print(f"No results for {args.baseline} in {args.results}", file=sys.stderr)
+        sys.exit(2)
+
+    results = {}
+    regressions = []
+    print("%-20s %12s %12s %9s" % ("benchmark", "median ns", "min ns", "change"))
+    for name in names:
+        runs = run(BENCHMARKS[name], args.repeat, args.min_time)
+        results[name] = {"median": statistics.median(runs), "min": min(runs), "runs": runs}
+        change = ""
+        before = baseline["results"].get(name) if baseline else None
+        if before:
+            slower = results[name]["median"] / before["median"] - 1
+            change = "%+8.1f%%" % (slower * 100)
+            if (slower > args.threshold
+                    and results[name]["min"] > before["min"] * (1 + args.threshold)):
+                regressions.append(name)
+                change += " REGRESSION"
+        print("%-20s %12.0f %12.0f %s" % (
+            name, results[name]["median"], results[name]["min"], change))
+
+    if baseline:
+        print("Compared with %s%s, measured %s" % (
+            baseline["commit"][:10], " (uncommitted changes)" if baseline["dirty"] else "",
+            baseline["date"]))
+    if not args.no_save:
+        entry = {"commit": commit, "dirty": dirty,
+                 "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                 "python": platform.python_version(), "machine": platform.node(),
+                 "results": results}
+        with open(args.results, "a") as file:
+            file.write(json.dumps(entry) + "\n")
+    if regressions:
+        print("%d regressions beyond %.0f%%: %s" % (
+            len(regressions), args.threshold * 100, ", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(arg_parser().parse_args())
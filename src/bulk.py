@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import http.client
+import json
+import queue
+import struct
+import sys
+import threading
+import time
+from bisect import bisect_right
+from hashlib import sha1
+
+from compress import AVAILABLE, MIN_SIZE, decode, encode
+from store import decode_items, encode_items
+
+# Bulk import and export of a whole ring.
+#
+# The importer reads the ring layout from the nodes, hashes every key itself
+# and sends each owner its keys in large batches, on a few connections per
+# owner at once. Each owner has a bounded queue of batches, so a slow owner
+# holds up reading the input instead of piling it up in memory. Values are
+# compressed here, if asked to, so the nodes store them as they come. A
+# node only stores the keys it owns and sends back the rest, which happens
+# when the ring changed since the layout was read; those are sent again
+# with a fresh layout.
+#
+# The exporter pages through the range of every node at once, with
+# /admin/range.
+#
+# Files are either newline-delimited JSON, one {"key": ..., "value": ...}
+# per line (or "value_base64" for values that aren't UTF-8, and optionally
+# "ttl" in seconds or "expires_at" in Unix time), or binary records:
+#
+#   key length (u16) | value length (u32) | expires_at (f64, 0 for none) | key | value
+#
+# Keys are only known on export if the nodes run with --keep-keys. Without
+# them, exported records carry the key's hash instead: "hash" in JSON, and
+# in binary an empty key followed by the 20 byte hash. Both import as they
+# are.
+
+RECORD = struct.Struct("!HId")
+DIGEST_SIZE = 20
+RETRIES = 5
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="bulk")
+
+    parser.add_argument("action", choices=("import", "export"))
+
+    parser.add_argument("file", type=str,
+                        help="file to import from or export to, - for stdin/stdout")
+
+    parser.add_argument("nodes", type=str, nargs="+",
+                        help="addresses (host:port) of one or more nodes of the ring")
+
+    parser.add_argument("-f", "--format", choices=("ndjson", "binary"), default="ndjson",
+                        help="file format, default ndjson")
+
+    parser.add_argument("-b", "--batch", type=int, default=1000,
+                        help="keys per request, default 1000")
+
+    parser.add_argument("-c", "--connections", type=int, default=2,
+                        help="requests in flight per node, default 2")
+
+    parser.add_argument("-q", "--queue", type=int, default=4,
+                        help="batches queued per node before reading waits, default 4")
+
+    parser.add_argument("--compress", choices=AVAILABLE,
+                        help="compress imported values with this codec")
+
+    parser.add_argument("--compress-min-size", type=int, default=MIN_SIZE,
+                        help=f"smallest value to compress, default {MIN_SIZE}")
+
+    parser.add_argument("--keep-existing", action="store_true",
+                        help="on import, leave keys the ring already has as they are")
+
+    return parser
+
+
+def request(node, method, path, body=None):
+    conn = http.client.HTTPConnection(node, timeout=60)
+    try:
+        conn.request(method, path, body)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except OSError as e:
+        return 504, str(e).encode()
+    finally:
+        conn.close()
+
+
+class Layout:
+    # The nodes of the ring by key. A hash belongs to the first node with a
+    # greater key, wrapping around at the top.
+    def __init__(self, seeds):
+        self.seeds = list(seeds)
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        nodes = {}
+        for seed in self.seeds:
+            address = seed
+            while address not in nodes.values():
+                status, body = request(address, "GET", "/node-info")
+                if status != 200:
+                    break
+                info = json.loads(body)
+                nodes[info["node_key"]] = address
+                address = info["successor"]
+            if nodes:
+                break
+        if not nodes:
+            raise RuntimeError("None of the nodes answered")
+        with self.lock:
+            self.keys = sorted(nodes)
+            self.nodes = [nodes[key] for key in self.keys]
+
+    def owner(self, hashed_key):
+        with self.lock:
+            return self.nodes[bisect_right(self.keys, hashed_key) % len(self.keys)]
+
+    def ranges(self):
+        # (node, start, end) of every node's range.
+        with self.lock:
+            return [(node, self.keys[i - 1], self.keys[i]) for i, node in enumerate(self.nodes)]
+
+
+def read_records(file, fmt):
+    # (key or None, hash or None, value, expires_at or None) per record.
+    now = time.time()
+    if fmt == "ndjson":
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "value_base64" in record:
+                value = base64.b64decode(record["value_base64"])
+            else:
+                value = record["value"].encode()
+            expires_at = record.get("expires_at")
+            if "ttl" in record:
+                expires_at = now + record["ttl"]
+            yield record.get("key"), record.get("hash"), value, expires_at
+        return
+    while header := file.read(RECORD.size):
+        key_length, value_length, expires_at = RECORD.unpack(header)
+        if key_length:
+            key, hashed_key = file.read(key_length).decode(), None
+        else:
+            key, hashed_key = None, file.read(DIGEST_SIZE).hex()
+        yield key, hashed_key, file.read(value_length), expires_at or None
+
+
+def write_record(file, fmt, item):
+    hashed_key, stored, expires_at, key = item
+    value = bytes(decode(stored))
+    if fmt == "ndjson":
+        record = {"key": key} if key is not None else {"hash": hashed_key}
+        try:
+            record["value"] = value.decode()
+        except UnicodeDecodeError:
+            record["value_base64"] = base64.b64encode(value).decode()
+        if expires_at is not None:
+            record["expires_at"] = expires_at
+        file.write((json.dumps(record) + "\n").encode())
+        return
+    key = key.encode() if key is not None else b""
+    file.write(RECORD.pack(len(key), len(value), expires_at or 0))
+    file.write(key or bytes.fromhex(hashed_key))
+    file.write(value)
+
+
+class Importer:
+    def __init__(self, layout, args):
+        self.layout = layout
+        self.args = args
+        self.queues = {}
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stored = 0
+        self.failed = 0
+
+    def queue(self, node):
+        # The queue of batches for node, with its sender threads.
+        if node not in self.queues:
+            self.queues[node] = queue.Queue(self.args.queue)
+            for i in range(self.args.connections):
+                thread = threading.Thread(target=self.sender, args=(node,))
+                thread.start()
+                self.threads.append(thread)
+        return self.queues[node]
+
+    def sender(self, node):
+        batches = self.queues[node]
+        while (batch := batches.get()) is not None:
+            self.send(node, batch)
+
+    def send(self, node, batch):
+        path = "/bulk?replace=0" if self.args.keep_existing else "/bulk"
+        for attempt in range(RETRIES):
+            status, body = request(node, "PUT", path, json.dumps(encode_items(batch)))
+            if status == 200:
+                misrouted = set(json.loads(body)["misrouted"])
+                with self.lock:
+                    self.stored += len(batch) - len(misrouted)
+                if not misrouted:
+                    return
+                # The ring changed; send those keys on to their new owners.
+                self.layout.refresh()
+                for owner, items in self.partition(
+                        [item for item in batch if item[0] in misrouted]).items():
+                    self.send(owner, items)
+                return
+            time.sleep(0.1 * 2 ** attempt)
+            self.layout.refresh()
+            node = self.layout.owner(batch[0][0])
+        print(f"{node}: giving up on {len(batch)} keys after {status} {body[:80]!r}",
+              file=sys.stderr)
+        with self.lock:
+            self.failed += len(batch)
+
+    def partition(self, items):
+        batches = {}
+        for item in items:
+            batches.setdefault(self.layout.owner(item[0]), []).append(item)
+        return batches
+
+    def run(self, records):
+        args = self.args
+        batches = {}
+        for key, hashed_key, value, expires_at in records:
+            hashed_key = hashed_key or sha1(key.encode()).hexdigest()
+            stored = encode(value, args.compress, args.compress_min_size)
+            node = self.layout.owner(hashed_key)
+            batch = batches.setdefault(node, [])
+            batch.append((hashed_key, stored, expires_at, key))
+            if len(batch) >= args.batch:
+                # Blocks while the node is args.queue batches behind.
+                self.queue(node).put(batch)
+                batches[node] = []
+        for node, batch in batches.items():
+            if batch:
+                self.queue(node).put(batch)
+        for node, batches in self.queues.items():
+            for i in range(args.connections):
+                batches.put(None)
+        for thread in self.threads:
+            thread.join()
+
+
+def export_range(node, start, end, args, out, lock, counts):
+    # A page at a time, each starting right after the last key of the one
+    # before.
+    while True:
+        status, body = request(
+            node, "GET", f"/admin/range?start={start}&end={end}&limit={args.batch}")
+        if status != 200:
+            raise RuntimeError(f"{node}: {status} {body[:80]!r}")
+        items = decode_items(json.loads(body))
+        with lock:
+            for item in items:
+                write_record(out, args.format, item)
+            counts[node] = counts.get(node, 0) + len(items)
+        if len(items) < args.batch:
+            return
+        start = items[-1][0] + "g"
+
+
+def export_all(layout, args, out):
+    lock = threading.Lock()
+    counts = {}
+    errors = []
+
+    def run(node, start, end):
+        try:
+            export_range(node, start, end, args, out, lock, counts)
+        except Exception as e:
+            errors.append(e)
+
+    ranges = layout.ranges()
+    threads = [threading.Thread(target=run, args=r) for r in ranges]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for e in errors:
+        print(e, file=sys.stderr)
+    layout.refresh()
+    if layout.ranges() != ranges:
+        print("The ring changed during the export; keys that moved may be missing",
+              file=sys.stderr)
+    return sum(counts.values()), len(errors)
+
+
+def main(args):
+    layout = Layout(args.nodes)
+    print("%d nodes in the ring" % len(layout.nodes), file=sys.stderr)
+    start = time.time()
+    if args.action == "import":
+        file = sys.stdin.buffer if args.file == "-" else open(args.file, "rb")
+        importer = Importer(layout, args)
+        with file:
+            importer.run(read_records(file, args.format))
+        keys, failed = importer.stored, importer.failed
+    else:
+        file = sys.stdout.buffer if args.file == "-" else open(args.file, "wb")
+        with file:
+            keys, failed = export_all(layout, args, file)
+    duration = time.time() - start
+    print("%d keys in %.2f s, %.0f keys/s" % (keys, duration, keys / duration), file=sys.stderr)
+    if failed:
+        print("FAILED", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(arg_parser().parse_args())
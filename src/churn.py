@@ -0,0 +1,338 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import http.client
+import math
+import random
+import threading
+import time
+
+from histogram import Histogram
+
+# Availability and latency of a running ring while its membership changes.
+# Client threads keep writing and reading their own keys through the nodes,
+# so they know what every read should return, while nodes join, leave,
+# crash (/sim-crash) and come back (/sim-recover, --downtime seconds later)
+# at random, at the given rates per second. The first node stays put, and
+# joins pick from nodes that left or were never in the ring (--spare).
+# Clients stop using a node the moment it crashes, and --drain seconds
+# before it leaves, so what is measured is the ring getting requests to
+# their keys, not clients finding out that a node went away.
+#
+# Every request is put in a --bucket second wide slot of the run, by when
+# it started: how many there were, how many failed (500, 502 or 504, or no
+# answer), how many got a wrong answer (a 404 or an old value for a key
+# that was written), and their p50 and p99, with the membership changes of
+# the slot next to them. For every change, it also shows how many requests
+# failed in the --window seconds after it and for how long. A write that
+# failed may or may not have happened, so its key isn't checked until it
+# is written again.
+#
+# In the end, once everything has recovered and --settle seconds have
+# passed, every key is read once more through the first node, and the keys
+# whose last acknowledged write is gone are lost.
+
+UNAVAILABLE = (500, 502, 504)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="churn")
+
+    parser.add_argument("nodes", type=str, nargs="+",
+                        help="addresses (host:port) of the nodes in the ring")
+
+    parser.add_argument("--spare", type=str, nargs="*", default=[],
+                        help="addresses of running nodes outside the ring, for joins")
+
+    parser.add_argument("-d", "--duration", type=float, default=60,
+                        help="seconds to run, default 60")
+
+    parser.add_argument("-t", "--threads", type=int, default=8,
+                        help="client threads, default 8")
+
+    parser.add_argument("-k", "--keys", type=int, default=200,
+                        help="keys per thread, default 200")
+
+    parser.add_argument("-w", "--write-ratio", type=float, default=0.3,
+                        help="share of requests that are PUTs, default 0.3")
+
+    parser.add_argument("--join-rate", type=float, default=0,
+                        help="joins per second, default 0")
+
+    parser.add_argument("--leave-rate", type=float, default=0,
+                        help="leaves per second, default 0")
+
+    parser.add_argument("--crash-rate", type=float, default=0,
+                        help="crashes per second, default 0")
+
+    parser.add_argument("--downtime", type=float, default=10,
+                        help="seconds until a crashed node recovers, default 10")
+
+    parser.add_argument("--drain", type=float, default=0.5,
+                        help="seconds clients stop using a node before it leaves, default 0.5")
+
+    parser.add_argument("--bucket", type=float, default=1,
+                        help="seconds per line of the timeline, default 1")
+
+    parser.add_argument("--window", type=float, default=5,
+                        help="seconds after a change to blame its failures on, default 5")
+
+    parser.add_argument("--settle", type=float, default=5,
+                        help="seconds to wait before the final check, default 5")
+
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed for the membership changes")
+
+    parser.add_argument("-o", "--output", type=str, default=None,
+                        help="also write the timeline to this CSV file")
+
+    return parser
+
+
+def request(node, method, path, body=None):
+    conn = http.client.HTTPConnection(node, timeout=30)
+    try:
+        conn.request(method, path, body)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except OSError:
+        return 504, b""
+    finally:
+        conn.close()
+
+
+class Membership:
+    # Which nodes are in the ring, out of it and crashed, and which of them
+    # clients may use.
+    def __init__(self, nodes, spare, rng):
+        self.seed = nodes[0]
+        self.members = list(nodes)
+        self.out = list(spare)
+        self.crashed = {}
+        self.usable = list(nodes)
+        self.rng = rng
+        self.lock = threading.Lock()
+
+    def pick(self):
+        with self.lock:
+            return random.choice(self.usable)
+
+    def take(self, source):
+        # A random node from source, but never the first one.
+        choices = [node for node in source if node != self.seed]
+        if not choices:
+            return None
+        node = self.rng.choice(choices)
+        with self.lock:
+            source.remove(node)
+            if node in self.usable:
+                self.usable.remove(node)
+        return node
+
+    def add(self, node):
+        with self.lock:
+            self.members.append(node)
+            self.usable.append(node)
+
+
+class Run:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.ring = Membership(args.nodes, args.spare, self.rng)
+        self.stop = threading.Event()
+        # (start, latency, outcome) of every request, and (time, event,
+        # node, status) of every membership change, relative to the start.
+        self.requests = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.expected = {}
+
+    def client(self, prefix):
+        rng = random.Random()
+        keys = [f"{prefix}-{i}" for i in range(self.args.keys)]
+        records = []
+        op = 0
+        while not self.stop.is_set():
+            key = rng.choice(keys)
+            op += 1
+            started = time.time()
+            if rng.random() < self.args.write_ratio:
+                value = f"{key}-{op}".encode()
+                status, body = request(self.ring.pick(), "PUT", f"/storage/{key}", value)
+                self.expected[key] = value if status == 200 else "unknown"
+                outcome = "ok" if status == 200 else "failed"
+            else:
+                status, body = request(self.ring.pick(), "GET", f"/storage/{key}")
+                outcome = self.check(key, status, body)
+            records.append((started - self.start, time.time() - started, outcome))
+        with self.lock:
+            self.requests.extend(records)
+
+    def check(self, key, status, body):
+        if status in UNAVAILABLE:
+            return "failed"
+        want = self.expected.get(key)
+        if want == "unknown" or want is None and status == 404:
+            return "ok"
+        return "ok" if status == 200 and body == want else "wrong"
+
+    def log(self, event, node, status):
+        self.events.append((time.time() - self.start, event, node, status))
+        print("%7.2f %-8s %s %d" % (self.events[-1][0], event, node, status))
+
+    def join(self):
+        node = self.ring.take(self.ring.out)
+        if node is None:
+            return
+        status, body = request(node, "POST", f"/join?nprime={self.ring.seed}")
+        self.log("join", node, status)
+        # A node that failed to join is left alone, whatever state it is in.
+        if status == 200:
+            self.ring.add(node)
+
+    def leave(self):
+        node = self.ring.take(self.ring.members)
+        if node is None:
+            return
+        time.sleep(self.args.drain)
+        status, body = request(node, "POST", "/leave")
+        self.log("leave", node, status)
+        with self.ring.lock:
+            self.ring.out.append(node)
+
+    def crash(self):
+        node = self.ring.take(self.ring.members)
+        if node is None:
+            return
+        status, body = request(node, "POST", "/sim-crash")
+        self.log("crash", node, status)
+        self.ring.crashed[node] = time.time() + self.args.downtime
+
+    def recover(self, node):
+        del self.ring.crashed[node]
+        status, body = request(node, "POST", "/sim-recover")
+        self.log("recover", node, status)
+        self.ring.add(node)
+
+    def churn(self):
+        # Changes one at a time, as a Poisson process of all the rates
+        # together, and recoveries when they are due.
+        actions = [(self.args.join_rate, self.join), (self.args.leave_rate, self.leave),
+                   (self.args.crash_rate, self.crash)]
+        total = sum(rate for rate, action in actions)
+        next_change = time.time() + self.rng.expovariate(total) if total else float("inf")
+        while True:
+            due = min([next_change, *self.ring.crashed.values()])
+            if self.stop.wait(max(0, due - time.time())):
+                break
+            for node, at in list(self.ring.crashed.items()):
+                if at <= time.time():
+                    self.recover(node)
+            if next_change <= time.time():
+                pick = self.rng.uniform(0, total)
+                for rate, action in actions:
+                    pick -= rate
+                    if pick <= 0:
+                        action()
+                        break
+                next_change = time.time() + self.rng.expovariate(total)
+        for node in list(self.ring.crashed):
+            self.recover(node)
+
+    def run(self):
+        self.start = time.time()
+        threads = [threading.Thread(target=self.client, args=(f"churn-{i}",))
+                   for i in range(self.args.threads)]
+        churner = threading.Thread(target=self.churn)
+        for thread in threads + [churner]:
+            thread.start()
+        time.sleep(self.args.duration)
+        self.stop.set()
+        for thread in threads + [churner]:
+            thread.join()
+        self.requests.sort()
+
+    def lost_keys(self):
+        lost = 0
+        for key, want in self.expected.items():
+            if want == "unknown":
+                continue
+            status, body = request(self.ring.seed, "GET", f"/storage/{key}")
+            if status != 200 or body != want:
+                lost += 1
+        return lost
+
+
+def timeline(run, width):
+    # [start, requests, failed, wrong, Histogram, events] per bucket.
+    buckets = [[i * width, 0, 0, 0, Histogram(), []]
+               for i in range(math.ceil(run.args.duration / width))]
+    for started, latency, outcome in run.requests:
+        bucket = buckets[min(int(started / width), len(buckets) - 1)]
+        bucket[1] += 1
+        bucket[2] += outcome == "failed"
+        bucket[3] += outcome == "wrong"
+        bucket[4].add(latency)
+    for at, event, node, status in run.events:
+        buckets[min(int(at / width), len(buckets) - 1)][5].append(f"{event} {node}")
+    return buckets
+
+
+def disruption(run, at, window):
+    # Failed or wrong requests that started within window seconds after at,
+    # and how long after at the last of them started.
+    bad = [started - at for started, latency, outcome in run.requests
+           if at <= started < at + window and outcome != "ok"]
+    return len(bad), max(bad, default=0)
+
+
+def main(args):
+    run = Run(args)
+    print("Running for %.0f s with %d clients, %d nodes in the ring and %d spare" % (
+        args.duration, args.threads, len(args.nodes), len(args.spare)))
+    run.run()
+
+    buckets = timeline(run, args.bucket)
+    rows = []
+    print()
+    print("%7s %9s %7s %6s %8s %8s  %s" % ("t", "req/s", "failed", "wrong", "p50 ms",
+                                          "p99 ms", "changes"))
+    for start, requests, failed, wrong, histogram, events in buckets:
+        rate = requests / args.bucket
+        error_rate = 100 * failed / requests if requests else 0
+        p50, p99 = histogram.percentile(50) * 1000, histogram.percentile(99) * 1000
+        print("%7.1f %9.1f %6.1f%% %6d %8.2f %8.2f  %s" % (
+            start, rate, error_rate, wrong, p50, p99, ", ".join(events)))
+        rows.append([start, requests, failed, wrong, round(p50, 3), round(p99, 3),
+                     ";".join(events)])
+
+    if run.events:
+        print()
+        print("%7s %-8s %-22s %10s %10s" % ("t", "change", "node", "bad reqs", "for s"))
+        for at, event, node, status in run.events:
+            bad, seconds = disruption(run, at, args.window)
+            print("%7.2f %-8s %-22s %10d %10.2f" % (at, event, node, bad, seconds))
+
+    overall = Histogram()
+    for bucket in buckets:
+        overall.merge(bucket[4])
+    failed = sum(bucket[2] for bucket in buckets)
+    wrong = sum(bucket[3] for bucket in buckets)
+    print()
+    print("%d requests, %.2f%% failed, %d wrong, p99 %.2f ms" % (
+        len(run.requests), 100 * failed / max(len(run.requests), 1), wrong,
+        overall.percentile(99) * 1000))
+    time.sleep(args.settle)
+    print("%d of %d keys lost" % (run.lost_keys(), len(run.expected)))
+
+    if args.output:
+        with open(args.output, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(["t", "requests", "failed", "wrong", "p50_ms", "p99_ms", "changes"])
+            writer.writerows(rows)
+
+
+if __name__ == "__main__":
+    main(arg_parser().parse_args())
@@ -0,0 +1,130 @@
+import zlib
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Value compression. Nodes store and pass around values in their stored
+# form: one byte naming the codec, followed by the value as that codec
+# encoded it. A value is compressed once, by the node a client stores it
+# through, and from then on every hop and the owner pass the stored form on
+# as it is. It is only decompressed for a client that doesn't accept its
+# encoding.
+#
+# Over HTTP the codec byte becomes the Content-Encoding of the body, so
+# clients can also store values they compressed themselves and read them
+# back compressed. Nodes send each other storage requests over HTTP the same
+# way, with an explicit Content-Encoding (identity too, which tells the
+# receiving node not to compress the value again) and an Accept-Encoding of
+# every codec. Over RPC the value part of a storage op is the stored form.
+
+IDENTITY = 0
+DEFLATE = 1
+LZ4 = 2
+ZSTD = 3
+
+NAMES = {IDENTITY: "identity", DEFLATE: "deflate", LZ4: "lz4", ZSTD: "zstd"}
+CODES = {name: code for code, name in NAMES.items()}
+ACCEPT_ALL = ", ".join(NAMES.values())
+
+# Values smaller than this are not worth compressing.
+MIN_SIZE = 512
+
+COMPRESSORS = {DEFLATE: zlib.compress}
+DECOMPRESSORS = {DEFLATE: zlib.decompress}
+if lz4:
+    COMPRESSORS[LZ4] = lz4.frame.compress
+    DECOMPRESSORS[LZ4] = lz4.frame.decompress
+if zstandard:
+    COMPRESSORS[ZSTD] = zstandard.compress
+    DECOMPRESSORS[ZSTD] = zstandard.decompress
+
+AVAILABLE = sorted(NAMES[code] for code in COMPRESSORS)
+
+
+def pack(code, data):
+    return bytes((code,)) + data
+
+
+def payload(stored):
+    return memoryview(stored)[1:]
+
+
+def encode(value, name=None, min_size=MIN_SIZE):
+    # The stored form of value, compressed with the codec called name if it
+    # is big enough and compressing actually makes it smaller.
+    if name and len(value) >= min_size:
+        code = CODES[name]
+        data = COMPRESSORS[code](value)
+        if len(data) < len(value):
+            return pack(code, data)
+    return pack(IDENTITY, value)
+
+
+def decode(stored):
+    code = stored[0]
+    if code == IDENTITY:
+        return payload(stored)
+    if code not in DECOMPRESSORS:
+        raise ValueError(f"No {NAMES.get(code, code)} codec on this node")
+    return DECOMPRESSORS[code](payload(stored))
+
+
+def header(headers, name):
+    name = name.lower()
+    for key, value in headers:
+        if key.lower() == name:
+            return value
+    return None
+
+
+def accepts(accept_encoding, name):
+    for part in (accept_encoding or "").split(","):
+        token, _, params = part.partition(";")
+        if token.strip().lower() not in (name, "*"):
+            continue
+        params = params.strip().lower()
+        try:
+            return not params.startswith("q=") or float(params[2:]) > 0
+        except ValueError:
+            return False
+    return False
+
+
+def from_body(body, content_encoding, name=None, min_size=MIN_SIZE):
+    # The stored form of a request body. Without a Content-Encoding the
+    # body is the plain value, which gets compressed here.
+    if content_encoding is None:
+        return encode(body, name, min_size)
+    code = CODES.get(content_encoding.strip().lower())
+    if code is None:
+        raise ValueError(f"Unknown Content-Encoding: {content_encoding}")
+    return pack(code, body)
+
+
+def to_body(stored, accept_encoding):
+    # The response body for a stored value and its Content-Encoding, or
+    # None if it had to be decoded for the client.
+    code = stored[0]
+    if code != IDENTITY and accepts(accept_encoding, NAMES[code]):
+        return payload(stored), NAMES[code]
+    return decode(stored), None
+
+
+def storage_request(method, stored):
+    # The body and headers a node sends a storage request to another node
+    # over HTTP with.
+    if method == "PUT":
+        return payload(stored), {"Content-Encoding": NAMES[stored[0]]}
+    return stored, {"Accept-Encoding": ACCEPT_ALL}
+
+
+def storage_response(body, headers):
+    # The stored form of the body of a storage response from another node.
+    return pack(CODES[header(headers, "Content-Encoding") or "identity"], body)
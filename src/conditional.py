@@ -0,0 +1,81 @@
+from hashlib import sha1
+
+from compress import IDENTITY, NAMES, decode, encode, pack
+
+# Conditional writes and atomic read-modify-write operations, evaluated on
+# the node that owns the key under the lock of the key's stripe, so they
+# take one routed request.
+#
+# A value's ETag is a hash of its stored form, so every node computes the
+# same ETag for the same value without keeping versions, and handoffs and
+# repairs carry it along for free.
+
+MODIFY_OPS = ("incr", "append")
+CONDITION_HEADERS = ("If-Match", "If-None-Match")
+
+
+def parse_condition(headers, query):
+    # The preconditions of a write, from its headers, or from its query
+    # string when another node passed the write on. None if it has none.
+    condition = {}
+    for name in CONDITION_HEADERS:
+        value = headers.get(name) or query.get(name.lower())
+        if value is not None:
+            condition[name] = value
+    return condition or None
+
+
+def etag(stored):
+    return '"' + sha1(stored).hexdigest()[:16] + '"'
+
+
+def parse_etags(header):
+    # "*" or a list of ETags; weak ETags compare like strong ones here.
+    if header.strip() == "*":
+        return "*"
+    return [tag.strip().removeprefix("W/") for tag in header.split(",")]
+
+
+def preconditions_hold(condition, current):
+    # condition maps If-Match and If-None-Match to their values; current is
+    # the stored value, or None if there is none.
+    if_match = condition.get("If-Match")
+    if if_match is not None:
+        tags = parse_etags(if_match)
+        if current is None or tags != "*" and etag(current) not in tags:
+            return False
+    if_none_match = condition.get("If-None-Match")
+    if if_none_match is not None:
+        tags = parse_etags(if_none_match)
+        if current is not None and (tags == "*" or etag(current) in tags):
+            return False
+    return True
+
+
+def incr(current, operand):
+    # Adds operand, 1 if empty, to a value that is a decimal integer, or to
+    # 0 if there is no value. Returns None if the value isn't an integer.
+    try:
+        number = int(bytes(decode(current))) if current is not None else 0
+        number += int(operand or 1)
+    except ValueError:
+        return None
+    return pack(IDENTITY, str(number).encode())
+
+
+def append(current, operand):
+    # Compressed values stay compressed, with the same codec. Returns None
+    # if this node can't decode the value.
+    if current is None:
+        return pack(IDENTITY, operand)
+    try:
+        data = bytes(decode(current)) + operand
+    except ValueError:
+        return None
+    if current[0] == IDENTITY:
+        return pack(IDENTITY, data)
+    return encode(data, NAMES[current[0]], 0)
+
+
+def modify(op, current, operand):
+    return (incr if op == "incr" else append)(current, operand)
@@ -0,0 +1,136 @@
+import random
+from collections import OrderedDict
+
+# Eviction policies for a store in cache mode. A policy tracks the keys of
+# the store: add() when a key is stored, touch() when it is read or
+# overwritten, remove() when it goes away, and victim() picks the key to
+# evict next without removing it, passing over skip, the key that is being
+# written. All of them are O(1) per call, and none
+# of them lock; the store calls them under the lock of the keys' stripe.
+# Adding a known key or touching or removing an unknown one is ignored.
+
+# Keys a sampled policy looks at per eviction, as in Redis.
+SAMPLES = 5
+
+
+class LruPolicy:
+    # Keys in order of last use, least recently used first.
+    def __init__(self):
+        self.keys = OrderedDict()
+
+    def add(self, key):
+        self.keys[key] = None
+
+    def touch(self, key):
+        if key in self.keys:
+            self.keys.move_to_end(key)
+
+    def remove(self, key):
+        self.keys.pop(key, None)
+
+    def victim(self, skip=None):
+        for key in self.keys:
+            if key != skip:
+                return key
+        return None
+
+
+class LfuPolicy:
+    # Keys bucketed by use count, each bucket in order of last use, so the
+    # victim is the least recently used of the least frequently used keys.
+    def __init__(self):
+        self.counts = {}
+        self.buckets = {}
+        self.min_count = 0
+
+    def add(self, key):
+        if key in self.counts:
+            return
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+
+    def touch(self, key):
+        count = self.counts.get(key)
+        if count is None:
+            return
+        self.unlink(key, count)
+        if self.min_count == count and count not in self.buckets:
+            self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def remove(self, key):
+        count = self.counts.pop(key, None)
+        if count is not None:
+            self.unlink(key, count)
+
+    def unlink(self, key, count):
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+
+    def victim(self, skip=None):
+        if not self.buckets:
+            return None
+        # Only a remove() leaves min_count pointing at an emptied bucket,
+        # and finding the next one takes a pass over the counts in use.
+        if self.min_count not in self.buckets:
+            self.min_count = min(self.buckets)
+        for key in self.buckets[self.min_count]:
+            if key != skip:
+                return key
+        # skip is the only key with the lowest count.
+        counts = [count for count in self.buckets if count != self.min_count]
+        return next(iter(self.buckets[min(counts)])) if counts else None
+
+
+class SampledPolicy:
+    # Approximate LRU: evict the least recently used of a few random keys.
+    # Keys are kept in a list for O(1) sampling, with each key's position so
+    # it can be swapped out with the last one on removal.
+    def __init__(self):
+        self.keys = []
+        self.positions = {}
+        self.last_used = {}
+        self.clock = 0
+
+    def add(self, key):
+        if key in self.positions:
+            return
+        self.positions[key] = len(self.keys)
+        self.keys.append(key)
+        self.touch(key)
+
+    def touch(self, key):
+        if key not in self.positions:
+            return
+        self.clock += 1
+        self.last_used[key] = self.clock
+
+    def remove(self, key):
+        position = self.positions.pop(key, None)
+        if position is None:
+            return
+        del self.last_used[key]
+        last = self.keys.pop()
+        if last != key:
+            self.keys[position] = last
+            self.positions[last] = position
+
+    def victim(self, skip=None):
+        if not self.keys or self.keys == [skip]:
+            return None
+        sample = []
+        while not sample:
+            sample = [key for key in (random.choice(self.keys) for i in range(SAMPLES))
+                      if key != skip]
+        return min(sample, key=self.last_used.__getitem__)
+
+
+POLICIES = {
+    "lru": LruPolicy,
+    "lfu": LfuPolicy,
+    "random": SampledPolicy,
+}
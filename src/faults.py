@@ -0,0 +1,97 @@
+import random
+import threading
+import time
+
+# Fault injection for node-to-node traffic, so a ring running on loopback
+# can be tested under WAN-like conditions. Rules are set per peer address,
+# with "*" as the rule for every other peer, and apply to the requests this
+# node sends and the responses it gets back:
+#
+#   latency    one-way delay in ms, so a request/response takes twice that
+#   jitter     up to this many ms added to or taken off every delay
+#   bandwidth  bytes per second the link carries, shared by all requests
+#   drop       probability that a request or its response is lost
+#   partition  true to lose everything sent over the link
+#   timeout    ms the sender waits for a lost message, default 1000
+#
+# A lost message looks to the sender like a peer that timed out: it gets a
+# 504 once the rule's timeout, or the deadline of the request, has passed.
+# Rules only affect the sending side, so a symmetric partition has to be set
+# on both sides.
+
+DEFAULT_RULE = {
+    "latency": 0,
+    "jitter": 0,
+    "bandwidth": 0,
+    "drop": 0,
+    "partition": False,
+    "timeout": 1000,
+}
+
+
+class Link:
+    def __init__(self, rule):
+        unknown = set(rule) - set(DEFAULT_RULE)
+        if unknown:
+            raise ValueError(f"Unknown fault settings: {', '.join(sorted(unknown))}")
+        self.rule = dict(DEFAULT_RULE, **rule)
+        self.lock = threading.Lock()
+        self.busy_until = 0.0
+
+    def lost(self):
+        return self.rule["partition"] or random.random() < self.rule["drop"]
+
+    def transmit(self, size):
+        # Sleep for as long as sending size bytes over the link takes. With
+        # a bandwidth cap, messages queue up behind each other.
+        rule = self.rule
+        delay = rule["latency"] + random.uniform(-rule["jitter"], rule["jitter"])
+        delay = max(delay, 0) / 1000
+        if rule["bandwidth"]:
+            with self.lock:
+                now = time.monotonic()
+                self.busy_until = max(now, self.busy_until) + size / rule["bandwidth"]
+                delay += self.busy_until - now
+        time.sleep(delay)
+
+
+class Faults:
+    def __init__(self):
+        self.links = {}
+        self.lost = 0
+        self.lock = threading.Lock()
+
+    def configure(self, rules):
+        # Replaces all rules; an empty dict turns fault injection off.
+        self.links = {peer: Link(rule) for peer, rule in rules.items()}
+
+    def rules(self):
+        return {
+            "rules": {peer: link.rule for peer, link in self.links.items()},
+            "lost": self.lost,
+        }
+
+    def link(self, peer):
+        return self.links.get(peer) or self.links.get("*")
+
+    def send(self, peer, size, request, failed, timeout):
+        # Run request(), which returns (response, body size), as if it went
+        # over the link to peer. failed() builds the response for a lost
+        # message, which the sender waits at most timeout seconds for.
+        link = self.link(peer)
+        if link is None:
+            return request()[0]
+        if link.lost():
+            return self.lose(link, failed, timeout)
+        link.transmit(size)
+        resp, response_size = request()
+        if link.lost():
+            return self.lose(link, failed, timeout)
+        link.transmit(response_size)
+        return resp
+
+    def lose(self, link, failed, timeout):
+        with self.lock:
+            self.lost += 1
+        time.sleep(min(link.rule["timeout"] / 1000, timeout))
+        return failed()
@@ -0,0 +1,49 @@
+import math
+
+# Latency histograms that can be merged. Buckets grow by GROWTH each, from
+# a microsecond up, so every latency is known to within GROWTH of itself
+# however long it is, and a histogram stays a few hundred counts even over
+# millions of requests. Merging the histograms of several clients is adding
+# up their counts, and percentiles of the merged histogram are those of all
+# their requests together, which averaging each client's percentiles is
+# not.
+
+GROWTH = 1.05
+LOG_GROWTH = math.log(GROWTH)
+
+
+class Histogram:
+    def __init__(self, counts=None):
+        # {bucket: count}; bucket b holds latencies up to GROWTH ** b us.
+        self.counts = {int(b): c for b, c in (counts or {}).items()}
+
+    def add(self, seconds):
+        us = max(seconds * 1e6, 1)
+        bucket = math.ceil(math.log(us) / LOG_GROWTH - 1e-9)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def total(self):
+        return sum(self.counts.values())
+
+    def percentile(self, p):
+        # In seconds, the upper bound of the bucket the p-th percentile
+        # falls in; 0 for an empty histogram.
+        rank = self.total() * p / 100
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return GROWTH ** bucket / 1e6
+        return 0
+
+    def mean(self):
+        # Taking every latency as its bucket's upper bound.
+        total = self.total()
+        return sum(GROWTH ** b / 1e6 * c for b, c in self.counts.items()) / total if total else 0
+
+    def to_json(self):
+        return {str(bucket): count for bucket, count in self.counts.items()}
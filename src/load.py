@@ -0,0 +1,37 @@
+import threading
+
+# Load accounting for rebalancing. A node counts the storage requests it
+# serves as the owner of the key, and their bytes, per bucket of the ring:
+# the first two hex digits of the hash, so 1/256th of the ring each. Buckets
+# mean the same on every node, so a rebalancer can add up the counts of all
+# nodes into the load along the whole ring and see where to cut it. The
+# counts only ever grow; rates come from reading them twice.
+#
+# With a multiprocessing context the counts are shared by the workers of
+# one node.
+
+BUCKETS = 256
+
+
+class LoadTracker:
+    def __init__(self, ctx=None):
+        if ctx is None:
+            self.lock = threading.Lock()
+            self.ops = [0] * BUCKETS
+            self.bytes = [0] * BUCKETS
+        else:
+            self.lock = ctx.Lock()
+            self.ops = ctx.Array("q", BUCKETS, lock=False)
+            self.bytes = ctx.Array("q", BUCKETS, lock=False)
+
+    def add(self, hashed_key, size):
+        bucket = int(hashed_key[:2], 16)
+        with self.lock:
+            self.ops[bucket] += 1
+            self.bytes[bucket] += size
+
+    def snapshot(self):
+        # {bucket as two hex digits: [ops, bytes]} for the buckets used.
+        with self.lock:
+            return {f"{i:02x}": [self.ops[i], self.bytes[i]]
+                    for i in range(BUCKETS) if self.ops[i]}
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+from histogram import Histogram
+
+# Load from several client processes at once. One Python process can't keep
+# more than a few nodes busy, so the numbers test_client.py gives are the
+# client's. This starts --clients worker processes running this script,
+# each with --threads threads sending PUTs and GETs of its own keys to
+# random nodes of the ring, and waits until all of them have stored their
+# keys. Then it gives them all one start time, a moment ahead, and they run
+# for --duration seconds from then, leaving out the first --warmup seconds,
+# and send back their counts and latency histograms, which are merged into
+# one result (see histogram.py).
+#
+# The result is appended to data.csv as test_client.py does, as
+#
+#   nodes, requests, seconds, requests/s, p50 ms, p99 ms, clients, errors
+#
+# the first four of which plot.py plots.
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="loadtest")
+
+    parser.add_argument("nodes", type=str, nargs="+",
+                        help="addresses (host:port) of one or more nodes of the ring")
+
+    parser.add_argument("-c", "--clients", type=int, default=4,
+                        help="client processes, default 4")
+
+    parser.add_argument("-t", "--threads", type=int, default=4,
+                        help="requests in flight per client, default 4")
+
+    parser.add_argument("-d", "--duration", type=float, default=10,
+                        help="seconds to measure for, default 10")
+
+    parser.add_argument("--warmup", type=float, default=1,
+                        help="seconds to run before measuring, default 1")
+
+    parser.add_argument("-k", "--keys", type=int, default=1000,
+                        help="keys each client stores and then reads and writes, default 1000")
+
+    parser.add_argument("-s", "--value-size", type=int, default=100,
+                        help="bytes per value, default 100")
+
+    parser.add_argument("-r", "--read-ratio", type=float, default=0.5,
+                        help="share of requests that are GETs, default 0.5")
+
+    parser.add_argument("-o", "--output", type=str, default="data.csv",
+                        help="file to append the result row to, default data.csv")
+
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+
+    return parser
+
+
+def request(node, method, path, body=None):
+    conn = http.client.HTTPConnection(node, timeout=10)
+    try:
+        conn.request(method, path, body)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except OSError as e:
+        return 504, str(e).encode()
+    finally:
+        conn.close()
+
+
+def ring_nodes(seeds):
+    # Every node of the ring, following successors from the first seed that
+    # answers.
+    for seed in seeds:
+        nodes = []
+        address = seed
+        while address not in nodes:
+            status, body = request(address, "GET", "/node-info")
+            if status != 200:
+                break
+            nodes.append(address)
+            address = json.loads(body)["successor"]
+        if nodes:
+            return nodes
+    raise RuntimeError("None of the nodes answered")
+
+
+def worker(args):
+    # One client process: store the keys, say so, wait for the start time
+    # on stdin, run, and print the result as JSON.
+    rng = random.Random()
+    nodes = args.nodes
+    value = b"x" * args.value_size
+    keys = [str(uuid.uuid4()) for i in range(args.keys)]
+    for key in keys:
+        request(rng.choice(nodes), "PUT", f"/storage/{key}", value)
+    print("ready", flush=True)
+
+    start = float(sys.stdin.readline())
+    measure_from = start + args.warmup
+    end = measure_from + args.duration
+    histogram = Histogram()
+    counts = {"requests": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def run():
+        rng = random.Random()
+        local = Histogram()
+        requests = errors = 0
+        while (now := time.time()) < end:
+            key = rng.choice(keys)
+            if rng.random() < args.read_ratio:
+                status, body = request(rng.choice(nodes), "GET", f"/storage/{key}")
+            else:
+                status, body = request(rng.choice(nodes), "PUT", f"/storage/{key}", value)
+            if now >= measure_from:
+                local.add(time.time() - now)
+                requests += 1
+                errors += status != 200
+        with lock:
+            histogram.merge(local)
+            counts["requests"] += requests
+            counts["errors"] += errors
+
+    time.sleep(max(0, start - time.time()))
+    threads = [threading.Thread(target=run) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(json.dumps(dict(counts, histogram=histogram.to_json())), flush=True)
+
+
+def coordinate(args):
+    nodes = ring_nodes(args.nodes)
+    print("%d nodes in the ring; starting %d clients with %d threads each" % (
+        len(nodes), args.clients, args.threads))
+    command = [sys.executable, __file__, "--worker", *nodes,
+               "-t", str(args.threads), "-d", str(args.duration), "--warmup", str(args.warmup),
+               "-k", str(args.keys), "-s", str(args.value_size), "-r", str(args.read_ratio)]
+    clients = [subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                text=True) for i in range(args.clients)]
+    try:
+        for client in clients:
+            if client.stdout.readline().strip() != "ready":
+                raise RuntimeError("A client failed to start")
+        # Far enough ahead for every client to get it before it passes.
+        start = time.time() + 0.2 + 0.01 * args.clients
+        for client in clients:
+            client.stdin.write(f"{start}\n")
+            client.stdin.flush()
+        results = [json.loads(client.stdout.readline()) for client in clients]
+    finally:
+        for client in clients:
+            client.kill()
+            client.wait()
+
+    histogram = Histogram()
+    requests = errors = 0
+    for result in results:
+        histogram.merge(Histogram(result["histogram"]))
+        requests += result["requests"]
+        errors += result["errors"]
+    rate = requests / args.duration
+    p50, p99 = histogram.percentile(50) * 1000, histogram.percentile(99) * 1000
+    print("%d requests in %.1f s, %.0f requests/s, %d errors" % (
+        requests, args.duration, rate, errors))
+    print("latency p50 %.2f ms, p99 %.2f ms, p99.9 %.2f ms" % (
+        p50, p99, histogram.percentile(99.9) * 1000))
+    with open(args.output, "a") as file:
+        file.write(f"{len(nodes)},{requests},{args.duration},{rate},{p50:.3f},{p99:.3f},"
+                   f"{args.clients},{errors}\n")
+
+
+if __name__ == "__main__":
+    args = arg_parser().parse_args()
+    if args.worker:
+        worker(args)
+    else:
+        coordinate(args)
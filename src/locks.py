@@ -0,0 +1,56 @@
+import threading
+from contextlib import contextmanager
+
+# Reader-writer lock for the ring state. Any number of threads can hold it
+# for reading at once, a writer holds it alone. Writers take precedence:
+# once one is waiting, new readers wait behind it, so a steady stream of
+# storage requests can't hold off a neighbor update. It is not reentrant; a
+# thread that holds it must not take it again.
+#
+# With a multiprocessing context the lock works across processes, for the
+# workers of one node.
+
+READERS = 0
+WAITING_WRITERS = 1
+WRITING = 2
+
+
+class RWLock:
+    def __init__(self, ctx=None):
+        if ctx is None:
+            self.cond = threading.Condition(threading.Lock())
+            self.state = [0, 0, 0]
+        else:
+            self.cond = ctx.Condition(ctx.Lock())
+            self.state = ctx.Array("i", 3, lock=False)
+
+    @contextmanager
+    def read(self):
+        state = self.state
+        with self.cond:
+            while state[WAITING_WRITERS] or state[WRITING]:
+                self.cond.wait()
+            state[READERS] += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                state[READERS] -= 1
+                if not state[READERS]:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        state = self.state
+        with self.cond:
+            state[WAITING_WRITERS] += 1
+            while state[WRITING] or state[READERS]:
+                self.cond.wait()
+            state[WAITING_WRITERS] -= 1
+            state[WRITING] = 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                state[WRITING] = 0
+                self.cond.notify_all()
@@ -0,0 +1,75 @@
+import threading
+from hashlib import sha1
+
+HEX_DIGITS = "0123456789abcdef"
+DEPTH = 3
+
+
+def entry_hash(key, value):
+    return int.from_bytes(sha1(key.encode() + value).digest(), "big")
+
+
+def prefix_range(prefix):
+    # Every hex key starting with prefix sorts in [prefix, prefix + "g"),
+    # since "g" comes after all hex digits.
+    return prefix, prefix + "g"
+
+
+class MerkleTree:
+    # A fixed-shape tree over the hex prefixes of the keys, 16 children per
+    # node and DEPTH levels below the root. A node's digest is the XOR of the
+    # hashes of all entries below it, so a write only has to XOR the change
+    # into the DEPTH + 1 nodes on its path instead of rehashing the tree.
+    def __init__(self):
+        self.digests = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, old_value=None, new_value=None):
+        delta = 0
+        if old_value is not None:
+            delta ^= entry_hash(key, old_value)
+        if new_value is not None:
+            delta ^= entry_hash(key, new_value)
+        with self.lock:
+            for length in range(DEPTH + 1):
+                prefix = key[:length]
+                digest = self.digests.get(prefix, 0) ^ delta
+                if digest:
+                    self.digests[prefix] = digest
+                else:
+                    self.digests.pop(prefix, None)
+
+    def digest(self, prefix=""):
+        return self.digests.get(prefix, 0)
+
+    def children(self, prefix=""):
+        return [format(self.digest(prefix + c), "x") for c in HEX_DIGITS]
+
+
+# Ranges are [start, end) on the ring, wrapping around when start > end and
+# covering the whole ring when start == end.
+
+def overlaps(prefix, start, end):
+    lo, hi = prefix_range(prefix)
+    if start == end:
+        return True
+    if start < end:
+        return lo < end and start < hi
+    return hi > start or lo < end
+
+
+def covered(prefix, start, end):
+    lo, hi = prefix_range(prefix)
+    if start == end:
+        return True
+    if start < end:
+        return start <= lo and hi <= end
+    return lo >= start or hi <= end
+
+
+def in_range(key, start, end):
+    if start == end:
+        return True
+    if start < end:
+        return start <= key < end
+    return key >= start or key < end
@@ -1,390 +1,1441 @@
 import argparse
+import random
 import signal
+import time
 import threading
 import socket
 import socketserver
 import json
-import re
 import http.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
 from hashlib import sha1
 from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlencode
+
+from compress import AVAILABLE, MIN_SIZE, decode, from_body, storage_request, storage_response, to_body
+from conditional import MODIFY_OPS, etag, modify, parse_condition, preconditions_hold
+from eviction import POLICIES
+from faults import Faults
+from load import LoadTracker
+from locks import RWLock
+from merkle import DEPTH, HEX_DIGITS, covered, entry_hash, in_range, overlaps, prefix_range
+from profiling import (SAMPLE_INTERVAL, TRACE_FRAMES, Sampler, allocations, start_tracing,
+                       stop_tracing)
+from rpc import RPC_PORT_OFFSET, RpcClient, RpcResponse, RpcServer, encode_request, send_buffers
+from singleflight import SingleFlight
+from store import ObjectStore, decode_items, encode_items
+from timeouts import (CONNECT_TIMEOUT, DEADLINE_HEADER, LatencyTracker, RetryBudget,
+                      budget_ms, get_deadline, remaining, restore_deadline, set_deadline)
+
+
+JOIN_RETRIES = 16
+JOIN_BACKOFF = 0.05
+STABILIZE_MAX_HOPS = 1 << 16
+REQUEST_TIMEOUT = 10
+TTL_HEADER = "X-TTL"
+HEDGE_WORKERS = 32
+SCAN_LIMIT = 100
+SCAN_MAX_LIMIT = 1000
+# Pages a node prefetches for the scans going through it, and how long a
+# prefetched page is good for.
+SCAN_PREFETCH_SLOTS = 64
+SCAN_PREFETCH_TTL = 10
+# A node moving along the ring hands over keys in steps of about
+# MOVE_CHUNK, at MOVE_RATE keys/s by default.
+MOVE_CHUNK = 500
+MOVE_RATE = 5000
+RING_SIZE = 1 << 160
 
 
 class NodeHttpHandler(BaseHTTPRequestHandler):
-    def send_whole_response(self, code, content, content_type="text/plain"):
+    # Response heads up to the Date header, by status and content type.
+    response_heads = {}
+    # The Date header, formatted once a second.
+    date_header = (None, b"")
+
+    def response_head(self, code, content_type):
+        head = self.response_heads.get((code, content_type))
+        if head is None:
+            phrase = self.responses[code][0] if code in self.responses else ""
+            head = (f"{self.protocol_version} {code} {phrase}\r\n"
+                    f"Server: {self.version_string()}\r\n"
+                    f"Content-type: {content_type}\r\n").encode("latin-1")
+            self.response_heads[(code, content_type)] = head
+        now = int(time.time())
+        if NodeHttpHandler.date_header[0] != now:
+            NodeHttpHandler.date_header = (
+                now, f"Date: {self.date_time_string(now)}\r\n".encode("latin-1"))
+        return head + NodeHttpHandler.date_header[1]
+
+    def send_whole_response(self, code, content, content_type="text/plain", headers=None):
         if isinstance(content, str):
             content = content.encode("utf-8")
             if not content_type:
                 content_type = "text/plain"
             if content_type.startswith("text/"):
                 content_type += "; charset=utf-8"
-        elif isinstance(content, bytes):
+        elif isinstance(content, (bytes, bytearray, memoryview)):
             if not content_type:
                 content_type = "application/octet-stream"
         elif isinstance(content, object):
-            content = json.dumps(content, indent=2)
-            content += "\n"
-            content = content.encode("utf-8")
+            content = json.dumps(content, separators=(",", ":")).encode("utf-8")
             content_type = "application/json"
 
-        self.send_response(code)
-        self.send_header('Content-type', content_type)
-        self.send_header('Content-length', len(content))
-        self.end_headers()
-        self.wfile.write(content)
-
-    def extract_key_from_path(self, path):
-        return re.sub(r'/storage/?(\w+)', r'\1', path)
+        # The head and the content go out in one sendmsg, without copying
+        # the content, instead of through the buffered send_header path.
+        self.log_request(code)
+        head = self.response_head(code, content_type)
+        length = f"Content-length: {len(content)}\r\n\r\n"
+        if headers:
+            length = "".join(f"{k}: {v}\r\n" for k, v in headers.items()) + length
+        length = length.encode("latin-1")
+        send_buffers(self.connection, [head, length, content])
+
+    def query(self):
+        return {k: v[0] for k, v in parse_qs(self.query_string).items()}
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        budget = self.headers.get(DEADLINE_HEADER)
+        set_deadline(int(budget) / 1000 if budget else self.server.request_timeout)
+        return True
+
+    def dispatch(self, verb):
+        # One dict lookup for the exact path, and if that misses, one for
+        # its first segment among the keyed routes, which get the rest of
+        # the path, unquoted, as the key.
+        path, _, self.query_string = self.path.partition("?")
+        route = self.routes.get((verb, path))
+        args = ()
+        if route is None:
+            first, slash, rest = path.partition("/")[2].partition("/")
+            route = self.keyed_routes.get((verb, "/" + first)) if slash else None
+            args = (unquote(rest),)
+        if route is None:
+            self.send_whole_response(404, "Unknown path: " + self.path)
+            return
 
-    def do_PUT(self):
         content_length = int(self.headers.get('content-length', 0))
-        value = self.rfile.read(content_length)
+        value = self.rfile.read(content_length) if content_length else b""
 
-        if self.server.sim_crashed is True:
+        if self.server.sim_crashed is True and route not in self.available_when_crashed:
             self.send_whole_response(500, "I have sim-crashed")
-
-        elif self.path.startswith("/storage"):
-            key = self.extract_key_from_path(self.path)
-            status = self.server.store_value(key, value)
-            if status == 200:
-                msg = f"Value stored for {key}"
-            else:
-                msg = f"Failed to store value for {key}"
-            self.send_whole_response(status, msg)
-
-        elif self.path.startswith("/update"):
-            neighbors = json.loads(value.decode())
-            self.server.update_neighbors(neighbors)
-
-        elif self.path.startswith("/join"):
-            status, neighbors = self.server.find_neighbors(value)
-            self.send_whole_response(status, neighbors)
-
-        elif self.path.startswith("/stabilize"):
-            info = json.loads(value.decode())
-            node = self.server.stabilize(info)
-            self.send_whole_response(200, json.dumps({"key": node[0], "address": node[1]}))
+            return
+        route(self, *args, value)
 
     def do_GET(self):
-        if self.path.startswith("/node-info"):
-            response = {
-                "node_key": self.server.key,
-                "successor": self.server.successor[1],
-                "others": [self.server.predecessor[1]],
-                "sim_crash": self.server.sim_crashed
-            }
-            self.send_whole_response(200, response, content_type="application/json")
-
-        elif self.server.sim_crashed is True:
-            self.send_whole_response(500, "I have sim-crashed")
-
-        elif self.path.startswith("/key"):
-            self.send_whole_response(200, self.server.key)
+        self.dispatch("GET")
 
-        elif self.path.startswith("/storage"):
-            key = self.extract_key_from_path(self.path)
-
-            status, value = self.server.get_value(key)
-            self.send_whole_response(status, value)
+    def do_PUT(self):
+        self.dispatch("PUT")
 
-        elif self.path.startswith("/neighbors"):
-            if self.server.successor[1] == self.server.address:
-                self.send_whole_response(
-                    200, [])
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def put_storage(self, key, value):
+        ttl = self.headers.get(TTL_HEADER) or self.query().get("ttl")
+        try:
+            ttl = float(ttl) if ttl is not None else None
+        except ValueError:
+            self.send_whole_response(400, f"Invalid TTL: {ttl}")
+            return
+        try:
+            value = from_body(value, self.headers.get("Content-Encoding"),
+                              self.server.compress, self.server.compress_min_size)
+        except ValueError as e:
+            self.send_whole_response(415, str(e))
+            return
+        condition = parse_condition(self.headers, self.query())
+        status = self.server.store_value(key, value, ttl=ttl, condition=condition)
+        if status == 200:
+            # The ETag of the stored form, which is what the owner stored.
+            self.send_whole_response(200, f"Value stored for {key}",
+                                     headers={"ETag": etag(value)})
+            return
+        if status == 412:
+            msg = f"Precondition failed for {key}"
+        elif status == 413:
+            msg = f"Value for {key} is larger than the cache"
+        else:
+            msg = f"Failed to store value for {key}"
+        self.send_whole_response(status, msg)
+
+    def post_storage(self, key, value):
+        op = self.query().get("op")
+        if op not in MODIFY_OPS:
+            self.send_whole_response(400, f"Unknown op: {op}")
+            return
+        if op == "incr":
+            try:
+                int(value or 1)
+            except ValueError:
+                self.send_whole_response(400, f"Invalid increment: {value[:40]!r}")
                 return
-
-            self.send_whole_response(
-                200, (self.server.successor[1], self.server.predecessor[1]))
-
+        status, value = self.server.modify_value(key, op, value)
+        if status == 200:
+            self.send_value(value)
+            return
+        if status == 409:
+            msg = f"Can't {op} the value of {key}"
+        elif status == 413:
+            msg = f"Value for {key} is larger than the cache"
         else:
-            self.send_whole_response(404, "Unknown path: " + self.path)
-
-    def do_POST(self):
-        if self.path == "/sim-recover":
-            self.server.sim_recover()
-            self.send_whole_response(200, "Recovering from crash...")
+            msg = f"Failed to {op} the value of {key}"
+        self.send_whole_response(status, msg)
 
-        elif self.path == "/sim-crash":
-            self.server.sim_crash()
-            self.send_whole_response(200, "Simulating crash...")
-
-        elif self.server.sim_crashed is True:
-            self.send_whole_response(500, "I have sim-crashed")
+    def get_storage(self, key, value):
+        status, value = self.server.get_value(key)
+        if status != 200:
+            self.send_whole_response(status, value)
+            return
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match and not preconditions_hold({"If-None-Match": if_none_match}, value):
+            self.send_whole_response(304, b"", headers={"ETag": etag(value)})
+            return
+        self.send_value(value)
+
+    def send_value(self, stored):
+        headers = {"ETag": etag(stored)}
+        try:
+            value, encoding = to_body(stored, self.headers.get("Accept-Encoding"))
+        except ValueError as e:
+            self.send_whole_response(406, str(e))
+            return
+        if encoding:
+            headers["Content-Encoding"] = encoding
+        self.send_whole_response(200, value, headers=headers)
+
+    def delete_storage(self, key, value):
+        status = self.server.delete_value(key)
+        if status == 200:
+            msg = f"Deleted {key}"
+        elif status == 404:
+            msg = f"No value for {key}"
+        else:
+            msg = f"Failed to delete {key}"
+        self.send_whole_response(status, msg)
 
-        elif self.path == "/leave":
-            self.server.leave()
-            self.send_whole_response(200, "Leaving network...")
+    def put_faults(self, value):
+        try:
+            self.server.configure_faults(json.loads(value or b"{}"))
+        except ValueError as e:
+            self.send_whole_response(400, str(e))
+            return
+        self.send_whole_response(200, self.server.faults.rules())
 
-        elif self.path.startswith("/join"):
-            nprime = re.sub(r'^/join\?nprime=([\w:-]+)$', r'\1', self.path)
-            status, neighbors = self.server.join_ring(nprime)
-            self.send_whole_response(status, neighbors)
+    def get_faults(self, value):
+        self.send_whole_response(200, self.server.faults.rules())
 
+    def put_update(self, value):
+        neighbors = json.loads(value.decode())
+        status, items = self.server.update_neighbors(neighbors)
+        self.send_whole_response(status, encode_items(items))
+
+    def put_join(self, value):
+        status, neighbors = self.server.find_neighbors(value)
+        self.send_whole_response(status, neighbors)
+
+    def put_handoff(self, value):
+        replace = self.query().get("replace") == "1"
+        self.server.accept_handoff(decode_items(json.loads(value)), replace)
+        self.send_whole_response(200, "")
+
+    def put_bulk(self, value):
+        replace = self.query().get("replace", "1") != "0"
+        misrouted = self.server.import_items(decode_items(json.loads(value)), replace)
+        self.send_whole_response(200, {"misrouted": misrouted})
+
+    def put_merkle_fetch(self, value):
+        items = self.server.fetch_entries(json.loads(value))
+        self.send_whole_response(200, encode_items(items))
+
+    def put_stabilize(self, value):
+        info = json.loads(value.decode())
+        node = self.server.stabilize(info)
+        self.send_whole_response(200, json.dumps({"key": node[0], "address": node[1]}))
+
+    def get_node_info(self, value):
+        response = {
+            "node_key": self.server.key,
+            "successor": self.server.successor[1],
+            "others": [self.server.predecessor[1]],
+            "sim_crash": self.server.sim_crashed,
+            "requests": self.server.request_stats(),
+            "store": self.server.store_stats(),
+            "load": self.server.load.snapshot(),
+        }
+        self.send_whole_response(200, response, content_type="application/json")
+
+    def get_key(self, value):
+        self.send_whole_response(200, self.server.key)
+
+    def get_admin_range(self, value):
+        query = self.query()
+        limit = int(query["limit"]) if "limit" in query else None
+        items = self.server.object_store.items_in_range(
+            query.get("start", ""), query.get("end", ""), limit)
+        self.send_whole_response(200, encode_items(items))
+
+    def get_scan(self, value):
+        query = self.query()
+        try:
+            limit = int(query.get("limit", SCAN_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= SCAN_MAX_LIMIT:
+            self.send_whole_response(400, f"Invalid limit: {query.get('limit')}")
+            return
+        status, page = self.server.scan(query.get("cursor"), limit)
+        if status != 200:
+            self.send_whole_response(status, "Scan failed")
+            return
+        # Pages go between nodes with the values in their stored form, and
+        # the client gets them decoded, as a GET without Accept-Encoding
+        # would.
+        try:
+            items = [(key, decode(value), expires_at, name)
+                     for key, value, expires_at, name in decode_items(page["items"])]
+        except ValueError as e:
+            self.send_whole_response(406, str(e))
+            return
+        self.send_whole_response(200, dict(page, items=encode_items(items)))
+
+    def get_scan_page(self, value):
+        query = self.query()
+        status, page = self.server.scan_page(query.get("start", ""), int(query["limit"]))
+        self.send_whole_response(status, page)
+
+    def get_merkle(self, value):
+        prefix = self.query().get("prefix", "")
+        self.send_whole_response(200, self.server.merkle_node(prefix))
+
+    def get_neighbors(self, value):
+        if self.server.successor[1] == self.server.address:
+            self.send_whole_response(
+                200, [])
+            return
+
+        self.send_whole_response(
+            200, (self.server.successor[1], self.server.predecessor[1]))
+
+    def post_sim_recover(self, value):
+        self.server.sim_recover()
+        self.send_whole_response(200, "Recovering from crash...")
+
+    def post_sim_crash(self, value):
+        self.server.sim_crash()
+        self.send_whole_response(200, "Simulating crash...")
+
+    def post_anti_entropy(self, value):
+        query = self.query()
+        repaired = self.server.anti_entropy(
+            query["peer"], query.get("start"), query.get("end"))
+        self.send_whole_response(200, {"repaired": repaired})
+
+    def post_admin_move(self, value):
+        query = self.query()
+        try:
+            key = format(int(query["key"], 16) % RING_SIZE, "040x")
+            rate = float(query.get("rate", MOVE_RATE))
+        except (KeyError, ValueError):
+            self.send_whole_response(400, "Expected ?key=<hex>[&rate=<keys/s>]")
+            return
+        status, result = self.server.move(key, rate)
+        self.send_whole_response(status, result)
+
+    def post_profile_start(self, value):
+        query = self.query()
+        try:
+            interval = float(query.get("interval", SAMPLE_INTERVAL))
+        except ValueError:
+            self.send_whole_response(400, f"Invalid interval: {query['interval']}")
+            return
+        if not self.server.start_profile(interval, query.get("idle") == "1"):
+            self.send_whole_response(409, "Already profiling")
+            return
+        self.send_whole_response(200, f"Sampling every {interval} s")
+
+    def get_profile(self, value):
+        self.send_profile(self.server.sampler)
+
+    def post_profile_stop(self, value):
+        self.send_profile(self.server.stop_profile())
+
+    def send_profile(self, sampler):
+        query = self.query()
+        output = query.get("format", "json")
+        if sampler is None:
+            self.send_whole_response(409, "Not profiling")
+        elif output == "json":
+            self.send_whole_response(200, sampler.top(int(query.get("top", 30))))
+        elif output == "collapsed":
+            self.send_whole_response(200, sampler.collapsed())
+        elif output == "pstats":
+            self.send_whole_response(200, sampler.pstats(), "application/octet-stream")
         else:
-            self.send_whole_response(404, "Unknown path: " + self.path)
+            self.send_whole_response(400, f"Unknown format: {output}")
+
+    def post_tracemalloc_start(self, value):
+        frames = int(self.query().get("frames", TRACE_FRAMES))
+        if not start_tracing(frames):
+            self.send_whole_response(409, "Already tracing")
+            return
+        self.send_whole_response(200, f"Tracing allocations, {frames} frames deep")
+
+    def get_tracemalloc(self, value):
+        query = self.query()
+        try:
+            top = allocations(int(query.get("top", 20)), query.get("group", "lineno"))
+        except RuntimeError:
+            self.send_whole_response(409, "Not tracing")
+            return
+        except ValueError as e:
+            self.send_whole_response(400, str(e))
+            return
+        self.send_whole_response(200, top)
+
+    def post_tracemalloc_stop(self, value):
+        stop_tracing()
+        self.send_whole_response(200, "Stopped tracing allocations")
+
+    def post_leave(self, value):
+        self.server.leave()
+        self.send_whole_response(200, "Leaving network...")
+
+    def post_join(self, value):
+        status, neighbors = self.server.join_ring(self.query().get("nprime", ""))
+        self.send_whole_response(status, neighbors)
+
+    routes = {
+        ("GET", "/node-info"): get_node_info,
+        ("GET", "/admin/faults"): get_faults,
+        ("GET", "/key"): get_key,
+        ("GET", "/admin/range"): get_admin_range,
+        ("GET", "/merkle"): get_merkle,
+        ("GET", "/scan"): get_scan,
+        ("GET", "/scan/page"): get_scan_page,
+        ("GET", "/admin/profile"): get_profile,
+        ("GET", "/admin/tracemalloc"): get_tracemalloc,
+        ("GET", "/neighbors"): get_neighbors,
+        ("PUT", "/admin/faults"): put_faults,
+        ("PUT", "/update"): put_update,
+        ("PUT", "/join"): put_join,
+        ("PUT", "/handoff"): put_handoff,
+        ("PUT", "/bulk"): put_bulk,
+        ("PUT", "/merkle/fetch"): put_merkle_fetch,
+        ("PUT", "/stabilize"): put_stabilize,
+        ("POST", "/sim-recover"): post_sim_recover,
+        ("POST", "/sim-crash"): post_sim_crash,
+        ("POST", "/anti-entropy"): post_anti_entropy,
+        ("POST", "/leave"): post_leave,
+        ("POST", "/admin/move"): post_admin_move,
+        ("POST", "/admin/profile/start"): post_profile_start,
+        ("POST", "/admin/profile/stop"): post_profile_stop,
+        ("POST", "/admin/tracemalloc/start"): post_tracemalloc_start,
+        ("POST", "/admin/tracemalloc/stop"): post_tracemalloc_stop,
+        ("POST", "/join"): post_join,
+    }
+    keyed_routes = {
+        ("GET", "/storage"): get_storage,
+        ("PUT", "/storage"): put_storage,
+        ("POST", "/storage"): post_storage,
+        ("DELETE", "/storage"): delete_storage,
+    }
+    available_when_crashed = {
+        get_node_info, get_faults, put_faults, post_sim_recover, post_sim_crash,
+    }
 
 
 class ThreadingHttpServer(socketserver.ThreadingMixIn, HTTPServer):
-    def __init__(self, *args, entry_node=None):
+    # The default backlog of 5 drops connections when many nodes talk to
+    # us at once, and a dropped SYN costs a second.
+    request_queue_size = 128
+
+    def __init__(self, *args, entry_node=None, rpc=False, request_timeout=REQUEST_TIMEOUT,
+                 hedge=False, cache_size=None, eviction="lru", compress=None,
+                 compress_min_size=MIN_SIZE, keep_keys=False):
         super().__init__(*args)
-        self.address = f"{self.server_name}:{self.server_port}"
+        self.setup_node(f"{self.server_name}:{self.server_port}", rpc, request_timeout, hedge,
+                        cache_size, eviction, compress, compress_min_size, keep_keys)
+        if entry_node:
+            self.join_ring(entry_node)
+
+    def setup_node(self, address, rpc=False, request_timeout=REQUEST_TIMEOUT, hedge=False,
+                   cache_size=None, eviction="lru", compress=None, compress_min_size=MIN_SIZE,
+                   keep_keys=False):
+        # Everything but the socket, so the ring logic can also run without
+        # one, as in the ring simulator.
+        self.address = address
         self.key = self.hash_value(self.address.encode())
-        self.object_store = {}
+        # With a cache_size the node is a cache: it evicts keys rather than
+        # grow past cache_size bytes. With keep_keys it remembers the keys
+        # behind the hashes, for listing them.
+        self.object_store = ObjectStore(cache_size, eviction, keep_keys)
+        # Values are kept in their stored form (see compress.py); values
+        # that clients store through this node get compressed with this codec.
+        self.compress = compress
+        self.compress_min_size = compress_min_size
         self.successor = (self.key, self.address)
         self.predecessor = (self.key, self.address)
         self.sim_crashed = False
-        if entry_node:
-            self.join_ring(entry_node)
+        # After leaving the ring, the node its keys went to. Storage
+        # requests that still reach this node are forwarded there, rather
+        # than served from a one-node ring nobody else can see.
+        self.left = None
+        # Guards successor/predecessor: storage requests hold it for reading
+        # while they decide whether the key is ours and act on it locally, and
+        # pointer changes, with the key handoffs that go with them, hold it
+        # for writing. It is never held across a request to another node of
+        # the ring. With --workers, though, a handoff takes the range from
+        # every worker's shard, and so makes requests to the other worker
+        # processes of this node (see ShardedStore.gather) while holding it;
+        # those only touch the shards, never the ring lock, so they can't
+        # wait for it. `splicing` marks that this node is in the middle of
+        # changing one of its neighbors, so concurrent neighbor updates are
+        # rejected with 409 and retried by whoever sent them.
+        self.ring_lock = RWLock()
+        self.splicing = False
+        # Cleared while this node joins. Until then it doesn't know its
+        # range and would take every key for its own, so storage requests
+        # that reach it early wait for the join to finish.
+        self.joined = threading.Event()
+        self.joined.set()
+        # With rpc enabled, node-to-node requests that have a binary
+        # equivalent go over persistent connections to the peers' RPC ports.
+        self.rpc = rpc
+        self.rpc_clients = {}
+        self.rpc_clients_lock = threading.Lock()
+        # Injected latency, drops and partitions on links to other nodes.
+        self.faults = Faults()
+        # Requests from clients get request_timeout seconds; requests from
+        # other nodes whatever was left of theirs.
+        self.request_timeout = request_timeout
+        self.retry_budget = RetryBudget()
+        self.hedge = hedge
+        self.read_latency = LatencyTracker()
+        self.hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS) if hedge else None
+        self.stats = {"timeouts": 0, "unreachable": 0, "retries": 0, "retries_denied": 0,
+                      "hedges": 0, "coalesced": 0}
+        self.stats_lock = threading.Lock()
+        # Forwarded GETs in flight, by hash, for others of the same key to
+        # wait for.
+        self.get_flights = SingleFlight()
+        self.load = LoadTracker()
+        # The profiling session, if one is running (see profiling.py).
+        self.sampler = None
+        self.profile_lock = threading.Lock()
+        # The next page of each scan going through this node, fetched while
+        # the client works through the current one, by cursor and limit.
+        self.scan_prefetch = OrderedDict()
+        self.scan_prefetch_lock = threading.Lock()
+        self.scan_pool = ThreadPoolExecutor(max_workers=4)
 
     def stabilize(self, info):
         # Direction
         # 0: successor
         # 1: predecessor
+        # If we get our own request back, it went all the way around the
+        # ring without finding a crashed node, so keep the neighbor we have.
+        # The hop limit catches the same when churn has left the pointers in
+        # a cycle that we are not part of.
+        hops = info.get("hops", 0)
+        if hops and info["node"][1] == self.address or hops >= STABILIZE_MAX_HOPS:
+            return self.successor if info["direction"] == 1 else self.predecessor
+        info = dict(info, hops=hops + 1)
         if info["direction"] == 0:
             resp, headers = self.request("PUT", self.successor[1], "/stabilize", json.dumps(info))
             # Timeout
             if resp.status == 500:
-                self.successor = info["node"]
+                with self.ring_lock.write():
+                    self.successor = tuple(info["node"])
                 return (self.key, self.address)
         else:
             resp, headers = self.request("PUT", self.predecessor[1], "/stabilize", json.dumps(info))
             # Timeout
             if resp.status == 500:
-                self.predecessor = info["node"]
+                with self.ring_lock.write():
+                    self.predecessor = tuple(info["node"])
                 return (self.key, self.address)
         info = json.loads(resp.read())
         return (info["key"], info["address"])
 
-    def store_value(self, key, value):
-        if self.sim_crashed:
-            return 500, ""
-        hashed_key = self.hash_value(key.encode())
-        status = 200
+    def next_hop(self, hashed_key):
+        # Returns None if this node is responsible for the key, or the
+        # address of the neighbor to reroute the request to.
+        successor, predecessor = self.successor, self.predecessor
 
-        # If the network consists of a single node, store the value.
-        if self.successor[1] == self.address:
-            self.object_store[hashed_key] = value
+        if self.left is not None:
+            return self.left
+
+        # If the network consists of a single node, it owns every key.
+        if successor[1] == self.address:
+            return None
 
-        elif hashed_key < self.key:
+        if hashed_key < self.key:
             # If the key of the data is less than this nodes key and
-            # greater or equal to the predecessors key, store the value.
-            if (hashed_key >= self.predecessor[0]) or (self.predecessor[0] > self.key):
-                self.object_store[hashed_key] = value
+            # greater or equal to the predecessors key, it is ours.
+            if (hashed_key >= predecessor[0]) or (predecessor[0] > self.key):
+                return None
             # Else, reroute the request to the predecessor.
-            else:
-                resp, headers = self.try_request(
-                    "PUT", self.predecessor[1], f"/storage/{key}", value)
-                status = resp.status
-        
-        else:
-            # If we are located on the node with the smallest key and the
-            # key to store is greater than the node with the biggest key,
-            # store it on this node.
-            if self.predecessor[0] > self.key and self.predecessor[0] < hashed_key:
-                self.object_store[hashed_key] = value
-            # Else, reroute the request to the successor
-            else:
-                resp, headers = self.try_request(
-                    "PUT", self.successor[1], f"/storage/{key}", value)
-                status = resp.status
-        return status
+            return predecessor[1]
+
+        # If we are located on the node with the smallest key and the
+        # key is greater than the node with the biggest key, it is ours.
+        if predecessor[0] > self.key and predecessor[0] <= hashed_key:
+            return None
+        # Else, reroute the request to the successor
+        return successor[1]
+
+    def store_value(self, key, value, hashed_key=None, ttl=None, condition=None):
+        # ttl is in seconds; the key never expires without one. A write with
+        # a condition (see conditional.py) is checked against the current
+        # value on the owner, and fails with 412 if it doesn't hold.
+        if self.sim_crashed:
+            return 500
+        self.wait_for_join()
+        hashed_key = hashed_key or self.hash_value(key.encode())
+
+        # Holding the ring lock from the ownership check to the write means
+        # a handoff of the key's range either takes the key along or happens
+        # before the check, and then the key is forwarded to its new owner.
+        with self.ring_lock.read():
+            next_hop = self.next_hop(hashed_key)
+            if next_hop is None:
+                expires_at = time.time() + ttl if ttl is not None else None
+                if condition is None:
+                    stored = self.object_store.put(hashed_key, value, expires_at, key)
+                else:
+                    value, stored = self.object_store.update(
+                        hashed_key,
+                        lambda current: value if preconditions_hold(condition, current) else None,
+                        expires_at, key)
+                    if value is None:
+                        return 412
+                self.load.add(hashed_key, len(value))
+                return 200 if stored else 413
 
-    def get_value(self, key):
+        resp, headers = self.try_request(
+            "PUT", next_hop, self.storage_path(key, ttl=ttl, condition=condition), value,
+            hashed_key=hashed_key)
+        # A GET of the key still on its way may have read it before this
+        # write; GETs after it shouldn't wait for that one.
+        self.get_flights.forget(hashed_key)
+        return self.forwarded_status(resp.status)
+
+    def modify_value(self, key, op, operand, hashed_key=None):
+        # An incr or append (see conditional.py), done on the owner as one
+        # atomic step. Returns the status and the new value, in its stored
+        # form; 409 if the current value doesn't allow the op.
         if self.sim_crashed:
-            return 500, ""
+            return 500, None
+        self.wait_for_join()
+        hashed_key = hashed_key or self.hash_value(key.encode())
+
+        with self.ring_lock.read():
+            next_hop = self.next_hop(hashed_key)
+            if next_hop is None:
+                value, stored = self.object_store.update(
+                    hashed_key, lambda current: modify(op, current, operand),
+                    name=key, keep_expiry=True)
+                if value is None:
+                    return 409, None
+                self.load.add(hashed_key, len(operand) + len(value))
+                return (200, value) if stored else (413, None)
 
-        hashed_key = self.hash_value(key.encode())
-        status = 404
-        value = None
-        # If the network consists of a single node, store the value.
-        if self.successor[1] == self.address:
-            if hashed_key in self.object_store:
-                status = 200
-                value = self.object_store[hashed_key]
+        resp, headers = self.try_request(
+            "POST", next_hop, self.storage_path(key, op=op), operand, hashed_key=hashed_key)
+        self.get_flights.forget(hashed_key)
+        if resp.status == 200:
+            return 200, resp.read()
+        return self.forwarded_status(resp.status), None
+
+    def storage_path(self, key, ttl=None, condition=None, op=None):
+        # The path to pass a storage request on with. Whatever the request
+        # came with besides the key and the value goes in the query string.
+        params = {}
+        if ttl is not None:
+            params["ttl"] = ttl
+        for name, value in (condition or {}).items():
+            params[name.lower()] = value
+        if op is not None:
+            params["op"] = op
+        path = f"/storage/{quote(key, safe='')}"
+        return f"{path}?{urlencode(params)}" if params else path
+
+    def delete_value(self, key, hashed_key=None):
+        if self.sim_crashed:
+            return 500
+        self.wait_for_join()
+        hashed_key = hashed_key or self.hash_value(key.encode())
 
-        elif hashed_key < self.key:
-            # If the key of the data is less than this nodes key and
-            # greater or equal to the predecessors key, retrieve the value.
-            if (hashed_key >= self.predecessor[0]) or (self.predecessor[0] > self.key):
-                if hashed_key in self.object_store:
-                    status = 200
-                    value = self.object_store[hashed_key]
-            # Else, reroute the request to the predecessor.
-            else:
-                resp, headers = self.try_request(
-                    "GET", self.predecessor[1], f"/storage/{key}")
-                status = resp.status
-                if status == 200:
-                    value = resp.read()
-        else:
-            # If we are located on the node with the smallest key and the
-            # key to store is greater than the node with the biggest key,
-            # retrieve it from this node.
-            if self.predecessor[0] > self.key and self.predecessor[0] < hashed_key:
-                if hashed_key in self.object_store:
-                    status = 200
-                    value = self.object_store[hashed_key]
-            # Else, reroute the request to the successor
-            else:
-                resp, headers = self.try_request(
-                    "GET", self.successor[1], f"/storage/{key}")
-                status = resp.status
-                if status == 200:
-                    value = resp.read()
-        return status, value
+        with self.ring_lock.read():
+            next_hop = self.next_hop(hashed_key)
+            if next_hop is None:
+                self.load.add(hashed_key, 0)
+                return 200 if self.object_store.discard(hashed_key) else 404
+
+        resp, headers = self.try_request(
+            "DELETE", next_hop, f"/storage/{quote(key, safe='')}", hashed_key=hashed_key)
+        self.get_flights.forget(hashed_key)
+        return self.forwarded_status(resp.status)
+
+    def get_value(self, key, hashed_key=None):
+        if self.sim_crashed:
+            return 500, ""
+        self.wait_for_join()
+        hashed_key = hashed_key or self.hash_value(key.encode())
+
+        with self.ring_lock.read():
+            next_hop = self.next_hop(hashed_key)
+            if next_hop is None:
+                value = self.object_store.get(hashed_key)
+                self.load.add(hashed_key, len(value) if value is not None else 0)
+                if value is not None:
+                    return 200, value
+                return 404, None
+
+        status, value = self.coalesced_get(next_hop, key, hashed_key)
+        if status == 200:
+            return 200, value
+        return self.forwarded_status(status), None
+
+    def scan(self, cursor, limit):
+        # A page of the keys of the whole ring, in hash order: {"items":
+        # [[hash, base64 value, expiry, key], ...], "cursor": where the next
+        # page starts, or None after the last}. A cursor is the hash to go on
+        # from and the node that owned it, which a page is asked for first.
+        with self.scan_prefetch_lock:
+            prefetched = self.scan_prefetch.pop((cursor, limit), None)
+        status = None
+        if prefetched and prefetched[0] > time.monotonic() - SCAN_PREFETCH_TTL:
+            status, page = prefetched[1].result()
+        if status != 200:
+            status, page = self.collect_scan(cursor, limit)
+        if status == 200 and page["cursor"] is not None:
+            self.prefetch_scan(page["cursor"], limit)
+        return status, page
+
+    def prefetch_scan(self, cursor, limit):
+        def fetch():
+            set_deadline(self.request_timeout)
+            return self.collect_scan(cursor, limit)
+
+        with self.scan_prefetch_lock:
+            self.scan_prefetch[(cursor, limit)] = (time.monotonic(), self.scan_pool.submit(fetch))
+            while len(self.scan_prefetch) > SCAN_PREFETCH_SLOTS:
+                self.scan_prefetch.popitem(last=False)
+
+    def collect_scan(self, cursor, limit):
+        # Pages from one owner after the other, until there are limit items.
+        start, _, node = (cursor or "").partition("@")
+        items = []
+        while True:
+            status, page = self.fetch_scan_page(node or self.address, start, limit - len(items))
+            if status != 200:
+                return status, None
+            items.extend(page["items"])
+            start, node = page["next"], page["node"]
+            if start is None or len(items) >= limit:
+                break
+        return 200, {"items": items, "cursor": f"{start}@{node}" if start is not None else None}
+
+    def fetch_scan_page(self, node, start, limit):
+        # From the node the cursor names, and if that fails, say because it
+        # left the ring, routed to whoever owns start now.
+        if node != self.address:
+            resp, headers = self.request("GET", node, f"/scan/page?start={start}&limit={limit}")
+            if resp.status == 200:
+                return 200, json.loads(resp.read())
+        return self.scan_page(start, limit)
+
+    def scan_page(self, start, limit):
+        # Up to limit items of the keys this node owns from hash start to
+        # the end of its range, with where the scan goes on from: right
+        # after the last item, or on the successor. Routed to the owner of
+        # start like a storage request.
+        if self.sim_crashed:
+            return 500, None
+        self.wait_for_join()
+        with self.ring_lock.read():
+            next_hop = self.next_hop(start)
+            if next_hop is None:
+                # The node at the bottom of the ring owns both its ends, and
+                # the top one comes last.
+                end = self.key if start < self.key else ""
+                items = self.object_store.items_in_range(start, end, limit + 1)
+                successor = self.successor[1]
+        if next_hop is not None:
+            resp, headers = self.try_request(
+                "GET", next_hop, f"/scan/page?start={start}&limit={limit}")
+            if resp.status != 200:
+                return self.forwarded_status(resp.status), None
+            return 200, json.loads(resp.read())
+        if len(items) > limit:
+            items = items[:limit]
+            return 200, {"items": encode_items(items), "next": items[-1][0] + "g",
+                         "node": self.address}
+        return 200, {"items": encode_items(items), "next": end or None, "node": successor}
+
+    def wait_for_join(self):
+        if not self.joined.is_set():
+            self.joined.wait(remaining(self.request_timeout))
+
+    def coalesced_get(self, next_hop, key, hashed_key):
+        # GETs of one key that reach this node while one is already being
+        # forwarded wait for its answer instead of being forwarded too (see
+        # singleflight.py). The owner looks keys up in its store, which is
+        # no slower than waiting would be, so only forwarded GETs are
+        # coalesced. A GET that got a 504 from a fetch whose deadline was
+        # shorter than its own tries again on its own.
+        fetch = self.hedged_get if self.hedge else self.forward_get
+        result, shared = self.get_flights.do(
+            hashed_key, lambda: fetch(next_hop, key, hashed_key),
+            remaining(self.request_timeout))
+        if not shared:
+            return result
+        self.count("coalesced")
+        if result is None:
+            return 504, None
+        if result[0] == 504 and remaining(self.request_timeout) > 0:
+            return fetch(next_hop, key, hashed_key)
+        return result
+
+    def forward_get(self, next_hop, key, hashed_key):
+        resp, headers = self.try_request(
+            "GET", next_hop, f"/storage/{quote(key, safe='')}", hashed_key=hashed_key)
+        return resp.status, resp.read()
+
+    def hedged_get(self, next_hop, key, hashed_key):
+        # If the GET hasn't come back after the p95 of recent forwarded
+        # GETs, send it again and take whichever answer comes first. There
+        # are no replicas or other routes to the owner in this ring, so the
+        # hedge takes the same route; it gets past a lost message or a stuck
+        # hop rather than a slow owner.
+        deadline = get_deadline()
+
+        def attempt():
+            restore_deadline(deadline)
+            start = time.monotonic()
+            status, value = self.forward_get(next_hop, key, hashed_key)
+            if status == 200:
+                self.read_latency.add(time.monotonic() - start)
+            return status, value
+
+        attempts = [self.hedge_pool.submit(attempt)]
+        done, pending = wait(attempts, timeout=self.read_latency.p95)
+        if not done and self.retry_budget.withdraw():
+            self.count("hedges")
+            attempts.append(self.hedge_pool.submit(attempt))
+        for i, future in enumerate(as_completed(attempts)):
+            status, value = future.result()
+            if status == 200 or i == len(attempts) - 1:
+                return status, value
+
+    def count(self, stat):
+        with self.stats_lock:
+            self.stats[stat] += 1
+
+    def start_profile(self, interval, idle=False):
+        with self.profile_lock:
+            if self.sampler is not None:
+                return False
+            self.sampler = Sampler(interval, idle)
+            return True
+
+    def stop_profile(self):
+        with self.profile_lock:
+            sampler, self.sampler = self.sampler, None
+        if sampler is not None:
+            sampler.stop()
+        return sampler
+
+    def request_stats(self):
+        with self.stats_lock:
+            return dict(self.stats)
+
+    def store_stats(self):
+        store = self.object_store
+        totals = store.totals()
+        stats = {name: totals[name] for name in ("keys", "keys_with_ttl", "expired", "bytes")}
+        lookups = totals["hits"] + totals["misses"]
+        if store.capacity:
+            stats["cache"] = {
+                "capacity": store.capacity,
+                "eviction": store.eviction,
+                "evictions": totals["evictions"],
+                "hits": totals["hits"],
+                "misses": totals["misses"],
+                "hit_ratio": totals["hits"] / lookups if lookups else 0,
+            }
+        return stats
+
+    def forwarded_status(self, status):
+        # A 500 that is still there after try_request has stabilized means
+        # the request failed further along. Pass it on as 502, so the nodes
+        # before us don't take it for their own neighbor having crashed and
+        # stabilize and retry too.
+        return 502 if status == 500 else status
 
     def update_neighbors(self, neighbors):
-        if successor := neighbors.get("successor"):
-            self.successor = successor
-        if predecessor := neighbors.get("predecessor"):
-            self.predecessor = predecessor
+        # Neighbor updates are compare-and-set: when the sender includes
+        # "expect", the update only applies if our pointer still has the
+        # expected value, so a stale view of the ring can't overwrite a
+        # newer one.
+        expect = neighbors.get("expect", {})
+        items = []
+        with self.ring_lock.write():
+            if self.splicing:
+                return 409, items
+            for side in ("successor", "predecessor"):
+                if side in expect and tuple(expect[side]) != getattr(self, side):
+                    return 409, items
+            if successor := neighbors.get("successor"):
+                self.successor = tuple(successor)
+            if predecessor := neighbors.get("predecessor"):
+                # A node joining right before us takes over the keys between
+                # our old predecessor and itself. Hand them over in the same
+                # step, so no other join can move the range in between.
+                if neighbors.get("handoff"):
+                    items = self.object_store.pop_range(
+                        self.predecessor[0], predecessor[0])
+                self.predecessor = tuple(predecessor)
+        return 200, items
+
+    def begin_splice(self):
+        with self.ring_lock.write():
+            if self.splicing:
+                return False
+            self.splicing = True
+            return True
+
+    def end_splice(self):
+        with self.ring_lock.write():
+            self.splicing = False
+
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, JOIN_BACKOFF * 2 ** min(attempt, 4)))
+
+    def compare_and_set_neighbor(self, client, side, new, expected, handoff=False):
+        resp, headers = self.try_request(
+            "PUT", client, "/update",
+            json.dumps({side: new, "expect": {side: expected}, "handoff": handoff}))
+        items = resp.read()
+        if resp.status != 200:
+            return False, []
+        return True, json.loads(items)
 
-    def request(self, method, client, path, value=None, get_response=True):
+    def request(self, method, client, path, value=None, get_response=True,
+                hashed_key=None):
         if type(value) == int:
             value = bytes(value)
-        conn = http.client.HTTPConnection(client)
-        conn.request(method, path, value)
-        if get_response:
-            resp = conn.getresponse()
-            headers = resp.getheaders()
+        if self.faults.links:
+            resp = self.faults.send(
+                client, len(value or b""),
+                lambda: self.buffered_request(method, client, path, value, hashed_key),
+                lambda: RpcResponse(504, b"Message lost"),
+                remaining(self.request_timeout))
+            if get_response:
+                return resp, resp.getheaders()
+            return
+        return self.send_request(method, client, path, value, get_response, hashed_key)
+
+    def buffered_request(self, method, client, path, value, hashed_key):
+        # Read the whole response up front, so the fault injection knows
+        # its size.
+        resp, headers = self.send_request(method, client, path, value, True, hashed_key)
+        body = resp.read()
+        return RpcResponse(resp.status, body, headers), len(body)
+
+    def send_request(self, method, client, path, value, get_response, hashed_key):
+        # Gives up with 504 once the deadline of the request we are handling
+        # has passed, and passes on what is left of it.
+        timeout = remaining(self.request_timeout)
+        try:
+            if timeout <= 0:
+                raise TimeoutError("Deadline exceeded")
+            if self.rpc and (encoded := encode_request(method, path, value, hashed_key)):
+                resp = self.rpc_client(client).call(*encoded, timeout=timeout)
+                if get_response:
+                    return resp, resp.getheaders()
+                return
+            conn = http.client.HTTPConnection(client, timeout=min(CONNECT_TIMEOUT, timeout))
+            conn.connect()
+            conn.sock.settimeout(timeout)
+            request_headers = {DEADLINE_HEADER: budget_ms(timeout)}
+            storage = path.startswith("/storage/")
+            if storage:
+                value, codec_headers = storage_request(method, value)
+                request_headers.update(codec_headers)
+            conn.request(method, path, value, headers=request_headers)
+            if get_response:
+                resp = conn.getresponse()
+                headers = resp.getheaders()
+                # Read the body while the timeout still applies.
+                body = resp.read()
+                if storage and method in ("GET", "POST") and resp.status == 200:
+                    body = storage_response(body, headers)
+                resp = RpcResponse(resp.status, body, headers)
+                conn.close()
+                return resp, headers
             conn.close()
-            return resp, headers
-        conn.close()
-
-    def try_request(self, method, client, path, value=None, get_response=True):
+        except TimeoutError as e:
+            self.count("timeouts")
+            if get_response:
+                return RpcResponse(504, str(e).encode()), []
+        except OSError as e:
+            # A peer that refuses or drops the connection is down as far as
+            # we can tell, so answer as a crashed node does: 500, which
+            # try_request stabilizes around and retries, out of the retry
+            # budget, and callers pass on as 502.
+            self.count("unreachable")
+            if get_response:
+                return RpcResponse(500, str(e).encode()), []
+
+    def rpc_client(self, client):
+        with self.rpc_clients_lock:
+            if client not in self.rpc_clients:
+                self.rpc_clients[client] = RpcClient(client)
+            return self.rpc_clients[client]
+
+    def try_request(self, method, client, path, value=None, get_response=True,
+                    hashed_key=None):
+        self.retry_budget.deposit()
         if get_response:
-            resp, headers = self.request(method, client, path, value, get_response)
+            resp, headers = self.request(
+                method, client, path, value, get_response, hashed_key)
 
-            if resp.status == 500:
+            if resp.status == 500 and not self.retry_budget.withdraw():
+                self.count("retries_denied")
+
+            # A node that is leaving or has left has no neighbors to repair.
+            elif resp.status == 500 and self.left is None:
+                self.count("retries")
                 if client == self.successor[1]:
-                    node = self.stabilize({"node": (self.key, self.address), "direction": 1})                    
-                    self.successor = node
+                    node = self.stabilize({"node": (self.key, self.address), "direction": 1})
+                    with self.ring_lock.write():
+                        self.successor = tuple(node)
+                    client = self.successor[1]
 
                 else:
                     node = self.stabilize({"node": (self.key, self.address), "direction": 0})
-                    self.predecessor = node
+                    with self.ring_lock.write():
+                        self.predecessor = tuple(node)
+                    client = self.predecessor[1]
 
-                resp, headers = self.request(method, client, path, value, get_response)
+                # Retry with whoever replaced the crashed neighbor.
+                resp, headers = self.request(
+                    method, client, path, value, get_response, hashed_key)
 
             return resp, headers
         else:
-            self.request(method, client, path, value, get_response)
-
-    def join_ring(self, node):
-        resp, headers = self.try_request(
-            "PUT", node, "/join", self.address)
-        if resp.status != 200:
-            print("Failed to join ring")
-            return resp.status, ""
-        else:
-            value = resp.read()
-        neighbors = json.loads(value.decode())
-        self.successor = neighbors["successor"]
-        self.predecessor = neighbors["predecessor"]
-        return resp.status, neighbors
+            self.request(method, client, path, value, get_response, hashed_key)
+
+    def join_ring(self, node, replace=False):
+        # With replace, keys handed over in the join replace the ones we
+        # have, which are stale when we are coming back from a crash.
+        if node == self.address:
+            return 200, {"successor": self.successor, "predecessor": self.predecessor}
+        # Another join or leave may be splicing the same part of the ring.
+        # Back off with jitter and retry, so concurrent joins don't collide
+        # over and over. Until the join is done we may already be reachable
+        # from our new neighbors, so keep rejecting joins routed through us.
+        # The node we join through puts us where our address hashes to,
+        # wherever a move took us before we left or crashed.
+        with self.ring_lock.write():
+            self.splicing = True
+            self.joined.clear()
+            self.key = self.hash_value(self.address.encode())
+        try:
+            for attempt in range(JOIN_RETRIES):
+                resp, headers = self.try_request(
+                    "PUT", node, "/join", self.address)
+                value = resp.read()
+                if resp.status != 409:
+                    break
+                self.backoff(attempt)
+            if resp.status != 200:
+                print("Failed to join ring")
+                return resp.status, ""
+            neighbors = json.loads(value.decode())
+            with self.ring_lock.write():
+                self.successor = tuple(neighbors["successor"])
+                self.predecessor = tuple(neighbors["predecessor"])
+                self.left = None
+            # The successor owned our new range until now, and handed over
+            # the keys in it as part of the join.
+            self.accept_handoff(decode_items(neighbors.pop("items", [])), replace)
+            return resp.status, neighbors
+        finally:
+            self.end_splice()
+            self.joined.set()
+
+    def accept_handoff(self, items, replace=False):
+        # Keys handed over by a neighbor that joins or leaves were ours to
+        # serve from the moment its pointers changed, so a key we already
+        # have is newer than the one handed over. Repairs replace keys.
+        for key, value, expires_at, name in items:
+            self.object_store.put(key, value, expires_at, name, replace)
+
+    def import_items(self, items, replace=True):
+        # Items a bulk loader sent to the node it takes for their owner. The
+        # ones this node owns are stored, under the ring lock, so they can't
+        # end up behind a range that was just handed off; the hashes of the
+        # others are returned, for the loader to send on to their owner.
+        self.wait_for_join()
+        with self.ring_lock.read():
+            owned = [item for item in items if self.next_hop(item[0]) is None]
+            self.accept_handoff(owned, replace)
+        if len(owned) == len(items):
+            return []
+        owned = {item[0] for item in owned}
+        return [item[0] for item in items if item[0] not in owned]
 
     def leave(self):
-        self.try_request(
-            "PUT",
-            self.predecessor[1],
-            "/update",
-            json.dumps({"successor": self.successor}, indent=2),
-            False
-        )
-        self.try_request(
-            "PUT",
-            self.successor[1],
-            "/update",
-            json.dumps({"predecessor": self.predecessor}, indent=2),
-            False
-        )
-        self.successor = (self.key, self.address)
-        self.predecessor = (self.key, self.address)
+        for attempt in range(JOIN_RETRIES):
+            if self.try_leave():
+                break
+            self.backoff(attempt)
+        else:
+            print("Failed to leave ring")
+
+    def try_leave(self):
+        if not self.begin_splice():
+            return False
+        # Storage requests on this node wait until we are out of the ring,
+        # and then go to the successor.
+        self.joined.clear()
+        try:
+            me = (self.key, self.address)
+            successor, predecessor = self.successor, self.predecessor
+            if successor[1] == self.address:
+                return True
+            # Unlink ourselves from the predecessor first. Once that has
+            # happened nothing but us can change the successor's pointer
+            # back to us, so keep retrying that side until it goes through.
+            ok, items = self.compare_and_set_neighbor(
+                predecessor[1], "successor", successor, me)
+            if not ok:
+                return False
+            # If the predecessor had crashed, try_request went around it to
+            # the node before it, which is the successor's predecessor now.
+            predecessor = self.predecessor
+            # Our range is still ours until the successor's pointer moves,
+            # so hand it all our keys before that, or it would answer for
+            # keys it doesn't have yet. Requests for the range that reach
+            # us from here on are sent to the successor, which sends them
+            # back to wait for the leave.
+            with self.ring_lock.write():
+                items = self.object_store.pop_all()
+                self.left = successor[1]
+            for attempt in range(JOIN_RETRIES):
+                if not items:
+                    break
+                resp, headers = self.try_request(
+                    "PUT", successor[1], "/handoff", json.dumps(encode_items(items)))
+                if resp.status == 200:
+                    break
+                self.backoff(attempt)
+            for attempt in range(JOIN_RETRIES):
+                ok, items = self.compare_and_set_neighbor(
+                    successor[1], "predecessor", predecessor, me)
+                if ok:
+                    break
+                self.backoff(attempt)
+            with self.ring_lock.write():
+                self.successor = me
+                self.predecessor = me
+            return True
+        finally:
+            self.end_splice()
+            self.joined.set()
+
+    def move(self, key, rate=MOVE_RATE):
+        # Move this node to another position on the ring, between its
+        # neighbors, taking over part of the successor's range or handing
+        # part of ours to it. The range moves in steps of about MOVE_CHUNK
+        # keys, at most rate keys/s, and only storage requests on this node
+        # wait while a step is under way.
+        if not self.begin_splice():
+            return 409, "Busy, retry move"
+        try:
+            me, successor, predecessor = (self.key, self.address), self.successor, self.predecessor
+            if key == self.key:
+                return 200, {"key": key, "moved": 0}
+            if successor[1] == self.address:
+                with self.ring_lock.write():
+                    self.key = key
+                    self.successor = self.predecessor = (key, self.address)
+                return 200, {"key": key, "moved": 0}
+            if not between(predecessor[0], key, successor[0]):
+                return 400, f"{key} is not between the neighbors' keys"
+            moved = 0
+            for step in self.move_steps(key, successor):
+                set_deadline(self.request_timeout)
+                start = time.monotonic()
+                ok, count = self.move_step(step, successor)
+                if not ok:
+                    return 409, {"key": self.key, "moved": moved}
+                moved += count
+                time.sleep(max(0, count / rate - (time.monotonic() - start)))
+            # Routing only looks at predecessors' keys, but joins go by the
+            # successor pointers too.
+            self.compare_and_set_neighbor(
+                predecessor[1], "successor", (self.key, self.address), me)
+            return 200, {"key": self.key, "moved": moved}
+        finally:
+            self.end_splice()
+
+    def move_steps(self, key, successor):
+        # Keys are spread evenly over the ring, so steps of equal length
+        # each move about as many keys, given how many the node the range
+        # moves from has.
+        old, new = int(self.key, 16), int(key, 16)
+        if between(self.key, key, successor[0]):
+            resp, headers = self.request("GET", successor[1], "/node-info")
+            keys = json.loads(resp.read())["store"]["keys"] if resp.status == 200 else 0
+            distance = (new - old) % RING_SIZE
+            share = distance / ((int(successor[0], 16) - old) % RING_SIZE)
+        else:
+            keys = len(self.object_store)
+            distance = -((old - new) % RING_SIZE)
+            share = -distance / ((old - int(self.predecessor[0], 16)) % RING_SIZE or RING_SIZE)
+        steps = max(1, round(keys * share / MOVE_CHUNK))
+        return [format((old + distance * i // steps) % RING_SIZE, "040x")
+                for i in range(1, steps + 1)]
+
+    def move_step(self, key, successor):
+        # Storage requests on this node wait for the step, as they do for
+        # a join, so none of them sees the range half moved. The successor
+        # forwards requests for the range here in the meantime.
+        me = (self.key, self.address)
+        self.joined.clear()
+        try:
+            if between(self.key, key, successor[0]):
+                # Growing: the successor hands over [our key, key) as it
+                # points its predecessor at our new key, like for a join.
+                ok, items = self.compare_and_set_neighbor(
+                    successor[1], "predecessor", (key, self.address), me, handoff=True)
+                if not ok:
+                    return False, 0
+                with self.ring_lock.write():
+                    self.key = key
+                self.accept_handoff(decode_items(items))
+                return True, len(items)
+            # Shrinking: [key, our key) goes to the successor before it
+            # takes it over, since requests for it can't get to it until then.
+            with self.ring_lock.write():
+                items = self.object_store.pop_range(key, self.key)
+                self.key = key
+            if items:
+                self.try_request("PUT", successor[1], "/handoff", json.dumps(encode_items(items)))
+            ok, _ = self.compare_and_set_neighbor(
+                successor[1], "predecessor", (key, self.address), me)
+            if not ok:
+                with self.ring_lock.write():
+                    self.key = me[0]
+                self.accept_handoff(items)
+                return False, 0
+            return True, len(items)
+        finally:
+            self.joined.set()
 
     def find_neighbors(self, new_node):
         if self.sim_crashed:
             return 500, ""
-        neighbors = {}
-        status = 200
         key = self.hash_value(new_node)
         new_node = new_node.decode()
-
-        # If network consists of a single node
-        if self.successor[1] == self.address:
-            self.successor = (key, new_node)
-            self.predecessor = (key, new_node)
-            neighbors["predecessor"] = (self.key, self.address)
-            neighbors["successor"] = (self.key, self.address)
-            neighbors = json.dumps(neighbors, indent=2)
-            return status, neighbors
-
-        # If the key of the joining node is less than this node...
-        if key < self.key:
-            # ...and the key is greater than the predecessor,
-            # or we are in the wrap-around point of the node ring,
-            # put the joining node at this position.
-            if (key > self.predecessor[0]) or (self.predecessor[0] > self.key):
-                neighbors["successor"] = (self.key, self.address)
-                neighbors["predecessor"] = self.predecessor
-                # send a request to the predecessor to update its successor
-                # to the joining node.
-                self.try_request(
-                    "PUT", self.predecessor[1], "/update", json.dumps({"successor": (key, new_node)}, indent=2), False)
-                self.predecessor = (key, new_node)
-                neighbors = json.dumps(neighbors, indent=2)
-                status = 200
-            # ...but not greater than the predecessor, we reroute the request
-            # to the predecessor.
-            else:
-                resp, headers = self.try_request(
-                    "PUT", self.predecessor[1], "/join", new_node)
-                status = resp.status
-                if resp.status != 200:
-                    print("Failed to find neighbors")
-                else:
-                    value = resp.read()
-                neighbors = value
-        # If the key of the joining node is greater or equal to this node...
-        else:
-            # ...and the key is less than the successor, or we are in the
+        joining = (key, new_node)
+        me = (self.key, self.address)
+        side = None
+        forward = None
+
+        with self.ring_lock.write():
+            # Another node is already being spliced in next to this one.
+            if self.splicing:
+                return 409, "Busy, retry join"
+            successor, predecessor = self.successor, self.predecessor
+
+            # A node that has left is a one-node ring nobody else can see,
+            # so the join goes on to the node its keys went to.
+            if self.left is not None:
+                forward = self.left
+
+            # If network consists of a single node
+            elif successor[1] == self.address:
+                self.successor = joining
+                self.predecessor = joining
+                items = encode_items(self.object_store.pop_range(self.key, key))
+                return 200, json.dumps(
+                    {"predecessor": me, "successor": me, "items": items})
+
+            # If the key of the joining node is less than this node, and the
+            # key is greater than the predecessor, or we are in the
+            # wrap-around point of the node ring, put the joining node
+            # between the predecessor and this node.
+            elif key < self.key:
+                if (key > predecessor[0]) or (predecessor[0] > self.key):
+                    side = "predecessor"
+            # If the key of the joining node is greater or equal to this node,
+            # and the key is less than the successor, or we are in the
             # wrap-around point of the node ring, put the joining node
-            # at this position.
-            if (key < self.successor[0]) or (self.successor[0] < self.key):
-                neighbors["successor"] = self.successor
-                neighbors["predecessor"] = (self.key, self.address)
-                # send a request to the successor to update its predecessor
-                # to the joining node.
-                self.try_request(
-                    "PUT", self.successor[1], "/update", json.dumps({"predecessor": (key, new_node)}, indent=2), False)
-                self.successor = (key, new_node)
-                neighbors = json.dumps(neighbors, indent=2)
-                status = 200
-            # ...but not less than the successor, we reroute the request
-            # to the successor.
+            # between this node and the successor.
+            elif (key < successor[0]) or (successor[0] < self.key):
+                side = "successor"
+
+            if side:
+                self.splicing = True
+
+        # Otherwise, reroute the request towards the right position.
+        if side is None:
+            forward = forward or (predecessor if key < self.key else successor)[1]
+            resp, headers = self.try_request(
+                "PUT", forward, "/join", new_node)
+            if resp.status != 200:
+                print("Failed to find neighbors")
+            return resp.status, resp.read()
+
+        try:
+            # Tell the neighbor on the other side of the joining node about
+            # it, but only if its pointer back to us hasn't changed since we
+            # looked. Our own pointer is only moved once that has succeeded.
+            # The keys the joining node takes over are handed to it in the
+            # join response, by whichever of us owned them until now.
+            if side == "predecessor":
+                neighbors = {"successor": me, "predecessor": predecessor}
+                ok, items = self.compare_and_set_neighbor(
+                    predecessor[1], "successor", joining, me)
+                if not ok:
+                    return 409, "Neighbors changed, retry join"
+                with self.ring_lock.write():
+                    self.predecessor = joining
+                    items = encode_items(
+                        self.object_store.pop_range(predecessor[0], key))
             else:
-                resp, headers = self.try_request(
-                    "PUT", self.successor[1], "/join", new_node)
-                status = resp.status
-                if resp.status != 200:
-                    print("Failed to find neighbors")
-                else:
-                    value = resp.read()
-                neighbors = value
+                neighbors = {"successor": successor, "predecessor": me}
+                ok, items = self.compare_and_set_neighbor(
+                    successor[1], "predecessor", joining, me, handoff=True)
+                if not ok:
+                    return 409, "Neighbors changed, retry join"
+                with self.ring_lock.write():
+                    self.successor = joining
+            neighbors["items"] = items
+        finally:
+            self.end_splice()
+
         # return the found neighbors to the joining node.
-        return status, neighbors
+        return 200, json.dumps(neighbors)
 
     def hash_value(self, value):
         m = sha1()
         m.update(value)
         return m.hexdigest()
 
+    def configure_faults(self, rules):
+        self.faults.configure(rules)
+
     def sim_crash(self):
         self.sim_crashed = True
 
     def sim_recover(self):
         if self.sim_crashed:
             self.sim_crashed = False
-            self.join_ring(self.successor[1])
+            # If nobody noticed the crash we are still linked into the ring,
+            # and joining again would only find ourselves. Otherwise join
+            # through the first neighbor that takes us in; the successor we
+            # remember may have crashed or left since.
+            if not self.still_linked():
+                for node in (self.successor[1], self.predecessor[1]):
+                    if node != self.address and self.join_ring(node, replace=True)[0] == 200:
+                        break
+            # Writes may have gone to the successor while we were down.
+            self.anti_entropy(self.successor[1])
+
+    def still_linked(self):
+        # Whether our successor still has us as its predecessor, or, if it
+        # doesn't answer, our predecessor still has us as its successor.
+        if self.successor[1] == self.address:
+            return True
+        resp, headers = self.request("GET", self.successor[1], "/node-info")
+        body = resp.read()
+        if resp.status == 200:
+            return json.loads(body)["others"] == [self.address]
+        resp, headers = self.request("GET", self.predecessor[1], "/node-info")
+        body = resp.read()
+        return resp.status == 200 and json.loads(body)["successor"] == self.address
+
+    def merkle_node(self, prefix):
+        tree = self.object_store.tree
+        if len(prefix) < DEPTH:
+            return {"digest": format(tree.digest(prefix), "x"),
+                    "children": tree.children(prefix)}
+        keys = self.object_store.keys_in_range(*prefix_range(prefix))
+        return {"digest": format(tree.digest(prefix), "x"),
+                "keys": {key: format(entry_hash(key, self.object_store[key]), "x")
+                         for key in keys}}
+
+    def fetch_entries(self, keys):
+        return [self.object_store.item(key) for key in keys if key in self.object_store]
+
+    def anti_entropy(self, peer, start=None, end=None):
+        # Compare our Merkle tree with the peer's over [start, end), which
+        # defaults to the range we own, and pull the keys that differ. Only
+        # subtrees whose digests differ are fetched, so the cost follows the
+        # size of the difference rather than the amount of data.
+        if peer == self.address:
+            return 0
+        if start is None:
+            start, end = self.predecessor[0], self.key
+        divergent = []
+        self.diff_subtree(peer, "", start, end, divergent)
+        if divergent:
+            resp, headers = self.request(
+                "PUT", peer, "/merkle/fetch", json.dumps(divergent))
+            self.accept_handoff(decode_items(json.loads(resp.read())), replace=True)
+        return len(divergent)
+
+    def diff_subtree(self, peer, prefix, start, end, divergent):
+        resp, headers = self.request("GET", peer, f"/merkle?prefix={prefix}")
+        if resp.status != 200:
+            return
+        theirs = json.loads(resp.read())
+        if len(prefix) == DEPTH:
+            for key, digest in theirs["keys"].items():
+                value = self.object_store.peek(key)
+                if in_range(key, start, end) and (
+                        value is None or entry_hash(key, value) != int(digest, 16)):
+                    divergent.append(key)
+            return
+        ours = self.object_store.tree.children(prefix)
+        for c, mine, other in zip(HEX_DIGITS, ours, theirs["children"]):
+            child = prefix + c
+            # Skip subtrees outside the range, subtrees the peer has nothing
+            # in, and subtrees fully inside the range that already match.
+            if other == "0" or not overlaps(child, start, end):
+                continue
+            if mine == other and covered(child, start, end):
+                continue
+            self.diff_subtree(peer, child, start, end, divergent)
+
+
+def between(start, key, end):
+    # Whether key is strictly between start and end, going up the ring
+    # from start. With start == end that is anywhere but there.
+    if start < end:
+        return start < key < end
+    return key > start or key < end
+
+
+def parse_size(size):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    size = size.upper()
+    if size[-1:] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
 
 
 def arg_parser():
@@ -403,12 +1454,70 @@ def arg_parser():
 
     parser.add_argument("-e", "--entry", type=str, help="Entry node")
 
+    parser.add_argument("--rpc", action="store_true",
+                        help="use the binary protocol for node-to-node traffic, " +
+                        "served on the HTTP port + %d" % RPC_PORT_OFFSET)
+
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of worker processes sharing the port, default 1")
+
+    parser.add_argument("--timeout", type=float, default=REQUEST_TIMEOUT,
+                        help="seconds a client request may take across all hops, " +
+                        "default %d" % REQUEST_TIMEOUT)
+
+    parser.add_argument("--hedge", action="store_true",
+                        help="resend forwarded GETs that take longer than the p95")
+
+    parser.add_argument("--cache-size", type=parse_size,
+                        help="run as a cache that holds at most this many bytes, " +
+                        "with an optional K, M or G suffix")
+
+    parser.add_argument("--eviction", choices=sorted(POLICIES), default="lru",
+                        help="which keys a cache evicts first, default lru")
+
+    parser.add_argument("--compress", choices=AVAILABLE,
+                        help="compress the values clients store through this node")
+
+    parser.add_argument("--compress-min-size", type=int, default=MIN_SIZE,
+                        help="smallest value in bytes worth compressing, default %d" % MIN_SIZE)
+
+    parser.add_argument("--keep-keys", action="store_true",
+                        help="keep the keys along with their hashes, so /admin/range lists them")
+
     return parser
 
 
 def run_server(args):
-    server = ThreadingHttpServer(
-        ('', args.port), NodeHttpHandler, entry_node=args.entry)
+    if args.workers > 1:
+        from workers import run_workers
+        run_workers(args)
+        return
+    server = ThreadingHttpServer(('', args.port), NodeHttpHandler, rpc=args.rpc,
+                                 request_timeout=args.timeout, hedge=args.hedge,
+                                 cache_size=args.cache_size, eviction=args.eviction,
+                                 compress=args.compress,
+                                 compress_min_size=args.compress_min_size,
+                                 keep_keys=args.keep_keys)
+    serve(server, args)
+
+
+def serve(server, args):
+    # Peers may start talking to us over RPC as soon as we have joined, so
+    # the RPC server has to be up before the join.
+    if args.rpc:
+        rpc_server = RpcServer(server, reuse_port=args.workers > 1)
+        threading.Thread(target=rpc_server.serve_forever, daemon=True).start()
+    if args.entry:
+        server.join_ring(args.entry)
+
+    def reclaim_expired():
+        # Reads and writes turn the expiry wheel too, but an idle node
+        # should still let go of its expired keys.
+        while True:
+            time.sleep(1)
+            server.object_store.reclaim(time.time())
+
+    threading.Thread(target=reclaim_expired, daemon=True).start()
 
     def server_main():
         print("Starting server on port {}. Entry: {}".format(
@@ -0,0 +1,169 @@
+import marshal
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# On-demand profiling of a running node, without restarting it under a
+# profiler and losing the load that made it slow.
+#
+# The sampler is a statistical profiler: a thread that looks at the stack
+# of every other thread every interval seconds, through
+# sys._current_frames(), so it sees all handler threads, including ones
+# started after it, at a cost that doesn't depend on how busy they are.
+# cProfile can't do that: it only hooks the thread that enables it. Threads
+# that are waiting for work (in select, a lock or a socket read) are left
+# out unless asked for.
+#
+# The samples can be had as the top functions, as collapsed stacks (one
+# "f;g;h count" line per stack, which speedscope and flamegraph.pl read), or
+# as a pstats file for snakeviz, with sample counts standing in for calls
+# and samples times the interval for time.
+#
+# Allocations are traced with tracemalloc, which covers every thread.
+
+SAMPLE_INTERVAL = 0.005
+TRACE_FRAMES = 1
+
+# Where a thread that waits for work sits, as (file name, function).
+IDLE = {
+    ("selectors.py", "select"),
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("socket.py", "readinto"),
+    ("socket.py", "accept"),
+    ("rpc.py", "recv_exactly"),
+    ("thread.py", "_worker"),
+    ("queue.py", "get"),
+    ("node.py", "reclaim_expired"),
+}
+
+
+class Sampler:
+    def __init__(self, interval=SAMPLE_INTERVAL, idle=False):
+        self.interval = interval
+        self.idle = idle
+        # Taken by the sampler thread to add a round of samples, and by
+        # readers to copy the samples so far.
+        self.stacks = Counter()
+        self.lock = threading.Lock()
+        self.samples = 0
+        self.started = time.monotonic()
+        self.stopped = None
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self.done.wait(self.interval):
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if self.idle or (os.path.basename(stack[0][0]), stack[0][2]) not in IDLE:
+                    stacks.append(tuple(reversed(stack)))
+            with self.lock:
+                self.stacks.update(stacks)
+                self.samples += 1
+
+    def snapshot(self):
+        with self.lock:
+            return Counter(self.stacks)
+
+    def stop(self):
+        self.done.set()
+        self.thread.join()
+        self.stopped = time.monotonic()
+
+    def top(self, limit):
+        # The functions with the most samples of their own, with the share
+        # of all samples each was running in ("self") and was anywhere on
+        # the stack in ("total").
+        stacks = self.snapshot()
+        own = Counter()
+        total = Counter()
+        for stack, count in stacks.items():
+            own[stack[-1]] += count
+            for function in set(stack):
+                total[function] += count
+        samples = sum(stacks.values()) or 1
+        return {
+            "seconds": round((self.stopped or time.monotonic()) - self.started, 3),
+            "interval": self.interval,
+            "samples": sum(stacks.values()),
+            "top": [{"function": function_name(function),
+                     "self": round(100 * count / samples, 2),
+                     "total": round(100 * total[function] / samples, 2)}
+                    for function, count in own.most_common(limit)],
+        }
+
+    def collapsed(self):
+        return "".join(
+            ";".join(function_name(function) for function in stack) + f" {count}\n"
+            for stack, count in self.snapshot().items())
+
+    def pstats(self):
+        # The marshalled dict pstats.Stats loads: per function, (primitive
+        # calls, calls, own time, cumulative time, {caller: the same four}).
+        stats = {}
+        for stack, count in self.snapshot().items():
+            seconds = count * self.interval
+            seen = set()
+            for i, function in enumerate(stack):
+                cc, nc, tt, ct, callers = stats.setdefault(function, (0, 0, 0.0, 0.0, {}))
+                leaf = i == len(stack) - 1
+                if function not in seen:
+                    cc, nc, ct = cc + count, nc + count, ct + seconds
+                    seen.add(function)
+                if leaf:
+                    tt += seconds
+                if i:
+                    ccc, cnc, ctt, cct = callers.get(stack[i - 1], (0, 0, 0.0, 0.0))
+                    callers[stack[i - 1]] = (ccc + count, cnc + count,
+                                             ctt + (seconds if leaf else 0), cct + seconds)
+                stats[function] = (cc, nc, tt, ct, callers)
+        return marshal.dumps(stats)
+
+
+def function_name(function):
+    filename, line, name = function
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+def start_tracing(frames=TRACE_FRAMES):
+    # False if tracing is already on.
+    if tracemalloc.is_tracing():
+        return False
+    tracemalloc.start(frames)
+    return True
+
+
+def stop_tracing():
+    tracemalloc.stop()
+
+
+def allocations(limit, group="lineno"):
+    # The allocation sites holding the most memory right now, grouped by
+    # line or, with group="traceback", by the whole traceback the tracing
+    # was started with.
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    ])
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "traced": current,
+        "peak": peak,
+        "top": [{"site": [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                 "size": stat.size,
+                 "count": stat.count}
+                for stat in snapshot.statistics(group)[:limit]],
+    }
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import time
+
+from load import BUCKETS
+
+# Load-aware rebalancing. Node positions come from hashing their addresses,
+# which spreads keys evenly but not load: a node that owns hot keys stays
+# busy however many keys it has. This reads the load counts of every node
+# twice, over --interval seconds, and adds them up into the rate along the
+# ring, per 1/256th of it (see load.py), taking load within one of those as
+# even. Then it works out new node positions that split that rate evenly,
+# keeping the ring order and the first node where it is, and with --apply
+# moves the nodes there through /admin/move. A node can only move between
+# its neighbors, so the moves run in passes until all are done.
+#
+# Load on a single key can't be split; a node with one hot key ends up
+# with little else.
+
+RING_SIZE = 1 << 160
+BUCKET_SIZE = RING_SIZE // BUCKETS
+# Share of the total rate spread evenly over the ring, so stretches without
+# any load still count for their length.
+FLOOR = 0.01
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="rebalance")
+
+    parser.add_argument("nodes", type=str, nargs="+",
+                        help="addresses (host:port) of one or more nodes of the ring")
+
+    parser.add_argument("-i", "--interval", type=float, default=5,
+                        help="seconds to measure the load over, default 5")
+
+    parser.add_argument("--metric", choices=("ops", "bytes"), default="ops",
+                        help="load to even out: requests or bytes, default ops")
+
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="leave the ring as it is unless the busiest node has this " +
+                        "much more than the average, default 0.2")
+
+    parser.add_argument("--apply", action="store_true",
+                        help="move the nodes, instead of only showing the moves")
+
+    parser.add_argument("--rate", type=float, default=5000,
+                        help="keys per second each move hands over at most, default 5000")
+
+    return parser
+
+
+def request(node, method, path, timeout=10):
+    conn = http.client.HTTPConnection(node, timeout=timeout)
+    try:
+        conn.request(method, path)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except OSError as e:
+        return 504, str(e).encode()
+    finally:
+        conn.close()
+
+
+def ring_info(seeds):
+    # /node-info of every node, in ring order.
+    for seed in seeds:
+        infos = {}
+        address = seed
+        while address not in infos:
+            status, body = request(address, "GET", "/node-info")
+            if status != 200:
+                break
+            infos[address] = json.loads(body)
+            address = infos[address]["successor"]
+        if infos:
+            return sorted(infos.items(), key=lambda item: item[1]["node_key"])
+    raise RuntimeError("None of the nodes answered")
+
+
+def measure(seeds, interval, metric):
+    # (nodes in ring order as (address, key), rate per node, rate per bucket)
+    field = 0 if metric == "ops" else 1
+    while True:
+        before = ring_info(seeds)
+        time.sleep(interval)
+        after = ring_info(seeds)
+        if [a for a, info in before] == [a for a, info in after]:
+            break
+        print("The ring changed while measuring, measuring again")
+    buckets = [0.0] * BUCKETS
+    rates = []
+    for (address, old), (_, new) in zip(before, after):
+        rate = 0
+        for bucket, counts in new["load"].items():
+            diff = counts[field] - old["load"].get(bucket, [0, 0])[field]
+            buckets[int(bucket, 16)] += diff / interval
+            rate += diff / interval
+        rates.append(rate)
+    nodes = [(address, info["node_key"]) for address, info in after]
+    return nodes, rates, buckets
+
+
+class LoadCurve:
+    # The cumulative rate from the bottom of the ring up to a position.
+    def __init__(self, buckets):
+        floor = max(sum(buckets), 1) * FLOOR / BUCKETS
+        self.weights = [rate + floor for rate in buckets]
+        self.cumulative = [0.0]
+        for weight in self.weights:
+            self.cumulative.append(self.cumulative[-1] + weight)
+        self.total = self.cumulative[-1]
+
+    def at(self, position):
+        bucket = position // BUCKET_SIZE
+        return (self.cumulative[bucket]
+                + self.weights[bucket] * (position - bucket * BUCKET_SIZE) / BUCKET_SIZE)
+
+    def position(self, load):
+        load %= self.total
+        bucket = 0
+        while self.cumulative[bucket + 1] <= load:
+            bucket += 1
+        offset = (load - self.cumulative[bucket]) / self.weights[bucket]
+        return bucket * BUCKET_SIZE + int(offset * BUCKET_SIZE)
+
+    def share(self, start, end):
+        # Of the range [start, end), wrapping around the top.
+        load = self.at(end) - self.at(start)
+        return (load if load > 0 else load + self.total) / self.total
+
+
+def plan(nodes, curve):
+    # A node owns the range up to its key, so node i of n gets the i-th
+    # n-th of the load after the first node's key.
+    first = curve.at(int(nodes[0][1], 16))
+    step = curve.total / len(nodes)
+    return [format(curve.position(first + i * step), "040x") for i in range(len(nodes))]
+
+
+def apply(moves, rate):
+    pending = list(moves)
+    while pending:
+        waiting = []
+        for address, key in pending:
+            status, body = request(address, "POST", f"/admin/move?key={key}&rate={rate}",
+                                   timeout=3600)
+            if status == 200:
+                print("Moved %s to %s, %d keys handed over" % (
+                    address, key[:8], json.loads(body)["moved"]))
+            elif status in (400, 409):
+                # Not between its neighbors yet, or busy.
+                waiting.append((address, key))
+            else:
+                print("Moving %s failed: %d %s" % (address, status, body[:80]))
+        if len(waiting) == len(pending):
+            print("No move could go through; %d left" % len(waiting))
+            return False
+        pending = waiting
+    return True
+
+
+def main(args):
+    nodes, rates, buckets = measure(args.nodes, args.interval, args.metric)
+    mean = sum(rates) / len(rates)
+    curve = LoadCurve(buckets)
+    targets = plan(nodes, curve)
+
+    print("%-22s %-8s %-8s %12s %7s %7s" % ("node", "key", "target", args.metric + "/s",
+                                          "share", "after"))
+    for i, ((address, key), target) in enumerate(zip(nodes, targets)):
+        share = curve.share(int(nodes[i - 1][1], 16), int(key, 16))
+        after = curve.share(int(targets[i - 1], 16), int(target, 16))
+        print("%-22s %-8s %-8s %12.1f %6.1f%% %6.1f%%" % (
+            address, key[:8], target[:8], rates[i], share * 100, after * 100))
+
+    if not mean or max(rates) <= mean * (1 + args.threshold):
+        print("Balanced within %.0f%%, nothing to do" % (args.threshold * 100))
+        return
+    moves = [(address, target) for (address, key), target in zip(nodes, targets)
+             if target != key]
+    if args.apply:
+        apply(moves, args.rate)
+    else:
+        print("%d moves; run with --apply to make them" % len(moves))
+
+
+if __name__ == "__main__":
+    main(arg_parser().parse_args())
@@ -0,0 +1,330 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import heapq
+import json
+import random
+import statistics
+import sys
+import threading
+import uuid
+
+from compress import decode, encode
+from node import ThreadingHttpServer
+from rpc import RpcResponse, dispatch, encode_request
+from store import encode_items
+
+# Discrete-event simulator for the ring. The nodes are the real
+# ThreadingHttpServer ring logic (ownership checks, find_neighbors,
+# stabilize, leave), only their requests to each other go through an
+# in-memory network instead of sockets. Every event runs to completion at
+# once, and the latency it would have had is the sum of the latencies
+# sampled for each hop it made.
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="ringsim", description="DHT ring simulator")
+
+    parser.add_argument("-n", "--nodes", type=int, default=1000,
+                        help="number of nodes in the initial ring, default 1000")
+
+    parser.add_argument("--join-initial", action="store_true",
+                        help="build the initial ring through joins instead of " +
+                        "linking the nodes directly (slow for large rings)")
+
+    parser.add_argument("-k", "--keys", type=int, default=10000,
+                        help="number of keys stored before the run, default 10000")
+
+    parser.add_argument("-d", "--duration", type=float, default=60,
+                        help="simulated seconds to run, default 60")
+
+    parser.add_argument("--lookup-rate", type=float, default=20,
+                        help="lookups per simulated second, default 20")
+
+    parser.add_argument("--join-rate", type=float, default=0,
+                        help="joins per simulated second, default 0")
+
+    parser.add_argument("--leave-rate", type=float, default=0,
+                        help="leaves per simulated second, default 0")
+
+    parser.add_argument("--crash-rate", type=float, default=0,
+                        help="crashes per simulated second, default 0")
+
+    parser.add_argument("--downtime", type=float, default=10,
+                        help="simulated seconds until a crashed node recovers, default 10")
+
+    parser.add_argument("--latency", type=str, default="uniform:0.2,1",
+                        help="one-way hop latency in ms: const:<ms>, " +
+                        "uniform:<lo>,<hi>, exp:<mean> or lognormal:<mu>,<sigma>, " +
+                        "default uniform:0.2,1")
+
+    parser.add_argument("--seed", type=int, help="random seed")
+
+    parser.add_argument("--json", action="store_true",
+                        help="print the report as JSON")
+
+    return parser
+
+
+def parse_latency(spec, rng):
+    kind, _, params = spec.partition(":")
+    params = [float(p) for p in params.split(",") if p]
+    distributions = {
+        "const": lambda: params[0],
+        "uniform": lambda: rng.uniform(*params),
+        "exp": lambda: rng.expovariate(1 / params[0]),
+        "lognormal": lambda: rng.lognormvariate(*params),
+    }
+    if kind not in distributions:
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    return distributions[kind]
+
+
+class SimNetwork:
+    # The in-memory transport. Requests are delivered by calling straight
+    # into the target node, the same way the RPC server would.
+    def __init__(self, latency):
+        self.latency = latency
+        self.nodes = {}
+        self.hops = 0
+        self.elapsed = 0.0
+
+    def deliver(self, client, method, path, value, hashed_key):
+        self.hops += 1
+        self.elapsed += self.latency() + self.latency()
+        target = self.nodes.get(client)
+        if target is None:
+            raise ConnectionRefusedError(client)
+
+        encoded = encode_request(method, path, value, hashed_key)
+        if encoded:
+            return RpcResponse(*dispatch(target, *encoded))
+        # A crashed node still answers /node-info, as a real one does.
+        if path == "/node-info":
+            info = {"successor": target.successor[1], "others": [target.predecessor[1]],
+                    "sim_crash": target.sim_crashed}
+            return RpcResponse(200, json.dumps(info).encode())
+        if target.sim_crashed:
+            return RpcResponse(500, b"")
+        if path.startswith("/merkle?prefix="):
+            node = target.merkle_node(path.partition("=")[2])
+            return RpcResponse(200, json.dumps(node).encode())
+        if path == "/merkle/fetch":
+            items = target.fetch_entries(json.loads(value))
+            return RpcResponse(200, json.dumps(encode_items(items)).encode())
+        return RpcResponse(404, b"")
+
+    def measure(self, operation):
+        # Run one operation and return its result, hop count and latency.
+        self.hops = 0
+        self.elapsed = 0.0
+        result = operation()
+        return result, self.hops, self.elapsed
+
+
+class SimNode(ThreadingHttpServer):
+    def __init__(self, address, network):
+        self.setup_node(address)
+        self.network = network
+        self.served = 0
+        network.nodes[address] = self
+
+    def request(self, method, client, path, value=None, get_response=True,
+                hashed_key=None):
+        resp = self.network.deliver(client, method, path, value, hashed_key)
+        if get_response:
+            return resp, resp.getheaders()
+
+    def next_hop(self, hashed_key):
+        hop = super().next_hop(hashed_key)
+        if hop is None:
+            self.served += 1
+        return hop
+
+    def backoff(self, attempt):
+        self.network.elapsed += JOIN_BACKOFF_MS * 2 ** min(attempt, 4)
+
+
+JOIN_BACKOFF_MS = 50
+
+
+def link_ring(nodes):
+    ring = sorted(nodes, key=lambda node: node.key)
+    for i, node in enumerate(ring):
+        node.predecessor = (ring[i - 1].key, ring[i - 1].address)
+        successor = ring[(i + 1) % len(ring)]
+        node.successor = (successor.key, successor.address)
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarize(values):
+    return {
+        "mean": statistics.fmean(values) if values else 0,
+        "p50": percentile(values, 50),
+        "p99": percentile(values, 99),
+        "max": max(values, default=0),
+    }
+
+
+class Simulation:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.network = SimNetwork(parse_latency(args.latency, self.rng))
+        self.members = []
+        self.crashed = set()
+        self.keys = []
+        self.events = []
+        self.sequence = 0
+        self.next_port = 0
+        self.stats = {"lookups": 0, "errors": 0, "joins": 0, "leaves": 0,
+                      "crashes": 0, "recoveries": 0}
+        self.hops = []
+        self.latencies = []
+        self.membership_hops = []
+
+    def new_node(self):
+        self.next_port += 1
+        return SimNode(f"sim-{self.next_port}:8000", self.network)
+
+    def schedule(self, time, action):
+        self.sequence += 1
+        heapq.heappush(self.events, (time, self.sequence, action))
+
+    def schedule_rate(self, now, rate, action):
+        if rate > 0:
+            self.schedule(now + self.rng.expovariate(rate), action)
+
+    def alive(self):
+        return self.rng.choice([n for n in self.members if n not in self.crashed])
+
+    def build(self):
+        nodes = [self.new_node() for i in range(self.args.nodes)]
+        if self.args.join_initial:
+            for node in nodes[1:]:
+                node.join_ring(nodes[0].address)
+        else:
+            link_ring(nodes)
+        self.members = nodes
+        ring = sorted(nodes, key=lambda node: node.key)
+        ring_keys = [node.key for node in ring]
+        for i in range(self.args.keys):
+            key = str(uuid.UUID(int=self.rng.getrandbits(128)))
+            if self.args.join_initial:
+                self.alive().store_value(key, encode(key.encode()))
+            else:
+                # Routing every key across a big ring takes long, so put it
+                # straight on its owner, the first node with a key above its hash.
+                hashed_key = ring[0].hash_value(key.encode())
+                owner = ring[bisect.bisect_right(ring_keys, hashed_key) % len(ring)]
+                owner.object_store[hashed_key] = encode(key.encode())
+            self.keys.append(key)
+
+    def lookup(self, now):
+        key = self.rng.choice(self.keys)
+        node = self.alive()
+        (status, value), hops, elapsed = self.network.measure(
+            lambda: node.get_value(key))
+        self.stats["lookups"] += 1
+        if status != 200 or decode(value) != key.encode():
+            self.stats["errors"] += 1
+        self.hops.append(hops)
+        self.latencies.append(elapsed)
+        self.schedule_rate(now, self.args.lookup_rate, self.lookup)
+
+    def membership(self, now, operation, stat):
+        result, hops, elapsed = self.network.measure(operation)
+        self.stats[stat] += 1
+        self.membership_hops.append(hops)
+
+    def join(self, now):
+        node = self.new_node()
+        entry = self.alive()
+        self.membership(now, lambda: node.join_ring(entry.address), "joins")
+        self.members.append(node)
+        self.schedule_rate(now, self.args.join_rate, self.join)
+
+    def leave(self, now):
+        if len(self.members) - len(self.crashed) > 1:
+            node = self.alive()
+            self.membership(now, node.leave, "leaves")
+            self.members.remove(node)
+        self.schedule_rate(now, self.args.leave_rate, self.leave)
+
+    def crash(self, now):
+        if len(self.members) - len(self.crashed) > 1:
+            node = self.alive()
+            node.sim_crash()
+            self.crashed.add(node)
+            self.stats["crashes"] += 1
+            self.schedule(now + self.args.downtime, lambda now: self.recover(now, node))
+        self.schedule_rate(now, self.args.crash_rate, self.crash)
+
+    def recover(self, now, node):
+        self.membership(now, node.sim_recover, "recoveries")
+        self.crashed.discard(node)
+
+    def run(self):
+        self.build()
+        self.schedule_rate(0, self.args.lookup_rate, self.lookup)
+        self.schedule_rate(0, self.args.join_rate, self.join)
+        self.schedule_rate(0, self.args.leave_rate, self.leave)
+        self.schedule_rate(0, self.args.crash_rate, self.crash)
+        while self.events:
+            now, sequence, action = heapq.heappop(self.events)
+            if now > self.args.duration:
+                break
+            action(now)
+        return self.report()
+
+    def report(self):
+        keys_per_node = [len(node.object_store) for node in self.members]
+        served = [node.served for node in self.members]
+        return {
+            "nodes": len(self.members),
+            "events": self.stats,
+            "hops": summarize(self.hops),
+            "latency_ms": summarize(self.latencies),
+            "membership_hops": summarize(self.membership_hops),
+            "keys_per_node": summarize(keys_per_node),
+            "requests_served_per_node": summarize(served),
+        }
+
+
+def print_report(report):
+    print("%d nodes at the end of the run" % report["nodes"])
+    print("Events: " + ", ".join("%s %d" % item for item in report["events"].items()))
+    for name in ("hops", "latency_ms", "membership_hops",
+                 "keys_per_node", "requests_served_per_node"):
+        s = report[name]
+        print("%-26s mean %10.2f  p50 %10.2f  p99 %10.2f  max %10.2f" % (
+            name, s["mean"], s["p50"], s["p99"], s["max"]))
+
+
+def main(args):
+    report = Simulation(args).run()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+
+    parser = arg_parser()
+    args = parser.parse_args()
+
+    # Routing is recursive, one call chain per hop, so big rings need a
+    # deep stack.
+    sys.setrecursionlimit(1000000)
+    threading.stack_size(512 * 1024 * 1024)
+    thread = threading.Thread(target=main, args=(args,))
+    thread.start()
+    thread.join()
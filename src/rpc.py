@@ -0,0 +1,485 @@
+import json
+import select
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from urllib.parse import parse_qs, unquote
+
+from conditional import parse_condition
+from store import decode_items, encode_items
+from timeouts import CONNECT_TIMEOUT, budget_ms, set_deadline
+
+# Node-to-node traffic can optionally use this binary protocol instead of
+# HTTP. Every message is a frame on a persistent TCP connection:
+#
+#   body length (u32) | request id (u32) | op (u8) | flags (u8) | status (u16)
+#
+# followed by the body. In requests, the status field carries the ms the
+# request has left of its deadline, or 0 for none. Storage ops carry the 20
+# byte SHA-1 of the key, so the receiving node doesn't have to hash it
+# again, followed by the key itself, for forwarding, and the value in its
+# stored form (see compress.py), so compressed values pass through as they
+# are. PUT_TTL has the TTL in seconds (f64) between the key and the value;
+# PUT_QUERY, for conditional writes, and POST, for incr and append, have the
+# request's query string there instead, prefixed with its length (u16).
+# Control ops carry compact JSON.
+# The RPC port of a node is its HTTP port plus RPC_PORT_OFFSET.
+#
+# Requests are pipelined: a connection carries any number of requests at
+# once, and responses come back in whatever order they finish, matched to
+# their requests by id. So a node needs one connection per peer, one reader
+# thread per connection and a fixed pool of workers, however many requests
+# are in flight.
+
+HEADER = struct.Struct("!IIBBH")
+KEY_LENGTH = struct.Struct("!H")
+TTL = struct.Struct("!d")
+QUERY_LENGTH = struct.Struct("!H")
+DIGEST_SIZE = 20
+RPC_PORT_OFFSET = 1000
+RPC_WORKERS = 16
+# How often a client looks for calls whose deadline has passed, in seconds.
+EXPIRY_INTERVAL = 0.1
+
+# Runs the callbacks of RpcClient.call_async, off the connections' reader
+# threads.
+callback_pool = ThreadPoolExecutor(max_workers=RPC_WORKERS)
+
+OP_PUT = 1
+OP_GET = 2
+OP_JOIN = 3
+OP_UPDATE = 4
+OP_STABILIZE = 5
+OP_HANDOFF = 6
+OP_PUT_TTL = 7
+OP_DELETE = 8
+OP_PUT_QUERY = 9
+OP_POST = 10
+
+STORAGE_OPS = (OP_PUT, OP_GET, OP_PUT_TTL, OP_DELETE, OP_PUT_QUERY, OP_POST)
+
+
+def rpc_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port) + RPC_PORT_OFFSET
+
+
+def to_bytes(value):
+    if value is None:
+        return b""
+    if isinstance(value, str):
+        return value.encode()
+    return bytes(value)
+
+
+def recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer")
+        buf += chunk
+    return bytes(buf)
+
+
+def read_frame(sock):
+    length, request_id, op, flags, status = HEADER.unpack(
+        recv_exactly(sock, HEADER.size))
+    return request_id, op, flags, status, recv_exactly(sock, length)
+
+
+def wait_for(sock, event, timeout):
+    # Whether sock is ready for event (select.POLLIN or POLLOUT) within
+    # timeout seconds.
+    poller = select.poll()
+    poller.register(sock, event)
+    return bool(poller.poll(max(timeout, 0) * 1000))
+
+
+def send_buffers(sock, buffers, timeout=None):
+    # sendall for several buffers at once: one sendmsg call, usually, and
+    # no copying them into one bytes object first. With a timeout, raises
+    # TimeoutError if the socket hasn't taken them all after that many
+    # seconds, without taking the socket out of blocking mode, which its
+    # reader relies on; a frame may then be half sent.
+    buffers = [memoryview(b) for b in buffers if len(b)]
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while buffers:
+        if deadline is None:
+            sent = sock.sendmsg(buffers)
+        elif not wait_for(sock, select.POLLOUT, deadline - time.monotonic()):
+            raise TimeoutError("Timed out sending")
+        else:
+            try:
+                sent = sock.sendmsg(buffers, [], socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                continue
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def write_frame(sock, request_id, op, body, status=0, flags=0, timeout=None):
+    send_buffers(sock, [HEADER.pack(len(body), request_id, op, flags, status), body], timeout)
+
+
+def encode_storage(digest, key, value=b""):
+    key = key.encode()
+    return digest + KEY_LENGTH.pack(len(key)) + key + value
+
+
+def decode_storage(body):
+    digest = body[:DIGEST_SIZE]
+    offset = DIGEST_SIZE + KEY_LENGTH.size
+    (key_length,) = KEY_LENGTH.unpack(body[DIGEST_SIZE:offset])
+    key = body[offset:offset + key_length].decode()
+    return digest.hex(), key, body[offset + key_length:]
+
+
+def decode_query(value):
+    # The query string in front of the value of PUT_QUERY and POST, parsed,
+    # and the value.
+    (length,) = QUERY_LENGTH.unpack(value[:QUERY_LENGTH.size])
+    query = value[QUERY_LENGTH.size:QUERY_LENGTH.size + length].decode()
+    params = {k: v[0] for k, v in parse_qs(query).items()}
+    return params, value[QUERY_LENGTH.size + length:]
+
+
+def encode_request(method, path, value, hashed_key=None):
+    # Map an internal HTTP-style request onto an RPC op. Returns None for
+    # requests that have no binary equivalent and should go over HTTP.
+    if path.startswith("/storage/"):
+        path, _, query = path.partition("?")
+        key = unquote(path[len("/storage/"):])
+        if hashed_key:
+            digest = bytes.fromhex(hashed_key)
+        else:
+            digest = sha1(key.encode()).digest()
+        if method == "PUT" and not query:
+            return OP_PUT, encode_storage(digest, key, to_bytes(value))
+        if method == "PUT" and query.startswith("ttl=") and "&" not in query:
+            ttl = TTL.pack(float(query[len("ttl="):]))
+            return OP_PUT_TTL, encode_storage(digest, key, ttl + to_bytes(value))
+        if method in ("PUT", "POST"):
+            query = query.encode()
+            return (OP_PUT_QUERY if method == "PUT" else OP_POST), encode_storage(
+                digest, key, QUERY_LENGTH.pack(len(query)) + query + to_bytes(value))
+        if method == "GET":
+            return OP_GET, encode_storage(digest, key)
+        if method == "DELETE":
+            return OP_DELETE, encode_storage(digest, key)
+        return None
+    op = {
+        ("PUT", "/join"): OP_JOIN,
+        ("PUT", "/update"): OP_UPDATE,
+        ("PUT", "/stabilize"): OP_STABILIZE,
+        ("PUT", "/handoff"): OP_HANDOFF,
+    }.get((method, path))
+    if op is None:
+        return None
+    return op, to_bytes(value)
+
+
+def dispatch(node, op, body):
+    # Run a request against the node and return (status, response body).
+    if node.sim_crashed:
+        return 500, b"I have sim-crashed"
+
+    if op == OP_PUT:
+        hashed_key, key, value = decode_storage(body)
+        return node.store_value(key, value, hashed_key=hashed_key), b""
+
+    if op == OP_PUT_TTL:
+        hashed_key, key, value = decode_storage(body)
+        (ttl,) = TTL.unpack(value[:TTL.size])
+        return node.store_value(key, value[TTL.size:], hashed_key=hashed_key, ttl=ttl), b""
+
+    if op == OP_PUT_QUERY:
+        hashed_key, key, value = decode_storage(body)
+        params, value = decode_query(value)
+        ttl = float(params["ttl"]) if "ttl" in params else None
+        return node.store_value(key, value, hashed_key=hashed_key, ttl=ttl,
+                                condition=parse_condition({}, params)), b""
+
+    if op == OP_POST:
+        hashed_key, key, value = decode_storage(body)
+        params, value = decode_query(value)
+        status, value = node.modify_value(key, params.get("op"), value, hashed_key=hashed_key)
+        return status, to_bytes(value)
+
+    if op == OP_GET:
+        hashed_key, key, value = decode_storage(body)
+        status, value = node.get_value(key, hashed_key=hashed_key)
+        return status, to_bytes(value)
+
+    if op == OP_DELETE:
+        hashed_key, key, value = decode_storage(body)
+        return node.delete_value(key, hashed_key=hashed_key), b""
+
+    if op == OP_JOIN:
+        status, neighbors = node.find_neighbors(body)
+        return status, to_bytes(neighbors)
+
+    if op == OP_UPDATE:
+        status, items = node.update_neighbors(json.loads(body))
+        return status, json.dumps(encode_items(items), separators=(",", ":")).encode()
+
+    if op == OP_STABILIZE:
+        key, address = node.stabilize(json.loads(body))
+        return 200, json.dumps({"key": key, "address": address}).encode()
+
+    if op == OP_HANDOFF:
+        node.accept_handoff(decode_items(json.loads(body)))
+        return 200, b""
+
+    return 404, b"Unknown op"
+
+
+class RpcResponse:
+    # Quacks like the parts of http.client.HTTPResponse the node uses.
+    def __init__(self, status, body, headers=()):
+        self.status = status
+        self.body = body
+        self.headers = list(headers)
+
+    def read(self):
+        return self.body
+
+    def getheaders(self):
+        return self.headers
+
+
+class RpcClient:
+    # One persistent connection to one peer, shared by all threads. Each
+    # request registers a callback under its id, and a reader thread hands
+    # every response to its callback as soon as it arrives. Callbacks run
+    # on callback_pool, so one that blocks, say writing to a slow client,
+    # doesn't hold up the responses behind it. A request with a deadline
+    # fails with TimeoutError once it passes, whether or not the peer ever
+    # answers.
+    #
+    # lock guards the ids, the pending requests and the socket, and is only
+    # ever held for a moment, so the reader never waits for a sender.
+    # send_lock lets one thread at a time connect or write a frame, and is
+    # waited for no longer than the request's deadline.
+    def __init__(self, address):
+        self.address = rpc_address(address)
+        self.sock = None
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.next_id = 0
+        self.pending = {}
+
+    def connect(self, timeout):
+        sock = socket.create_connection(self.address, min(CONNECT_TIMEOUT, timeout))
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.lock:
+            self.sock = sock
+            self.pending = {}
+            pending = self.pending
+        threading.Thread(
+            target=self.read_loop, args=(sock, pending), daemon=True).start()
+
+    def call_async(self, op, body, callback, budget=0, inline=False):
+        # callback gets an RpcResponse, or the exception if the connection
+        # failed or the deadline passed before the response came back.
+        # budget is the deadline passed on, in ms, or 0 for none. With
+        # inline, the callback runs on the reader thread instead, and must
+        # not block.
+        expires_at = time.monotonic() + budget / 1000 if budget else None
+        with self.lock:
+            self.next_id = (self.next_id + 1) & 0xffffffff
+            request_id = self.next_id
+        # A cached connection may have been closed by the peer since we
+        # last used it, so reconnect once before giving up.
+        for attempt in range(2):
+            timeout = expires_at - time.monotonic() if expires_at else None
+            if not self.send_lock.acquire(timeout=max(timeout, 0) if timeout is not None else -1):
+                raise TimeoutError(f"Timed out waiting to send to {self.peer()}")
+            sock = None
+            try:
+                if self.sock is None:
+                    self.connect(timeout if timeout is not None else CONNECT_TIMEOUT)
+                with self.lock:
+                    sock, pending = self.sock, self.pending
+                    pending[request_id] = (callback, expires_at, inline)
+                timeout = expires_at - time.monotonic() if expires_at else None
+                write_frame(sock, request_id, op, body, budget, timeout=timeout)
+                return request_id
+            except OSError as e:
+                # A half sent frame leaves the connection unusable. If the
+                # reader already failed this request, it has reported the
+                # error to the callback.
+                with self.lock:
+                    reported = sock is not None and pending.pop(request_id, None) is None
+                    if sock is not None and self.sock is sock:
+                        self.close()
+                if reported:
+                    return request_id
+                if attempt or isinstance(e, TimeoutError):
+                    raise
+            finally:
+                self.send_lock.release()
+
+    def call(self, op, body, timeout=None):
+        done = threading.Event()
+        result = []
+
+        def callback(resp):
+            result.append(resp)
+            done.set()
+
+        budget = budget_ms(timeout) if timeout is not None else 0
+        request_id = self.call_async(op, body, callback, budget, inline=True)
+        if not done.wait(timeout):
+            with self.lock:
+                self.pending.pop(request_id, None)
+            raise TimeoutError(f"No response from {self.peer()}")
+        if isinstance(result[0], Exception):
+            raise result[0]
+        return result[0]
+
+    def read_loop(self, sock, pending):
+        # Between responses, and at least every EXPIRY_INTERVAL, fail the
+        # requests whose deadline has passed.
+        next_expiry = time.monotonic() + EXPIRY_INTERVAL
+        try:
+            while True:
+                if wait_for(sock, select.POLLIN, EXPIRY_INTERVAL):
+                    request_id, op, flags, status, body = read_frame(sock)
+                    with self.lock:
+                        request = pending.pop(request_id, None)
+                    if request:
+                        self.finish(request, RpcResponse(status, body))
+                if time.monotonic() >= next_expiry:
+                    self.expire(pending)
+                    next_expiry = time.monotonic() + EXPIRY_INTERVAL
+        except OSError as e:
+            # Fail everything still waiting on this connection.
+            with self.lock:
+                if self.sock is sock:
+                    self.close()
+                failed = list(pending.values())
+                pending.clear()
+            for request in failed:
+                self.finish(request, e)
+
+    def expire(self, pending):
+        now = time.monotonic()
+        with self.lock:
+            expired = [request_id for request_id, (callback, expires_at, inline) in pending.items()
+                       if expires_at is not None and expires_at <= now]
+            expired = [pending.pop(request_id) for request_id in expired]
+        for request in expired:
+            self.finish(request, TimeoutError(f"No response from {self.peer()}"))
+
+    def finish(self, request, result):
+        callback, expires_at, inline = request
+        if inline:
+            callback(result)
+        else:
+            callback_pool.submit(callback, result)
+
+    def peer(self):
+        return f"{self.address[0]}:{self.address[1]}"
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class RpcHandler(socketserver.BaseRequestHandler):
+    # Reads frames off one connection and answers them as they complete.
+    # Storage requests that only need to be forwarded are passed on to the
+    # next hop without holding a thread while they wait for the answer;
+    # everything else runs on the server's worker pool.
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.write_lock = threading.Lock()
+
+    def handle(self):
+        while True:
+            try:
+                request_id, op, flags, status, body = read_frame(self.request)
+            except (ConnectionError, OSError):
+                return
+            if not self.forward(request_id, op, body, status):
+                self.submit(request_id, op, body, status)
+
+    def respond(self, request_id, op, status, body):
+        with self.write_lock:
+            try:
+                write_frame(self.request, request_id, op, body, status)
+            except OSError:
+                pass
+
+    def submit(self, request_id, op, body, budget):
+        def run():
+            set_deadline(budget / 1000 if budget else self.server.node.request_timeout)
+            try:
+                status, response = dispatch(self.server.node, op, body)
+            except Exception as e:
+                status, response = 500, str(e).encode()
+            self.respond(request_id, op, status, response)
+
+        self.server.pool.submit(run)
+
+    def forward(self, request_id, op, body, budget):
+        node = self.server.node
+        # With injected faults, requests have to go through node.request.
+        if op not in STORAGE_OPS or node.sim_crashed or node.faults.links:
+            return False
+        key = body[:DIGEST_SIZE].hex()
+        with node.ring_lock.read():
+            next_hop = node.next_hop(key)
+        if next_hop is None:
+            return False
+
+        def forwarded(resp, shared=False):
+            # If the next hop failed, take the slow path, which stabilizes
+            # the ring and retries. So does a GET that got the answer of
+            # another one (see coalesced_get in node.py) if that failed or ran
+            # out of time, which may have been before this one's deadline.
+            # A write ends the wait for GETs of the key, as on the slow path.
+            if op != OP_GET:
+                node.get_flights.forget(key)
+            if (resp is None or isinstance(resp, Exception) or resp.status == 500
+                    or shared and resp.status == 504):
+                self.submit(request_id, op, body, budget)
+                return
+            if shared:
+                node.count("coalesced")
+            self.respond(request_id, op, resp.status, resp.body)
+
+        def send(done):
+            node.rpc_client(next_hop).call_async(op, body, done, budget)
+
+        try:
+            if op == OP_GET:
+                node.get_flights.do_async(key, send, forwarded)
+            else:
+                send(forwarded)
+        except OSError:
+            return False
+        return True
+
+
+class RpcServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, node, reuse_port=False):
+        self.node = node
+        self.allow_reuse_port = reuse_port
+        self.pool = ThreadPoolExecutor(max_workers=RPC_WORKERS)
+        super().__init__(("", rpc_address(node.address)[1]), RpcHandler)
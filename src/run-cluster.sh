@@ -1,5 +1,5 @@
 if [[ $# -lt 2 ]]; then
-	echo "Usage: $0 <num_hosts> <port> [benchmark (default=0)]"
+	echo "Usage: $0 <num_hosts> <port> [benchmark: 1 for test_client.py, 2 for loadtest.py (default=0)]"
 	exit
 fi
 
@@ -23,4 +23,7 @@ done
 if [[ "$3" == "1" ]]; then
 	sleep 2
 	python3 test_client.py -t 10000 -n $1 $entry.local:$port
+elif [[ "$3" == "2" ]]; then
+	sleep 2
+	python3 loadtest.py -c 8 -t 4 -d 30 $entry.local:$port
 fi
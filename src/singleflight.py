@@ -0,0 +1,96 @@
+import threading
+from concurrent.futures import Future, TimeoutError
+
+# Coalescing of identical requests in flight. The first caller for a key
+# runs the fetch, and callers that come for the same key while it runs wait
+# for its result instead of fetching it again, so a burst of reads of one
+# hot key costs its owner one request per node that forwards them rather
+# than one per client. Only requests that overlap share anything: the
+# flight is gone as soon as its result is in, so nothing is cached.
+#
+# A call for a key from within the fetch for that key, as when a request
+# that is forwarded in a loop comes back to the thread that forwarded it
+# (the ring simulator delivers requests that way), runs a fetch of its own
+# rather than wait for itself.
+#
+# forget() lets the next caller start a fresh fetch even while one is in
+# flight, for when the key was just written and the running fetch may have
+# read it before the write.
+#
+# do_async() is the same without a thread waiting, for fetches that report
+# their result through a callback, as the RPC server's forwarding does. Its
+# flights are the same as do()'s, so either kind of caller can wait for the
+# other's fetch.
+
+
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        self.leading = threading.local()
+
+    def do(self, key, fetch, timeout=None):
+        # (result, shared): the result of fetch(), from this call or from
+        # the one already running for key, and whether it was the latter.
+        # A caller that waited timeout seconds in vain gets (None, True).
+        leading = getattr(self.leading, "keys", None)
+        if leading is None:
+            leading = self.leading.keys = set()
+        if key in leading:
+            return fetch(), False
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Future()
+                leader = True
+            else:
+                leader = False
+        if not leader:
+            try:
+                return flight.result(timeout), True
+            except TimeoutError:
+                return None, True
+        leading.add(key)
+        try:
+            result = fetch()
+            flight.set_result(result)
+            return result, False
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            leading.discard(key)
+            self.forget(key, flight)
+
+    def forget(self, key, flight=None):
+        with self.lock:
+            if flight is None or self.flights.get(key) is flight:
+                self.flights.pop(key, None)
+
+    def do_async(self, key, fetch, callback):
+        # fetch(done) starts the fetch and calls done(result) once it is
+        # in, and callback(result, shared) gets the result, on the thread
+        # that delivered it; the result is None if the fetch it shared
+        # raised. If fetch() itself raises, so does this, and the callers
+        # waiting for it get None.
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.flights[key] = Future()
+        if not leader:
+            flight.add_done_callback(lambda flight: callback(
+                None if flight.exception() else flight.result(), True))
+            return
+
+        def done(result):
+            self.forget(key, flight)
+            flight.set_result(result)
+            callback(result, False)
+
+        try:
+            fetch(done)
+        except BaseException as e:
+            self.forget(key, flight)
+            flight.set_exception(e)
+            raise
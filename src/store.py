@@ -0,0 +1,411 @@
+import base64
+import threading
+import time
+from bisect import bisect_left, insort
+
+from eviction import POLICIES
+from merkle import MerkleTree
+
+WHEEL_SLOTS = 3600
+STRIPES = 16
+# Rough bytes of memory a key takes besides its digest, value and name:
+# the dict and index entries, the bytes headers and the Merkle tree
+# bookkeeping.
+ENTRY_OVERHEAD = 160
+DIGEST_SIZE = 20
+
+
+def entry_size(value, name=None):
+    return DIGEST_SIZE + len(value) + len(name or b"") + ENTRY_OVERHEAD
+
+
+def bound(key):
+    # A range bound given as hex, of any length, as the digest bound that
+    # orders the same against the keys. A prefix followed by "g" (see
+    # merkle.prefix_range) is the bound right after every key with that
+    # prefix.
+    if key.endswith("g"):
+        return bytes.fromhex(key[:-1].ljust(2 * DIGEST_SIZE, "f")) + b"\0"
+    return bytes.fromhex(key.ljust(2 * DIGEST_SIZE, "0"))
+
+
+class ExpiryWheel:
+    # A hashed timing wheel with one-second slots. A key with a TTL goes in
+    # the slot of the second it expires in, whichever turn of the wheel that
+    # is, and each second that passes only that second's slot is looked at.
+    # So reclaiming costs in proportion to the keys expiring, not the keys
+    # stored. Entries of later turns stay in their slot. Slots only exist
+    # while they hold entries, so a store without TTLs costs next to nothing,
+    # which matters with thousands of nodes in one ringsim process.
+    def __init__(self, now):
+        self.slots = {}
+        self.position = int(now)
+
+    def add(self, key, expires_at):
+        self.slots.setdefault(int(expires_at) % WHEEL_SLOTS, []).append((key, expires_at))
+
+    def advance(self, now):
+        # Returns the entries that expired in the seconds that have passed
+        # since the last call. After a long pause one full turn covers all
+        # of them.
+        now = int(now)
+        self.position = max(self.position, now - WHEEL_SLOTS)
+        expired = []
+        while self.position < now:
+            i = self.position % WHEEL_SLOTS
+            later = []
+            for key, expires_at in self.slots.pop(i, ()):
+                if expires_at < self.position + 1:
+                    expired.append((key, expires_at))
+                else:
+                    later.append((key, expires_at))
+            if later:
+                self.slots[i] = later
+            self.position += 1
+        return expired
+
+
+class Stripe:
+    # One of the hash shards of the store, with its own lock. Its methods
+    # expect the caller to hold the lock.
+    def __init__(self, tree, capacity, eviction, keep_names):
+        self.lock = threading.Lock()
+        self.tree = tree
+        self.values = {}
+        self.index = []
+        self.names = {} if keep_names else None
+        self.expiry = {}
+        self.size = 0
+        self.capacity = capacity
+        self.policy = POLICIES[eviction]() if capacity else None
+        self.expired = 0
+        self.evictions = 0
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, digest, key, value, expires_at, name, now, replace=True):
+        if not replace and digest in self.values and self.expiry.get(digest, now + 1) > now:
+            return True
+        if expires_at is not None and expires_at <= now:
+            self.discard(digest)
+            return True
+        if self.names is None:
+            name = None
+        elif name is None:
+            name = self.names.get(digest)
+        else:
+            name = name.encode()
+        size = entry_size(value, name)
+        if self.capacity and size > self.capacity:
+            self.discard(digest)
+            return False
+        old_value = self.values.get(digest)
+        if old_value is None:
+            insort(self.index, digest)
+        else:
+            old_name = self.names.get(digest) if self.names is not None else None
+            self.size -= entry_size(old_value, old_name)
+        self.values[digest] = value
+        if name is not None:
+            self.names[digest] = name
+        self.size += size
+        self.tree.update(key, old_value, value)
+        if expires_at is None:
+            self.expiry.pop(digest, None)
+        else:
+            self.expiry[digest] = expires_at
+        if self.policy:
+            if old_value is None:
+                self.policy.add(digest)
+            else:
+                self.policy.touch(digest)
+        return True
+
+    def evict_one(self, keep):
+        # Drops the key the policy picks over every key but keep; False if
+        # there is none.
+        digest = self.policy.victim(keep)
+        if digest is None:
+            return False
+        self.remove(digest)
+        self.evictions += 1
+        return True
+
+    def remove(self, digest):
+        value = self.values.pop(digest)
+        name = self.names.pop(digest, None) if self.names is not None else None
+        self.tree.update(digest.hex(), value)
+        del self.index[bisect_left(self.index, digest)]
+        self.expiry.pop(digest, None)
+        self.size -= entry_size(value, name)
+        if self.policy:
+            self.policy.remove(digest)
+
+    def discard(self, digest):
+        if digest in self.values:
+            self.remove(digest)
+            return True
+        return False
+
+    def get(self, digest, now):
+        expires_at = self.expiry.get(digest)
+        if expires_at is not None and expires_at <= now:
+            self.expire(digest)
+            value = None
+        else:
+            value = self.values.get(digest)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            if self.policy:
+                self.policy.touch(digest)
+        return value
+
+    def expire(self, digest):
+        if self.discard(digest):
+            self.expired += 1
+
+    def item(self, digest):
+        name = self.names.get(digest) if self.names is not None else None
+        return (digest.hex(), self.values[digest], self.expiry.get(digest),
+                name.decode() if name is not None else None)
+
+    def slice(self, lo, hi):
+        # Offsets of the digests in [lo, hi) in the index, None meaning
+        # the bottom or the top of the ring.
+        i = bisect_left(self.index, lo) if lo is not None else 0
+        j = bisect_left(self.index, hi) if hi is not None else len(self.index)
+        return i, max(i, j)
+
+    def pop_slice(self, i, j):
+        items = [self.item(digest) for digest in self.index[i:j]]
+        for digest in self.index[i:j]:
+            value = self.values.pop(digest)
+            name = self.names.pop(digest, None) if self.names is not None else None
+            self.tree.update(digest.hex(), value)
+            self.expiry.pop(digest, None)
+            self.size -= entry_size(value, name)
+            if self.policy:
+                self.policy.remove(digest)
+        del self.index[i:j]
+        return items
+
+
+def ranges(start, end):
+    # A ring range [start, end) of hex keys as digest ranges in ring order.
+    # When start >= end, the range wraps around the top of the ring.
+    if start < end:
+        return [(bound(start), bound(end))]
+    return [(bound(start), None), (None, bound(end))]
+
+
+class ObjectStore:
+    # Keys come in as the 40 character hex digests the ring works with, but
+    # are kept as the 20 byte digests, which take 36 bytes less per key.
+    # Values are kept in dicts for point lookups, and the digests are also
+    # kept in sorted lists. Sorting digests gives the same order as the
+    # ring, which lets us pull out all keys in a range of the ring with
+    # binary searches instead of a full scan.
+    #
+    # The keys are split by their first hex digit over STRIPES stripes,
+    # each with its own lock, so requests for different keys don't wait
+    # for each other, while everything that has to change together for one
+    # key (value, index, expiry, eviction bookkeeping) changes atomically.
+    # The stripes are ranges of the ring, so a range scan goes through them
+    # in order. The Merkle tree is shared and locks itself.
+    #
+    # With keep_names, the store also keeps the key each digest was made
+    # from, as UTF-8, so the keys it holds can be listed.
+    #
+    # Keys can have an expiry time (wall clock, so it means the same on every
+    # node). Expired keys are dropped when they are read, and the expiry
+    # wheel reclaims the rest as writes and reads come in.
+    #
+    # With a capacity, in bytes, the store is a cache: when a write takes
+    # the store over it, keys picked by the eviction policy of the fullest
+    # stripe are dropped until it fits again. The budget is the store's, not
+    # split between the stripes, so any value up to the capacity fits.
+    def __init__(self, capacity=None, eviction="lru", keep_names=False):
+        self.tree = MerkleTree()
+        self.capacity = capacity
+        self.eviction = eviction
+        self.keep_names = keep_names
+        self.stripes = [Stripe(self.tree, capacity, eviction, keep_names)
+                        for i in range(STRIPES)]
+        self.wheel = ExpiryWheel(time.time())
+        self.wheel_lock = threading.Lock()
+
+    def stripe(self, digest):
+        return self.stripes[digest[0] >> 4]
+
+    def __len__(self):
+        return sum(len(stripe.values) for stripe in self.stripes)
+
+    def __contains__(self, key):
+        digest = bytes.fromhex(key)
+        return digest in self.stripe(digest).values
+
+    def __getitem__(self, key):
+        digest = bytes.fromhex(key)
+        return self.stripe(digest).values[digest]
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def __delitem__(self, key):
+        if not self.discard(key):
+            raise KeyError(key)
+
+    def put(self, key, value, expires_at=None, name=None, replace=True):
+        # Returns False if the value is too big to ever fit in the cache.
+        # Without replace, a key the store already has is left as it is.
+        digest = bytes.fromhex(key)
+        now = time.time()
+        self.reclaim(now)
+        stripe = self.stripe(digest)
+        with stripe.lock:
+            stored = stripe.put(digest, key, value, expires_at, name, now, replace)
+        if stored and expires_at is not None and expires_at > now:
+            with self.wheel_lock:
+                self.wheel.add(digest, expires_at)
+        if self.capacity:
+            self.evict(digest)
+        return stored
+
+    def update(self, key, change, expires_at=None, name=None, keep_expiry=False):
+        # Read-modify-write of one key under its stripe's lock, so no other
+        # write to the key comes in between. change(value) gets the current
+        # value, or None, and returns the new one, or None to leave the key
+        # as it is. Returns the new value, or None, and whether it was
+        # stored, as put does. With keep_expiry the key keeps its expiry
+        # time instead of getting expires_at.
+        digest = bytes.fromhex(key)
+        now = time.time()
+        self.reclaim(now)
+        stripe = self.stripe(digest)
+        with stripe.lock:
+            value = change(stripe.get(digest, now))
+            if value is None:
+                return None, True
+            if keep_expiry:
+                expires_at = stripe.expiry.get(digest)
+            stored = stripe.put(digest, key, value, expires_at, name, now)
+        if stored and expires_at is not None and expires_at > now:
+            with self.wheel_lock:
+                self.wheel.add(digest, expires_at)
+        if self.capacity:
+            self.evict(digest)
+        return value, stored
+
+    def evict(self, keep):
+        # After the write's stripe lock is let go, one stripe lock at a time,
+        # so writes to different stripes never hold each other's locks. The
+        # key just written is never evicted by its own write.
+        while sum(stripe.size for stripe in self.stripes) > self.capacity:
+            for stripe in sorted(self.stripes, key=lambda stripe: -stripe.size):
+                with stripe.lock:
+                    if stripe.evict_one(keep):
+                        break
+            else:
+                return
+
+    def discard(self, key):
+        digest = bytes.fromhex(key)
+        stripe = self.stripe(digest)
+        with stripe.lock:
+            return stripe.discard(digest)
+
+    def get(self, key, default=None):
+        digest = bytes.fromhex(key)
+        now = time.time()
+        self.reclaim(now)
+        stripe = self.stripe(digest)
+        with stripe.lock:
+            value = stripe.get(digest, now)
+        return default if value is None else value
+
+    def peek(self, key, default=None):
+        # A read that doesn't count as a use of the key.
+        digest = bytes.fromhex(key)
+        return self.stripe(digest).values.get(digest, default)
+
+    def reclaim(self, now):
+        # One thread turns the wheel; the others don't wait for it. The
+        # keys are expired after letting go of the wheel, since writers
+        # take a stripe lock before the wheel lock.
+        if now < self.wheel.position + 1 or not self.wheel_lock.acquire(blocking=False):
+            return
+        try:
+            expired = self.wheel.advance(now)
+        finally:
+            self.wheel_lock.release()
+        for digest, expires_at in expired:
+            stripe = self.stripe(digest)
+            with stripe.lock:
+                # Skip keys that have been deleted or given another TTL since.
+                if stripe.expiry.get(digest) == expires_at:
+                    stripe.expire(digest)
+
+    def item(self, key):
+        # (hex key, value, expiry time or None, name or None)
+        digest = bytes.fromhex(key)
+        stripe = self.stripe(digest)
+        with stripe.lock:
+            return stripe.item(digest)
+
+    def totals(self):
+        totals = {"keys": 0, "keys_with_ttl": 0, "expired": 0, "bytes": 0,
+                  "evictions": 0, "hits": 0, "misses": 0}
+        for stripe in self.stripes:
+            with stripe.lock:
+                totals["keys"] += len(stripe.values)
+                totals["keys_with_ttl"] += len(stripe.expiry)
+                totals["expired"] += stripe.expired
+                totals["bytes"] += stripe.size
+                totals["evictions"] += stripe.evictions
+                totals["hits"] += stripe.hits
+                totals["misses"] += stripe.misses
+        return totals
+
+    def scan(self, start, end, collect, limit=None):
+        # collect(stripe, i, j) for the slice of each stripe in the range,
+        # under the stripe's lock, in ring order, until there are limit
+        # results.
+        results = []
+        for lo, hi in ranges(start, end):
+            for stripe in self.stripes:
+                with stripe.lock:
+                    i, j = stripe.slice(lo, hi)
+                    if limit is not None:
+                        j = min(j, i + limit - len(results))
+                    if i < j:
+                        results.extend(collect(stripe, i, j))
+                if limit is not None and len(results) >= limit:
+                    return results
+        return results
+
+    def keys_in_range(self, start, end):
+        return self.scan(start, end, lambda stripe, i, j: [
+            digest.hex() for digest in stripe.index[i:j]])
+
+    def items_in_range(self, start, end, limit=None):
+        # The first limit items of the range, in ring order.
+        return self.scan(start, end, lambda stripe, i, j: [
+            stripe.item(digest) for digest in stripe.index[i:j]], limit)
+
+    def pop_range(self, start, end):
+        return self.scan(start, end, Stripe.pop_slice)
+
+    def pop_all(self):
+        return self.pop_range("", "")
+
+
+def encode_items(items):
+    return [(key, base64.b64encode(value).decode(), expires_at, name)
+            for key, value, expires_at, name in items]
+
+
+def decode_items(encoded):
+    return [(key, base64.b64decode(value), expires_at, name)
+            for key, value, expires_at, name in encoded]
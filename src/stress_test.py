@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from hashlib import sha1
+
+from merkle import MerkleTree
+from store import ObjectStore, entry_size
+
+# Concurrent stress test for the locking in the store and the ring.
+#
+# Against running nodes, every thread owns its own keys and writes, reads
+# and deletes them through random nodes, so it knows what each read should
+# return; with --churn, nodes leave and join the ring meanwhile, and with
+# --move they first move to a random key between their neighbors. A write
+# that fails or times out may or may not have happened, so its key is not
+# checked until it is written or deleted again. In the end every key is
+# read once more.
+#
+# With --store, the threads hammer one ObjectStore in this process instead,
+# while another thread keeps scanning ranges, and afterwards the store's
+# index, byte count and Merkle tree are checked against its contents.
+
+UNAVAILABLE = (500, 502, 504)
+
+
+def arg_parser():
+    parser = argparse.ArgumentParser(prog="stress_test")
+
+    parser.add_argument("-t", "--threads", type=int, default=16,
+                        help="number of client threads, default 16")
+
+    parser.add_argument("-k", "--keys", type=int, default=100,
+                        help="keys per thread, default 100")
+
+    parser.add_argument("-o", "--ops", type=int, default=1000,
+                        help="operations per thread, default 1000")
+
+    parser.add_argument("--churn", type=float, default=0,
+                        help="seconds between one node leaving and rejoining " +
+                        "the ring during the run, default 0 for none")
+
+    parser.add_argument("--move", action="store_true",
+                        help="with --churn, move the node before it leaves")
+
+    parser.add_argument("--store", action="store_true",
+                        help="stress an in-process store instead of nodes")
+
+    parser.add_argument("--capacity", type=int,
+                        help="with --store, run the store as a cache of this many bytes")
+
+    parser.add_argument("nodes", type=str, nargs="*",
+                        help="addresses (host:port) of nodes to test")
+
+    return parser
+
+
+def request(node, method, path, body=None):
+    conn = http.client.HTTPConnection(node, timeout=30)
+    try:
+        conn.request(method, path, body)
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except OSError:
+        return 504, b""
+    finally:
+        conn.close()
+
+
+class Ring:
+    # The nodes clients may use. A node is taken out of it a while before
+    # it leaves, so no request is still on its way to it by then.
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.lock = threading.Lock()
+
+    def pick(self):
+        with self.lock:
+            return random.choice(self.nodes)
+
+    def remove(self, node):
+        with self.lock:
+            self.nodes.remove(node)
+
+    def add(self, node):
+        with self.lock:
+            self.nodes.append(node)
+
+
+def move(node, log):
+    # Move node to a random key strictly between its neighbors' keys.
+    status, body = request(node, "GET", "/node-info")
+    info = json.loads(body)
+    start = int(request(info["others"][0], "GET", "/key")[1], 16)
+    end = int(request(info["successor"], "GET", "/key")[1], 16)
+    span = (end - start) % 2 ** 160 or 2 ** 160
+    if span < 2:
+        return
+    key = (start + random.randrange(1, span)) % 2 ** 160
+    status, body = request(node, "POST", "/admin/move?key=%040x" % key)
+    log.append(("move", node, status))
+
+
+def churn(ring, nodes, interval, moves, stop, log):
+    while not stop.wait(interval):
+        node = random.choice(nodes[1:])
+        ring.remove(node)
+        if moves:
+            move(node, log)
+        time.sleep(1)
+        status, body = request(node, "POST", "/leave")
+        log.append(("leave", node, status))
+        time.sleep(interval)
+        status, body = request(node, "POST", f"/join?nprime={nodes[0]}")
+        log.append(("join", node, status))
+        ring.add(node)
+
+
+def client(ring, prefix, args, expected, stats):
+    keys = [f"{prefix}-{i}" for i in range(args.keys)]
+    for op in range(args.ops):
+        key = random.choice(keys)
+        action = random.random()
+        if action < 0.4:
+            value = f"{key}-{op}".encode()
+            status, body = request(ring.pick(), "PUT", f"/storage/{key}", value)
+            expected[key] = value if status == 200 else "unknown"
+        elif action < 0.5:
+            status, body = request(ring.pick(), "DELETE", f"/storage/{key}")
+            expected[key] = None if status in (200, 404) else "unknown"
+        else:
+            status, body = request(ring.pick(), "GET", f"/storage/{key}")
+            check(key, status, body, expected, stats)
+        stats["ops"] += 1
+        if status in UNAVAILABLE:
+            stats["unavailable"] += 1
+
+
+def check(key, status, body, expected, stats):
+    want = expected.get(key)
+    if want == "unknown" or status in UNAVAILABLE:
+        return
+    if want is None and status == 404 or status == 200 and body == want:
+        return
+    stats["errors"] += 1
+    if stats["errors"] <= 10:
+        print(f"{key}: got {status} {body[:40]!r}, expected {want!r}")
+
+
+def stress_nodes(args):
+    run = uuid.uuid4().hex[:8]
+    ring = Ring(args.nodes)
+    stop = threading.Event()
+    log = []
+    expected = [{} for i in range(args.threads)]
+    stats = [{"ops": 0, "unavailable": 0, "errors": 0} for i in range(args.threads)]
+    threads = [threading.Thread(target=client, args=(
+        ring, f"stress-{run}-{t}", args, expected[t], stats[t])) for t in range(args.threads)]
+    churner = None
+    if args.churn:
+        churner = threading.Thread(target=churn, args=(
+            ring, args.nodes, args.churn, args.move, stop, log))
+        churner.start()
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    stop.set()
+    if churner:
+        churner.join()
+
+    final = {"ops": 0, "unavailable": 0, "errors": 0}
+    for t in range(args.threads):
+        for key in expected[t]:
+            status, body = request(ring.pick(), "GET", f"/storage/{key}")
+            check(key, status, body, expected[t], final)
+    ops = sum(s["ops"] for s in stats)
+    print("%d ops in %.2f s, %.0f ops/s" % (ops, duration, ops / duration))
+    print("Unavailable %d, wrong reads %d" % (
+        sum(s["unavailable"] for s in stats), sum(s["errors"] for s in stats)))
+    print("Membership changes: " + ", ".join("%s %s %d" % entry for entry in log))
+    print("Final check: %d keys wrong or lost" % final["errors"])
+    return sum(s["errors"] for s in stats) + final["errors"]
+
+
+def store_client(store, t, args, expected):
+    keys = [sha1(f"{t}-{i}".encode()).hexdigest() for i in range(args.keys)]
+    errors = 0
+    for op in range(args.ops):
+        key = random.choice(keys)
+        action = random.random()
+        if action < 0.4:
+            value = f"{key}-{op}".encode()
+            if random.random() < 0.1:
+                store.put(key, value, time.time() + 60, key)
+            else:
+                store.put(key, value, None, key)
+            expected[key] = value
+        elif action < 0.5:
+            store.discard(key)
+            expected[key] = None
+        else:
+            value = store.get(key)
+            # A cache may have evicted the key.
+            if value != expected.get(key) and not (args.capacity and value is None):
+                errors += 1
+    return errors
+
+
+def scanner(store, stop, errors):
+    while not stop.is_set():
+        start, end = sorted(sha1(str(random.random()).encode()).hexdigest() for i in range(2))
+        keys = store.keys_in_range(start, end)
+        if keys != sorted(keys) or any(not start <= key < end for key in keys):
+            errors.append((start, end))
+
+
+def stress_store(args):
+    store = ObjectStore(args.capacity, keep_names=True)
+    expected = [{} for i in range(args.threads)]
+    errors = [0] * args.threads
+    scan_errors = []
+    stop = threading.Event()
+
+    def run(t):
+        errors[t] = store_client(store, t, args, expected[t])
+
+    threads = [threading.Thread(target=run, args=(t,)) for t in range(args.threads)]
+    scan = threading.Thread(target=scanner, args=(store, stop, scan_errors))
+    start = time.time()
+    scan.start()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start
+    stop.set()
+    scan.join()
+
+    # Rebuild everything the store keeps about its keys from the keys
+    # themselves, and compare.
+    problems = []
+    tree = MerkleTree()
+    for i, stripe in enumerate(store.stripes):
+        if stripe.index != sorted(stripe.values):
+            problems.append(f"stripe {i}: index out of sync")
+        size = sum(entry_size(value, stripe.names.get(digest))
+                   for digest, value in stripe.values.items())
+        if size != stripe.size:
+            problems.append(f"stripe {i}: size {stripe.size}, should be {size}")
+        for digest, value in stripe.values.items():
+            tree.update(digest.hex(), None, value)
+    if tree.digests != store.tree.digests:
+        problems.append("Merkle tree out of sync")
+    lost = 0
+    for t in range(args.threads):
+        for key, value in expected[t].items():
+            if store.peek(key) != value and not (args.capacity and store.peek(key) is None):
+                lost += 1
+
+    ops = args.threads * args.ops
+    print("%d ops in %.2f s, %.0f ops/s" % (ops, duration, ops / duration))
+    print("Wrong reads %d, bad scans %d, wrong keys at the end %d" % (
+        sum(errors), len(scan_errors), lost))
+    print(json.dumps(store.totals()))
+    for problem in problems:
+        print(problem)
+    return sum(errors) + len(scan_errors) + lost + len(problems)
+
+
+def main(args):
+    if args.store:
+        failures = stress_store(args)
+    else:
+        failures = stress_nodes(args)
+    print("FAILED" if failures else "OK")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(arg_parser().parse_args())
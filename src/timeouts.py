@@ -0,0 +1,89 @@
+import threading
+import time
+
+# Deadlines, retry budgets and hedging for requests between nodes.
+#
+# Every request a node handles runs under a deadline. It comes from the
+# X-Deadline-Ms header (or the RPC frame) of the node that sent it, as the
+# milliseconds it has left, or from the node's --timeout if a client sent
+# it. The deadline is kept per thread, and each request the node makes on
+# behalf of it gets the time that is left, so a chain of forwards never
+# waits longer than the first node was willing to.
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+# Long enough to ride out a dropped SYN, which is retransmitted after 1 s.
+CONNECT_TIMEOUT = 3.0
+# Longest budget an RPC frame can carry, in ms.
+MAX_BUDGET_MS = 0xffff
+
+current = threading.local()
+
+
+def set_deadline(budget):
+    current.deadline = time.monotonic() + budget
+
+
+def get_deadline():
+    return getattr(current, "deadline", None)
+
+
+def restore_deadline(deadline):
+    current.deadline = deadline
+
+
+def remaining(default):
+    # Seconds left until the deadline of the current request, or default
+    # if this thread is not handling one.
+    deadline = get_deadline()
+    if deadline is None:
+        return default
+    return max(deadline - time.monotonic(), 0)
+
+
+def budget_ms(budget):
+    # A budget as it goes over the wire: whole ms, at least 1, since 0
+    # means no deadline.
+    return min(max(int(budget * 1000), 1), MAX_BUDGET_MS)
+
+
+class RetryBudget:
+    # Caps retries (and hedges) at `ratio` of the requests sent, so a
+    # struggling ring doesn't get hit with a wave of retries on top of its
+    # load. Every request earns `ratio` tokens and a retry spends one; the
+    # balance is capped at `reserve`, which also lets a quiet node retry.
+    def __init__(self, ratio=0.2, reserve=10):
+        self.ratio = ratio
+        self.reserve = reserve
+        self.tokens = reserve
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.tokens + self.ratio, self.reserve)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class LatencyTracker:
+    # The p95 of the last `size` forwarded reads, for the hedge delay.
+    # Until there are enough samples it gives `default`.
+    def __init__(self, size=256, default=0.05):
+        self.samples = [default] * size
+        self.count = 0
+        self.size = size
+        self.p95 = default
+        self.lock = threading.Lock()
+
+    def add(self, latency):
+        with self.lock:
+            self.samples[self.count % self.size] = latency
+            self.count += 1
+            # Sorting a few hundred floats is cheap, but not per request.
+            if self.count % 16 == 0:
+                samples = sorted(self.samples[:min(self.count, self.size)])
+                self.p95 = samples[int(len(samples) * 0.95)]
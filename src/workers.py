@@ -0,0 +1,351 @@
+import http.client
+import json
+import multiprocessing
+import signal
+import socketserver
+import threading
+from http.server import HTTPServer
+from urllib.parse import quote
+
+from compress import storage_request, storage_response
+from load import LoadTracker
+from locks import RWLock
+from node import NodeHttpHandler, ThreadingHttpServer, serve
+from store import ObjectStore, decode_items, encode_items
+
+# Running a node as several worker processes. All workers accept
+# connections on the node's port through SO_REUSEPORT, so the kernel spreads
+# clients across them, and they share one ring identity: the node's
+# neighbors and state live in shared memory. The keys the node owns are
+# sharded across the workers by hash, and each worker serves its shard to
+# the others on a private loopback port.
+
+RING_STATE_SIZE = 4096
+
+
+class SharedRing:
+    # The ring state of the node, as JSON in a shared buffer. Writers bump
+    # the version to an odd number while they write and back to an even
+    # number after, so readers can tell a torn read and retry. Readers keep
+    # the last decoded state until the version changes.
+    def __init__(self, ctx, state):
+        self.lock = RWLock(ctx)
+        self.joined = ctx.Event()
+        self.joined.set()
+        self.load = LoadTracker(ctx)
+        self.write_lock = ctx.Lock()
+        self.version = ctx.Value("Q", 0, lock=False)
+        self.buffer = ctx.Array("c", RING_STATE_SIZE, lock=False)
+        self.cache = (None, None)
+        self.buffer.value = json.dumps(state).encode()
+
+    def read(self):
+        while True:
+            version = self.version.value
+            if version == self.cache[0]:
+                return self.cache[1]
+            if version % 2:
+                continue
+            raw = self.buffer.value
+            if self.version.value == version:
+                state = json.loads(raw)
+                for side in ("successor", "predecessor"):
+                    if state.get(side):
+                        state[side] = tuple(state[side])
+                self.cache = (version, state)
+                return state
+
+    def write(self, **changes):
+        with self.write_lock:
+            state = dict(self.read())
+            state.update(changes)
+            raw = json.dumps(state).encode()
+            self.version.value += 1
+            self.buffer.value = raw
+            self.version.value += 1
+
+
+def shared_property(name):
+    return property(
+        lambda self: self.ring.read()[name],
+        lambda self, value: self.ring.write(**{name: value}))
+
+
+class ShardedStore(ObjectStore):
+    # The worker's own shard. Point lookups only ever see keys of this
+    # shard, but range operations, used when the node hands keys over,
+    # gather the range from every worker, and so do the counts.
+    def __init__(self, node, capacity=None, eviction="lru", keep_names=False):
+        super().__init__(capacity, eviction, keep_names)
+        self.node = node
+
+    def gather(self, start, end, pop, limit=None):
+        # With a limit, the first limit items of every shard, and the first
+        # limit of all of those.
+        items = []
+        for worker in range(self.node.workers):
+            if worker == self.node.worker:
+                items.extend(self.local_range(start, end, pop, limit))
+            else:
+                path = f"/shard/range?start={start}&end={end}"
+                if limit is not None:
+                    path += f"&limit={limit}"
+                status, body = self.node.shard_request(worker, "POST" if pop else "GET", path)
+                items.extend(decode_items(json.loads(body)))
+        # Ring order, which for a range that wraps is not plain hash order.
+        items.sort(key=lambda item: (item[0] < start, item[0]))
+        return items[:limit]
+
+    def local_range(self, start, end, pop, limit=None):
+        if pop:
+            return super().pop_range(start, end)
+        return super().items_in_range(start, end, limit)
+
+    def items_in_range(self, start, end, limit=None):
+        return self.gather(start, end, False, limit)
+
+    def pop_range(self, start, end):
+        return self.gather(start, end, True)
+
+    def pop_all(self):
+        return self.gather("", "", True)
+
+    def local_totals(self):
+        return super().totals()
+
+    def totals(self):
+        totals = self.local_totals()
+        for worker in range(self.node.workers):
+            if worker != self.node.worker:
+                status, body = self.node.shard_request(worker, "GET", "/shard/totals")
+                for name, value in json.loads(body).items():
+                    totals[name] += value
+        return totals
+
+    def __len__(self):
+        return self.totals()["keys"]
+
+
+class ShardHttpHandler(NodeHttpHandler):
+    def shard_range(self, pop):
+        query = self.query()
+        limit = int(query["limit"]) if "limit" in query else None
+        items = self.server.object_store.local_range(
+            query.get("start", ""), query.get("end", ""), pop, limit)
+        self.send_whole_response(200, encode_items(items))
+
+    def get_shard_range(self, value):
+        self.shard_range(pop=False)
+
+    def post_shard_range(self, value):
+        self.shard_range(pop=True)
+
+    def get_shard_totals(self, value):
+        self.send_whole_response(200, self.server.object_store.local_totals())
+
+    def put_faults(self, value):
+        # Fault rules sent on by another worker, only for this one.
+        self.server.faults.configure(json.loads(value))
+        self.send_whole_response(200, "")
+
+    routes = {
+        **NodeHttpHandler.routes,
+        ("GET", "/shard/range"): get_shard_range,
+        ("POST", "/shard/range"): post_shard_range,
+        ("GET", "/shard/totals"): get_shard_totals,
+        ("PUT", "/admin/faults"): put_faults,
+    }
+    available_when_crashed = NodeHttpHandler.available_when_crashed | {put_faults}
+
+
+class ShardListener(socketserver.ThreadingMixIn, HTTPServer):
+    # The private port a worker serves its shard on. Everything else is
+    # looked up on the worker's node.
+    daemon_threads = True
+
+    def __init__(self, node, port):
+        self.node = node
+        super().__init__(("127.0.0.1", port), ShardHttpHandler)
+
+    def __getattr__(self, name):
+        return getattr(self.node, name)
+
+
+class WorkerHttpServer(ThreadingHttpServer):
+    allow_reuse_port = True
+
+    key = shared_property("key")
+    successor = shared_property("successor")
+    predecessor = shared_property("predecessor")
+    splicing = shared_property("splicing")
+    sim_crashed = shared_property("sim_crashed")
+    left = shared_property("left")
+
+    def __init__(self, *args, ring, worker, workers, **kwargs):
+        self.ring = ring
+        self.worker = worker
+        self.workers = workers
+        super().__init__(*args, **kwargs)
+        self.ring_lock = ring.lock
+        self.joined = ring.joined
+        self.load = ring.load
+        # A cache's budget is split evenly between the shards.
+        store = self.object_store
+        capacity = store.capacity // workers if store.capacity else None
+        self.object_store = ShardedStore(self, capacity, store.eviction,
+                                         store.keep_names)
+        # Any free port; run_workers tells every worker where the others are.
+        self.shard_listener = ShardListener(self, 0)
+        self.shard_ports = []
+
+    def shard_port(self, worker):
+        return self.shard_ports[worker]
+
+    def shard_of(self, hashed_key):
+        return int(hashed_key[:8], 16) % self.workers
+
+    def shard_request(self, worker, method, path, value=None):
+        headers = {}
+        storage = path.startswith("/storage/")
+        if storage:
+            value, headers = storage_request(method, value)
+        conn = http.client.HTTPConnection("127.0.0.1", self.shard_port(worker))
+        conn.request(method, path, value, headers)
+        resp = conn.getresponse()
+        body = resp.read()
+        conn.close()
+        if storage and method in ("GET", "POST") and resp.status == 200:
+            body = storage_response(body, resp.getheaders())
+        return resp.status, body
+
+    def other_shard(self, hashed_key):
+        # The worker to pass a storage request on to, if this node owns the
+        # key but another worker holds its shard. Only known once a join is
+        # over; until then the node forwards the keys it is about to own.
+        worker = self.shard_of(hashed_key)
+        if worker == self.worker:
+            return None
+        self.wait_for_join()
+        with self.ring_lock.read():
+            return worker if self.next_hop(hashed_key) is None else None
+
+    def store_value(self, key, value, hashed_key=None, ttl=None, condition=None):
+        hashed_key = hashed_key or self.hash_value(key.encode())
+        worker = self.other_shard(hashed_key)
+        if worker is not None:
+            status, body = self.shard_request(
+                worker, "PUT", self.storage_path(key, ttl=ttl, condition=condition), value)
+            return status
+        return super().store_value(key, value, hashed_key, ttl, condition)
+
+    def modify_value(self, key, op, operand, hashed_key=None):
+        hashed_key = hashed_key or self.hash_value(key.encode())
+        worker = self.other_shard(hashed_key)
+        if worker is not None:
+            status, value = self.shard_request(
+                worker, "POST", self.storage_path(key, op=op), operand)
+            return status, value if status == 200 else None
+        return super().modify_value(key, op, operand, hashed_key)
+
+    def delete_value(self, key, hashed_key=None):
+        hashed_key = hashed_key or self.hash_value(key.encode())
+        worker = self.other_shard(hashed_key)
+        if worker is not None:
+            status, body = self.shard_request(
+                worker, "DELETE", f"/storage/{quote(key, safe='')}")
+            return status
+        return super().delete_value(key, hashed_key)
+
+    def get_value(self, key, hashed_key=None):
+        hashed_key = hashed_key or self.hash_value(key.encode())
+        worker = self.other_shard(hashed_key)
+        if worker is not None:
+            status, value = self.shard_request(worker, "GET", f"/storage/{quote(key, safe='')}")
+            return status, value if status == 200 else None
+        return super().get_value(key, hashed_key)
+
+    def accept_handoff(self, items, replace=False):
+        shards = [[] for worker in range(self.workers)]
+        for item in items:
+            shards[self.shard_of(item[0])].append(item)
+        for worker, shard in enumerate(shards):
+            if worker == self.worker:
+                super().accept_handoff(shard, replace)
+            elif shard:
+                self.shard_request(worker, "PUT", "/handoff?replace=1" if replace else "/handoff",
+                                   json.dumps(encode_items(shard)))
+
+    def configure_faults(self, rules):
+        # Every worker sends requests to other nodes, so they all need the
+        # rules.
+        super().configure_faults(rules)
+        for worker in range(self.workers):
+            if worker != self.worker:
+                self.shard_request(worker, "PUT", "/admin/faults", json.dumps(rules))
+
+    def store_stats(self):
+        stats = super().store_stats()
+        if "cache" in stats:
+            stats["cache"]["capacity"] = self.object_store.capacity * self.workers
+        return stats
+
+    def merkle_node(self, prefix):
+        # Each worker only has a tree over its own shard.
+        return {"error": "Merkle trees are not available with --workers"}
+
+    def anti_entropy(self, peer, start=None, end=None):
+        return 0
+
+
+def run_workers(args):
+    # The servers, and with them the listening sockets, are created before
+    # forking, so every worker starts from the same ring state. Each worker
+    # then closes the sockets that belong to the others.
+    ctx = multiprocessing.get_context("fork")
+    ring = SharedRing(ctx, {})
+    servers = [
+        WorkerHttpServer(('', args.port), NodeHttpHandler, ring=ring,
+                         worker=worker, workers=args.workers, rpc=args.rpc,
+                         request_timeout=args.timeout, hedge=args.hedge,
+                         cache_size=args.cache_size, eviction=args.eviction,
+                         compress=args.compress, compress_min_size=args.compress_min_size,
+                         keep_keys=args.keep_keys)
+        for worker in range(args.workers)
+    ]
+    shard_ports = [server.shard_listener.server_address[1] for server in servers]
+    for server in servers:
+        server.shard_ports = shard_ports
+    processes = [
+        ctx.Process(target=run_worker, args=(servers, worker, args))
+        for worker in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for server in servers:
+        server.server_close()
+        server.shard_listener.server_close()
+
+    def stop_workers(signum, frame):
+        print("We get signal (%s). Stopping workers" % signum)
+        for process in processes:
+            process.terminate()
+
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for process in processes:
+        process.join()
+
+
+def run_worker(servers, worker, args):
+    server = servers[worker]
+    for other in servers:
+        if other is not server:
+            other.server_close()
+            other.shard_listener.server_close()
+    thread = threading.Thread(target=server.shard_listener.serve_forever)
+    thread.daemon = True
+    thread.start()
+    # Only the first worker joins the ring, on behalf of the whole node.
+    if worker != 0:
+        args.entry = None
+    serve(server, args)